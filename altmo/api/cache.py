@@ -0,0 +1,202 @@
+"""
+Persistent on-disk cache for Valhalla matrix results
+"""
+from __future__ import annotations
+
+import sqlite3
+import struct
+import time
+from dataclasses import dataclass
+from typing import Callable
+
+from altmo.data.types import Point, NetworkDistanceRow
+from altmo.planner import MatrixRequest
+
+# Coordinates are rounded to this many decimal places before being used as a key (roughly one meter)
+CACHE_KEY_PRECISION = 5
+
+# Default maximum number of routes kept in the cache
+DEFAULT_CACHE_SIZE = 10_000_000
+
+# Number of keys looked up or touched per statement, below SQLite's limit on the number of parameters
+CACHE_LOOKUP_SIZE = 500
+
+_KEY_STRUCT = struct.Struct('<iiii')
+
+
+@dataclass
+class CacheStats:
+    hits: int = 0
+    misses: int = 0
+    requests: int = 0
+
+    def __add__(self, other: CacheStats) -> CacheStats:
+        return CacheStats(self.hits + other.hits, self.misses + other.misses, self.requests + other.requests)
+
+    @property
+    def hit_rate(self) -> float:
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+    @property
+    def saved_requests(self) -> int:
+        """
+        Estimates the requests we did not have to send, using the average number of
+        pairs per request we did send
+        """
+        if not self.requests or not self.misses:
+            return 0
+        return round(self.hits / (self.misses / self.requests))
+
+    def __str__(self):
+        return (
+            f'Route cache: {self.hits} hits, {self.misses} misses ({self.hit_rate:.1%} hit rate), '
+            f'{self.requests} requests sent, ~{self.saved_requests} requests saved'
+        )
+
+
+class RouteCache:
+    """
+    SQLite backed cache of the distance and time between two points for a costing.
+
+    Keys are the quantized source and target coordinates plus the costing. Once the cache holds more
+    than `max_size` routes, the least recently used ones are evicted.
+
+    Several worker processes may share one cache file, so nothing about its contents is kept in the
+    process: routes are stamped with the wall clock when they are used, and the number of routes is
+    kept in the `meta` table, updated in the same transaction as the routes themselves.
+    """
+    def __init__(self, file_name: str, max_size: int = DEFAULT_CACHE_SIZE, precision: int = CACHE_KEY_PRECISION):
+        self.file_name = file_name
+        self.max_size = max_size
+        self.stats = CacheStats()
+        self._factor = 10 ** precision
+        # Several worker processes may share one cache file, so wait for their locks to be released
+        self._conn = sqlite3.connect(file_name, timeout=60)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute('PRAGMA synchronous=NORMAL')
+        self._conn.execute(
+            'CREATE TABLE IF NOT EXISTS routes ('
+            'key BLOB, costing TEXT, distance REAL, time INTEGER, used INTEGER, '
+            'PRIMARY KEY (key, costing)) WITHOUT ROWID'
+        )
+        self._conn.execute('CREATE INDEX IF NOT EXISTS routes_used_idx ON routes (used)')
+        self._conn.execute('CREATE TABLE IF NOT EXISTS meta (name TEXT PRIMARY KEY, value INTEGER)')
+        self._conn.execute("INSERT OR IGNORE INTO meta (name, value) SELECT 'size', count(*) FROM routes")
+        self._conn.commit()
+
+    def __repr__(self):
+        return f'<RouteCache file_name={self.file_name} size={self.size} max_size={self.max_size}>'
+
+    @property
+    def size(self) -> int:
+        """Number of routes in the cache, including those added by other processes"""
+        return self._conn.execute("SELECT value FROM meta WHERE name = 'size'").fetchone()[0]
+
+    def close(self) -> None:
+        self._conn.commit()
+        self._conn.close()
+
+    def _key(self, source: Point, target: Point) -> bytes:
+        return _KEY_STRUCT.pack(
+            round(source.lat * self._factor), round(source.lng * self._factor),
+            round(target.lat * self._factor), round(target.lng * self._factor),
+        )
+
+    def get(self, keys: list[bytes], costing: str) -> dict[bytes, tuple]:
+        """
+        Returns the cached (distance, time) of each of `keys` we know about and marks them as used.
+
+        Keys are looked up `CACHE_LOOKUP_SIZE` at a time, and all of them are marked in a single transaction.
+        """
+        found = {}
+        for idx in range(0, len(keys), CACHE_LOOKUP_SIZE):
+            chunk = keys[idx:idx + CACHE_LOOKUP_SIZE]
+            placeholders = ','.join('?' * len(chunk))
+            found.update(
+                (key, (distance, time_))
+                for key, distance, time_ in self._conn.execute(
+                    f'SELECT key, distance, time FROM routes WHERE costing = ? AND key IN ({placeholders})',
+                    (costing, *chunk)
+                )
+            )
+
+        if found:
+            used = time.time_ns()
+            found_keys = list(found)
+            for idx in range(0, len(found_keys), CACHE_LOOKUP_SIZE):
+                chunk = found_keys[idx:idx + CACHE_LOOKUP_SIZE]
+                placeholders = ','.join('?' * len(chunk))
+                self._conn.execute(
+                    f'UPDATE routes SET used = ? WHERE costing = ? AND key IN ({placeholders})',
+                    (used, costing, *chunk)
+                )
+            self._conn.commit()
+
+        return found
+
+    def split(
+        self, groups: list[tuple[Point, list[Point]]], costing: str, on_hit: Callable[[list], None]
+    ) -> list[tuple[Point, list[Point]]]:
+        """
+        Passes the rows we have cached for `groups` to `on_hit` and returns the groups again,
+        keeping only the amenities which still need to be routed.
+
+        All of `groups` (a planner window) is looked up at once, so the cache file is only written
+        to once per window instead of once per residence.
+        """
+        found = self.get(
+            list({self._key(residence, amenity) for residence, amenities in groups for amenity in amenities}),
+            costing
+        )
+        groups_missing = []
+
+        for residence, amenities in groups:
+            missing = []
+            rows = []
+            for amenity in amenities:
+                route = found.get(self._key(residence, amenity))
+                if route is None:
+                    missing.append(amenity)
+                else:
+                    rows.append(NetworkDistanceRow(*route, amenity.id, residence.id, costing))
+
+            self.stats.hits += len(rows)
+            self.stats.misses += len(missing)
+
+            if rows:
+                on_hit(rows)
+            if missing:
+                groups_missing.append((residence, missing))
+
+        return groups_missing
+
+    def put(self, request: MatrixRequest, matrix: list[list[dict]], costing: str) -> None:
+        """
+        Stores every cell of a matrix response, including the ones we did not ask for
+        """
+        used = time.time_ns()
+        self.stats.requests += 1
+        cur = self._conn.executemany(
+            'INSERT OR IGNORE INTO routes (key, costing, distance, time, used) VALUES (?, ?, ?, ?, ?)',
+            (
+                (self._key(source, target), costing, cell['distance'], cell['time'], used)
+                for source, row in zip(request.sources, matrix)
+                for target, cell in zip(request.targets, row)
+            )
+        )
+        self._conn.execute("UPDATE meta SET value = value + ? WHERE name = 'size'", (cur.rowcount,))
+        if self.size > self.max_size:
+            # Recount before evicting, so that we never evict more than needed
+            size = self._conn.execute('SELECT count(*) FROM routes').fetchone()[0]
+            if size > self.max_size:
+                self._evict(size - self.max_size)
+            self._conn.execute("UPDATE meta SET value = ? WHERE name = 'size'", (min(size, self.max_size),))
+        self._conn.commit()
+
+    def _evict(self, count: int) -> None:
+        """Removes the `count` least recently used routes"""
+        self._conn.execute(
+            'DELETE FROM routes WHERE (key, costing) IN (SELECT key, costing FROM routes ORDER BY used LIMIT ?)',
+            (count,)
+        )
@@ -0,0 +1,123 @@
+"""
+Stand-in for a Valhalla server which only implements `sources_to_targets`.
+
+It answers with straight line distances instead of real routes, but it behaves like a real
+server where it matters for throughput: every request takes some time, some of them fail and
+matrices larger than the limit are rejected.
+"""
+from __future__ import annotations
+
+import asyncio
+import contextlib
+import math
+import multiprocessing
+import random
+from dataclasses import dataclass
+from typing import Iterator
+
+from aiohttp import web
+
+# Walking speed in meters per second used to turn distances into times
+FAKE_SPEED = 1.4
+
+EARTH_RADIUS_KM = 6371.0
+
+
+@dataclass
+class FakeValhallaOptions:
+    # Mean number of seconds each request takes
+    latency: float = 0.05
+    # Share of requests (0-1) which fail with a 500 response
+    error_rate: float = 0.0
+    # Maximum number of cells (sources × targets) in a matrix; larger requests get a 400 response
+    matrix_limit: int = 2500
+
+
+def get_distance(source: dict, target: dict) -> float:
+    """
+    Haversine distance between two Valhalla locations in kilometers
+    """
+    lat1, lng1, lat2, lng2 = map(math.radians, (source['lat'], source['lon'], target['lat'], target['lon']))
+    a = math.sin((lat2 - lat1) / 2) ** 2 + math.cos(lat1) * math.cos(lat2) * math.sin((lng2 - lng1) / 2) ** 2
+
+    return 2 * EARTH_RADIUS_KM * math.asin(math.sqrt(a))
+
+
+def get_fake_cell(source: dict, target: dict, src_idx: int, tgt_idx: int) -> dict:
+    distance = get_distance(source, target)
+
+    return {
+        'distance': round(distance, 3),
+        'time': round(distance * 1000 / FAKE_SPEED),
+        'from_index': src_idx,
+        'to_index': tgt_idx,
+    }
+
+
+def get_fake_matrix(sources: list[dict], targets: list[dict]) -> list[list[dict]]:
+    return [
+        [get_fake_cell(source, target, src_idx, tgt_idx) for tgt_idx, target in enumerate(targets)]
+        for src_idx, source in enumerate(sources)
+    ]
+
+
+def create_app(options: FakeValhallaOptions) -> web.Application:
+    async def sources_to_targets(request: web.Request) -> web.Response:
+        data = await request.json()
+        sources, targets = data.get('sources', []), data.get('targets', [])
+
+        # Exponentially distributed latency gives us the long tail real servers have
+        await asyncio.sleep(random.expovariate(1 / options.latency) if options.latency else 0)
+
+        if len(sources) * len(targets) > options.matrix_limit:
+            return web.json_response(
+                {'error_code': 154, 'error': 'Exceeded max locations'}, status=400
+            )
+        if random.random() < options.error_rate:
+            return web.json_response({'error': 'Fake server error'}, status=500)
+
+        return web.json_response({
+            'sources_to_targets': get_fake_matrix(sources, targets),
+            'units': 'kilometers',
+        })
+
+    app = web.Application()
+    app.router.add_post('/sources_to_targets', sources_to_targets)
+
+    return app
+
+
+def _serve(options: FakeValhallaOptions, host: str, port_queue: multiprocessing.Queue) -> None:
+    """
+    Runs the server until the process is terminated, sending the port it listens on to `port_queue`
+    """
+    async def main():
+        runner = web.AppRunner(create_app(options))
+        await runner.setup()
+        site = web.TCPSite(runner, host, 0)
+        await site.start()
+        port_queue.put(runner.addresses[0][1])
+        await asyncio.Event().wait()
+
+    asyncio.run(main())
+
+
+@contextlib.contextmanager
+def fake_valhalla_server(options: FakeValhallaOptions = None, host: str = '127.0.0.1') -> Iterator[str]:
+    """
+    Starts the fake server in its own process and yields its URL.
+
+    Using a separate process keeps the server from competing with the client for the event loop
+    (and from showing up in the client's memory usage).
+    """
+    port_queue = multiprocessing.Queue()
+    process = multiprocessing.Process(
+        target=_serve, args=(options or FakeValhallaOptions(), host, port_queue), daemon=True
+    )
+    process.start()
+
+    try:
+        yield f'http://{host}:{port_queue.get(timeout=30)}'
+    finally:
+        process.terminate()
+        process.join()
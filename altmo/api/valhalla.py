@@ -1,19 +1,50 @@
 from __future__ import annotations
 
+import asyncio
+import contextlib
+import time
 from functools import wraps
+from typing import AsyncIterator, Union
 
 import aiohttp
 
 from altmo.data.types import Point
-from altmo.settings import get_config_method, Config
+from altmo.errors import ValhallaServerError, ValhallaRequestError
+from altmo.settings import get_config, Config
+
+# Server URLs starting with this prefix are reached through a Unix domain socket
+UNIX_SOCKET_PREFIX = "unix://"
+
+# Consecutive failures before we stop sending requests to a server
+CIRCUIT_BREAKER_THRESHOLD = 5
+
+# Seconds to wait before trying a server again after its circuit breaker opened
+CIRCUIT_BREAKER_RESET_TIMEOUT = 30.0
+
+
+@contextlib.asynccontextmanager
+@get_config
+async def valhalla_client(config: Config) -> AsyncIterator[ValhallaAsyncClient]:
+    """
+    Creates a ValhallaAsyncClient for every server in `config.VALHALLA_SERVER` and
+    closes its connection pools once we are done with it
+    """
+    servers = [
+        ValhallaServer(url, connection_limit=config.VALHALLA_CONNECTION_LIMIT)
+        for url in get_server_urls(config.VALHALLA_SERVER)
+    ]
+    try:
+        yield ValhallaAsyncClient(servers)
+    finally:
+        for server in servers:
+            await server.close()
 
 
 def async_http_client(func):
     """Provides an async http client to functions"""
     @wraps(func)
     async def wrapper(*args, **kwargs):
-        async with aiohttp.ClientSession() as session:
-            client = ValhallaAsyncClient(session)
+        async with valhalla_client() as client:
             return await func(client, *args, **kwargs)
     return wrapper
 
@@ -22,22 +53,30 @@ def async_http_client_method(func):
     """Provides an async http client to class methods"""
     @wraps(func)
     async def wrapper(*args, **kwargs):
-        async with aiohttp.ClientSession() as session:
-            client = ValhallaAsyncClient(session)
+        async with valhalla_client() as client:
             self, *_args = args
             return await func(self, client, *_args, **kwargs)
     return wrapper
 
 
-def get_matrix_request(residence: Point, amenities: list[Point], costing: str = "auto") -> dict:
+def get_server_urls(value: Union[str, list[str]]) -> list[str]:
+    """
+    `VALHALLA_SERVER` may either be a single URL or a list of them
+    """
+    if isinstance(value, str):
+        return [value]
+    return list(value)
+
+
+def get_matrix_request(sources: list[Point], targets: list[Point], costing: str = "auto") -> dict:
     """
     This returns the JSON serializable object that we pass to the matrix API.
 
     More information about the API request and response here:
         - https://valhalla.readthedocs.io/en/latest/api/matrix/api-reference/
     """
-    sources = [{"lat": residence.lat, "lon": residence.lng}]
-    targets = [{"lat": row.lat, "lon": row.lng} for row in amenities]
+    sources = [{"lat": row.lat, "lon": row.lng} for row in sources]
+    targets = [{"lat": row.lat, "lon": row.lng} for row in targets]
 
     return {
         "sources": sources,
@@ -46,14 +85,127 @@ def get_matrix_request(residence: Point, amenities: list[Point], costing: str =
     }
 
 
+class CircuitBreaker:
+    """
+    Keeps track of consecutive failures for a single server.
+
+    After `threshold` consecutive failures the breaker opens and the server is skipped for
+    `reset_timeout` seconds. After that, requests are let through again; one more failure
+    opens the breaker again while a success closes it.
+    """
+    def __init__(
+        self,
+        threshold: int = CIRCUIT_BREAKER_THRESHOLD,
+        reset_timeout: float = CIRCUIT_BREAKER_RESET_TIMEOUT
+    ):
+        self.threshold = threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self._opened_at = None
+
+    @property
+    def available(self) -> bool:
+        return self.retry_in == 0
+
+    @property
+    def retry_in(self) -> float:
+        """Seconds until requests are let through again"""
+        if self._opened_at is None:
+            return 0
+        return max(0, self._opened_at + self.reset_timeout - time.monotonic())
+
+    def record_success(self) -> None:
+        self.failures = 0
+        self._opened_at = None
+
+    def record_failure(self) -> None:
+        self.failures += 1
+        if self.failures >= self.threshold:
+            self._opened_at = time.monotonic()
+
+
+class ValhallaServer:
+    """
+    A single Valhalla server along with its own pool of keep-alive connections.
+
+    Passing a URL like `unix:///var/run/valhalla.sock` connects through a Unix domain socket.
+    """
+    def __init__(self, url: str, connection_limit: int = 100):
+        if url.startswith(UNIX_SOCKET_PREFIX):
+            connector = aiohttp.UnixConnector(path=url[len(UNIX_SOCKET_PREFIX):], limit=connection_limit)
+            self.url = "http://localhost"
+        else:
+            connector = aiohttp.TCPConnector(limit=0, limit_per_host=connection_limit)
+            self.url = url.rstrip("/")
+
+        self.name = url
+        self.outstanding = 0
+        self.breaker = CircuitBreaker()
+        self._session = aiohttp.ClientSession(connector=connector)
+
+    def __repr__(self):
+        return f'<ValhallaServer url={self.name} outstanding={self.outstanding}>'
+
+    async def post(self, path: str, *args, **kwargs) -> dict:
+        """
+        Sends a POST request to `path` and returns the decoded JSON response
+
+        :raises: ValhallaServerError, ValhallaRequestError
+        """
+        self.outstanding += 1
+        try:
+            resp = await self._session.post(f'{self.url}{path}', *args, **kwargs)
+            try:
+                if not resp.ok and resp.status < 500:
+                    raise ValhallaRequestError(f'{self.name} responded with {resp.status}: {await resp.text()}')
+                if not resp.ok:
+                    raise ValhallaServerError(f'{self.name} responded with {resp.status}')
+                data = await resp.json()
+            finally:
+                # Hands the connection back to the pool even when we did not read the body
+                resp.release()
+        except (aiohttp.ClientError, asyncio.TimeoutError, ValueError, ValhallaServerError) as exc:
+            self.breaker.record_failure()
+            if isinstance(exc, ValhallaServerError):
+                raise
+            raise ValhallaServerError(f'{self.name}: {exc!r}') from exc
+        finally:
+            self.outstanding -= 1
+
+        self.breaker.record_success()
+        return data
+
+    async def close(self) -> None:
+        await self._session.close()
+
+
 class ValhallaAsyncClient:
     """
-    Thin wrapper around aiohttp.ClientSession to provide async methods for Valhalla API
+    Thin wrapper around one or more ValhallaServer objects to provide async methods for Valhalla API.
+
+    Each request goes to the server with the fewest outstanding requests, so a slow replica
+    receives less work instead of setting the pace for all the others.
     """
-    def __init__(self, session: aiohttp.ClientSession):
-        self._session = session
+    def __init__(self, servers: list[ValhallaServer]):
+        self._servers = servers
+
+    @property
+    def servers(self) -> list[ValhallaServer]:
+        return self._servers
+
+    async def _get_server(self) -> ValhallaServer:
+        """
+        Least outstanding requests load balancing, skipping servers whose circuit breaker is open.
+
+        When every circuit breaker is open we wait until the first one lets requests through again,
+        rather than failing requests that no server has even seen.
+        """
+        while True:
+            servers = [server for server in self._servers if server.breaker.available]
+            if servers:
+                return min(servers, key=lambda server: server.outstanding)
+            await asyncio.sleep(min(server.breaker.retry_in for server in self._servers))
 
-    @get_config_method
-    async def source_to_targets(self, config: Config, *args, **kwargs):
-        url = f'{config.VALHALLA_SERVER}/sources_to_targets'
-        return await (await self._session.post(url, *args, **kwargs)).json()
+    async def source_to_targets(self, *args, **kwargs):
+        server = await self._get_server()
+        return await server.post('/sources_to_targets', *args, **kwargs)
@@ -5,22 +5,26 @@ from __future__ import annotations
 
 import abc
 import asyncio
+import json
 import logging
+import random
 import sys
 from collections import defaultdict
 from collections.abc import Sequence
-from dataclasses import dataclass
-from typing import Callable
+from dataclasses import dataclass, field
+from typing import AsyncIterable, Callable, Iterable, Iterator, Union
 
 import aiocsv
 import aiofiles
-from psycopg2.errors import UniqueViolation
 
+from altmo.api.cache import RouteCache
 from altmo.api.valhalla import ValhallaAsyncClient, get_matrix_request
-from altmo.data.decorators import async_postgres_cursor_method
-from altmo.data.types import StraightDistanceRow, Point
-from altmo.data.write import add_amenity_residence_distance_async
-from altmo.utils import grouper
+from altmo.data.types import Point, StraightDistanceRow
+from altmo.errors import ValhallaError, ValhallaRequestError
+from altmo.data.write import copy_amenity_residence_distance
+from altmo.metrics import Metrics
+from altmo.planner import MatrixRequest, plan_matrix_requests, DEFAULT_PLANNER_WINDOW
+from altmo.utils import grouper_async
 
 logger = logging.getLogger("batches")
 logging.getLogger("chardet.charsetprober").disabled = True
@@ -28,15 +32,98 @@ logging.getLogger("chardet.charsetprober").disabled = True
 
 @dataclass
 class BatchConfig:
-    costing: str
+    # Every pair is routed once for each of these Valhalla costing models
+    costings: list[str]
     out: str
     file_name: str
+    matrix_limit: int = 2500
+    # Maximum number of in-flight Valhalla requests
+    concurrency: int = 10
+    # Maximum number of responses waiting to be written
+    queue_size: int = 100
+    # Number of times a failed request is retried before it is given up on
+    retries: int = 3
+    # Base delay in seconds for the exponential backoff between retries
+    backoff: float = 0.5
+    # File where requests are saved once we have given up on them
+    dead_letter_file: str = None
+    # Persistent cache of routes we have already calculated
+    cache: RouteCache = None
+    # Number of residence amenity pairs read from the database at a time
+    fetch_size: int = 10_000
+    # Number of rows the database writer buffers before writing them
+    flush_size: int = 50_000
+    # Maximum number of seconds rows stay in the database writer's buffer
+    flush_interval: float = 5.0
+    # Called with the number of rows each time a writer has written some
+    on_progress: Callable[[int], None] = None
+    # Counters and histograms describing the run, see `altmo.metrics`
+    metrics: Metrics = field(default_factory=Metrics)
+    # File the metrics are periodically written to; JSON if it ends with ".json", else a Prometheus textfile
+    metrics_file: str = None
+    # Labels added to every metric in the Prometheus textfile
+    metrics_labels: dict[str, str] = None
+    # Shows a compact progress line built from the metrics on stderr
+    progress: bool = False
 
 
 class ReaderBatchError(Exception):
     pass
 
 
+def get_backoff(attempt: int, base: float, cap: float = 30.0) -> float:
+    """
+    Exponential backoff with "full jitter" for the given attempt (starting at 0)
+    """
+    return random.uniform(0, min(cap, base * 2 ** attempt))
+
+
+class DeadLetterFile:
+    """
+    Stores matrix requests we gave up on as JSON lines so that they can be replayed later.
+
+    Each line holds the costing, the error and the residences with the amenities they needed.
+    """
+    def __init__(self, file_name: str):
+        self.file_name = file_name
+
+    def write(self, request: MatrixRequest, costing: str, error: Exception) -> None:
+        residences = defaultdict(list)
+        for src_idx, tgt_idx in request.pairs:
+            residences[src_idx].append(request.targets[tgt_idx])
+
+        entry = {
+            'costing': costing,
+            'error': str(error),
+            'residences': [
+                {
+                    'id': request.sources[src_idx].id,
+                    'lat': request.sources[src_idx].lat,
+                    'lng': request.sources[src_idx].lng,
+                    'amenities': [{'id': amt.id, 'lat': amt.lat, 'lng': amt.lng} for amt in amenities]
+                }
+                for src_idx, amenities in residences.items()
+            ]
+        }
+        with open(self.file_name, 'a') as fp:
+            fp.write(f'{json.dumps(entry)}\n')
+
+    def read(self) -> dict[str, list[StraightDistanceRow]]:
+        """
+        Reads the failed residence amenity pairs back, grouped by costing
+        """
+        rows = defaultdict(list)
+        with open(self.file_name) as fp:
+            for line in fp:
+                entry = json.loads(line)
+                for res in entry['residences']:
+                    rows[entry['costing']] += [
+                        StraightDistanceRow(res['id'], amt['id'], res['lat'], res['lng'], amt['lat'], amt['lng'])
+                        for amt in res['amenities']
+                    ]
+        return rows
+
+
 class ReaderBatch(abc.ABC, Sequence):
     """
     Creates jobs which read data from various sources
@@ -64,47 +151,67 @@ class WriterBatch(abc.ABC):
     """
     Base writer class
     """
+    _consumer: asyncio.Task = None
+
     @abc.abstractmethod
     async def consume(self, queue: asyncio.Queue) -> None:
         ...
 
-    def register(self, queue: asyncio.Queue) -> None:
+    def report(self, count: int) -> None:
         """
-        Creates a task and then adds our _handle_results callback
+        Counts the rows just written and passes their number on to `config.on_progress`
         """
-        def _handle_result(task_: asyncio.Task) -> None:
-            try:
-                task_.result()
-            except asyncio.exceptions.CancelledError:
-                pass
-            except Exception as exc:
-                raise exc
+        self.config.metrics.pairs += count
+        if self.config.on_progress is not None:
+            self.config.on_progress(count)
+
+    async def stop(self, queue: asyncio.Queue) -> None:
+        """
+        Tells the consumer to stop by sending it `None` and waits until it has written everything
+        """
+        await queue.put(None)
+        await self._consumer
 
-        task = asyncio.create_task(self.consume(queue))
-        task.add_done_callback(_handle_result)
+    def register(self, queue: asyncio.Queue) -> None:
+        """
+        Creates the consumer task; `batch_manager` watches it and raises its error should it fail
+        """
+        self._consumer = asyncio.create_task(self.consume(queue))
 
 
-def batch_manager(reader: ReaderBatch, writer: WriterBatch) -> Callable:
+def batch_manager(reader: ReaderBatch, writer: WriterBatch, queue_size: int = 0) -> Callable:
     """
     Returns a callable which bootstraps the batch_manager process
-    """
-    queue = asyncio.Queue()
 
+    :param queue_size: maximum number of items waiting between `reader` and `writer`. Readers
+                       block once it is full, which keeps memory usage flat. `0` means unbounded.
+    """
     async def run():
-        """Runs the batch import process, linking `reader` and `writer` together"""
+        """
+        Runs the batch import process, linking `reader` and `writer` together.
+
+        When any reader or the writer fails, everything else is cancelled and its error is raised.
+        Otherwise readers would wait forever on a full queue nobody consumes anymore.
+        """
+        queue = asyncio.Queue(maxsize=queue_size)
         reader.register(queue)
         writer.register(queue)
 
-        await asyncio.gather(*reader)
-        await queue.join()
+        async def finish():
+            await asyncio.gather(*reader)
+            await queue.join()
+            await writer.stop(queue)
 
-        # Cancel all remaining tasks
-        tasks = [
-            t for t in asyncio.all_tasks()
-            if t is not asyncio.current_task()
-        ]
+        tasks = [*reader, writer._consumer, asyncio.create_task(finish())]
+        done, pending = await asyncio.wait(tasks, return_when=asyncio.FIRST_EXCEPTION)
+
+        for task in pending:
+            task.cancel()
+        await asyncio.gather(*pending, return_exceptions=True)
 
-        tuple(t.cancel() for t in tasks)
+        for task in tasks:
+            if task in done and not task.cancelled() and task.exception() is not None:
+                raise task.exception()
 
     return run
 
@@ -114,59 +221,145 @@ class ValhallaReaderBatch(ReaderBatch):
     Manages reading operations from the Valhalla API
     """
 
-    # Current limit of batch size for this API
-    VALHALLA_BATCH_LIMIT: int = 50
-
     def __init__(
-        self, data: list[StraightDistanceRow], client: ValhallaAsyncClient, config: BatchConfig
+        self,
+        groups: Union[Iterable[tuple[Point, list[Point]]], AsyncIterable[tuple[Point, list[Point]]]],
+        client: ValhallaAsyncClient,
+        config: BatchConfig
     ):
-        self.data = data
+        self.groups = groups
         self.client = client
         self.config = config
+        self.dead_letters = DeadLetterFile(config.dead_letter_file) if config.dead_letter_file else None
         self._producers = []
 
     def register(self, queue: asyncio.Queue) -> None:
         """
-        Sets the producers attribute using the provided queue object
+        Sets the producers attribute using the provided queue object.
+
+        We start a fixed pool of `config.concurrency` workers which pull matrix requests from
+        a small, bounded request queue. That queue is filled lazily from `self.groups`, so only a
+        handful of requests exist at any one time no matter how many rows we have been given.
+        """
+        requests = asyncio.Queue(maxsize=self.config.concurrency)
+        self.config.metrics.queues.update(requests=requests.qsize, results=queue.qsize)
+
+        self._producers = [asyncio.create_task(self.feed(requests, queue))]
+        self._producers += [
+            asyncio.create_task(self.work(requests, queue))
+            for _ in range(self.config.concurrency)
+        ]
+
+    async def feed(self, requests: asyncio.Queue, queue: asyncio.Queue) -> None:
+        """
+        Plans matrix requests from `self.groups` and hands them to the workers, then tells every
+        worker to stop by sending it `None`.
+
+        `self.groups` is only read once; each planned request is sent once for every costing in
+        `config.costings`. It may also be an async iterable, such as the groups of an
+        `AsyncStraightDistanceResultSet`, in which case the workers keep routing while we wait for rows.
         """
-        self._producers = []
-        for residence, amenities in self._group_data_by_residence().items():
-            group = grouper(amenities, size=self.VALHALLA_BATCH_LIMIT)
+        cached_rows = []
+
+        async for window in grouper_async(self.groups, DEFAULT_PLANNER_WINDOW):
+            for costing, request in self.plan(window, on_hit=cached_rows.extend):
+                if cached_rows:
+                    self.config.metrics.cache_hits += len(cached_rows)
+                    await queue.put(cached_rows[:])
+                    cached_rows.clear()
 
-            for idx, amt_batch in enumerate(group, start=1):
-                task = asyncio.create_task(self.produce(queue, residence, amt_batch))
-                self._producers.append(task)
-                logger.info(f'Adding Task {idx} for {residence}')
+                await requests.put((costing, request))
 
-    def _group_data_by_residence(self) -> dict[Point, list[Point]]:
+        if cached_rows:
+            self.config.metrics.cache_hits += len(cached_rows)
+            await queue.put(cached_rows[:])
+
+        for _ in range(self.config.concurrency):
+            await requests.put(None)
+
+    def plan(
+        self, groups: list[tuple[Point, list[Point]]], on_hit: Callable[[list], None]
+    ) -> Iterator[tuple[str, MatrixRequest]]:
+        """
+        Yields (costing, request) for every costing we route `groups` with.
+
+        When a route cache is configured, cached pairs are passed to `on_hit` and only the cache
+        misses are planned, which may differ per costing.
         """
-        Groups the `self.data` attribute by residence(id, lat, lng)
+        if self.config.cache is None:
+            for request in plan_matrix_requests(groups, self.config.matrix_limit):
+                for costing in self.config.costings:
+                    yield costing, request
+            return
+
+        for costing in self.config.costings:
+            missing = self.config.cache.split(groups, costing, on_hit=on_hit)
+            for request in plan_matrix_requests(missing, self.config.matrix_limit):
+                yield costing, request
+
+    async def work(self, requests: asyncio.Queue, queue: asyncio.Queue) -> None:
         """
-        residence_group = defaultdict(list)
-        for row in self.data:
-            residence_group[
-                Point(row.residence_id, row.residence_lat, row.residence_lng)
-            ].append(
-                Point(row.amenity_id, row.amenity_lat, row.amenity_lng)
-            )
-        return residence_group
+        Worker which sends requests to the Valhalla API until it receives `None`
+        """
+        while True:
+            item = await requests.get()
+            if item is None:
+                return
+            await self.produce(queue, *item)
 
-    async def produce(self, queue: asyncio.Queue, residence: Point, amenities: list[Point]):
+    async def produce(self, queue: asyncio.Queue, costing: str, request: MatrixRequest):
         """
-        Task to retrieve data from Valhalla API using its `sources_to_targets` endpoint
+        Task to retrieve data from Valhalla API using its `sources_to_targets` endpoint.
+
+        Failed requests are retried `config.retries` times with a jittered exponential backoff.
+        After that the request is written to the dead letter file, or if there is none, a
+        ReaderBatchError is raised.
+
+        Requests rejected by Valhalla (4xx) are not retried as they are. When they hold more than one
+        residence they are split in two and each half is sent on its own, so that only the residences
+        which are rejected by themselves end up in the dead letter file.
         """
-        json_data = get_matrix_request(residence, amenities, costing=self.config.costing)
-        data = (
-            StraightDistanceRow(residence.id, amenity.id, residence.lat, residence.lng, amenity.lat, amenity.lng)
-            for amenity in amenities
-        )
-        resp = None
+        json_data = get_matrix_request(request.sources, request.targets, costing=costing)
+        metrics = self.config.metrics
 
-        try:
-            resp = (await self.client.source_to_targets(json=json_data))
-            await queue.put((resp['sources_to_targets'][0], data))
-        except (KeyError, IndexError):
-            raise ReaderBatchError(f'Malformed response: {resp}')
+        for attempt in range(self.config.retries + 1):
+            resp = None
+            try:
+                metrics.requests += 1
+                metrics.requests_in_flight += 1
+                try:
+                    with metrics.valhalla_latency.time():
+                        resp = (await self.client.source_to_targets(json=json_data))
+                finally:
+                    metrics.requests_in_flight -= 1
+                rows = request.get_rows(resp['sources_to_targets'], costing)
+                if self.config.cache is not None:
+                    self.config.cache.put(request, resp['sources_to_targets'], costing)
+            except ValhallaRequestError as exc:
+                error = exc
+                metrics.errors[type(exc).__name__] += 1
+                break
+            except (KeyError, IndexError, TypeError, ValhallaError) as exc:
+                error = exc if isinstance(exc, ValhallaError) else ReaderBatchError(f'Malformed response: {resp}')
+                metrics.errors[type(error).__name__] += 1
+                logger.warning(f'Attempt {attempt + 1} failed for {len(request.sources)} residences: {error}')
+                if attempt < self.config.retries:
+                    await asyncio.sleep(get_backoff(attempt, self.config.backoff))
+            else:
+                await queue.put(rows)
+                return
+
+        if isinstance(error, ValhallaRequestError) and len(request.sources) > 1:
+            logger.warning(f'Request for {len(request.sources)} residences rejected, splitting it: {error}')
+            for half in request.split():
+                await self.produce(queue, costing, half)
+            return
+
+        if self.dead_letters is None:
+            raise ReaderBatchError(str(error))
+
+        logger.error(f'Giving up on {len(request.sources)} residences: {error}')
+        self.dead_letters.write(request, costing, error)
 
 
 class StdOutWriterBatch(WriterBatch):
@@ -181,15 +374,14 @@ class StdOutWriterBatch(WriterBatch):
         Consumer that prints the results it receives to stdout using whatever print function was supplied.
         """
         while True:
-            http_res, db_res = await queue.get()
-            for http_data, db_data in zip(http_res, db_res):
-                row = (
-                    http_data['distance'], http_data['time'],
-                    db_data.amenity_id, db_data.residence_id,
-                    self.config.costing
-                )
+            rows = await queue.get()
+            if rows is None:
+                queue.task_done()
+                return
+            for row in rows:
                 str_row = (str(fld) for fld in row)
                 sys.stdout.write(f'{",".join(str_row)}\n')
+            self.report(len(rows))
             queue.task_done()
 
 
@@ -213,49 +405,79 @@ class CSVWriterBatch(WriterBatch):
         Consumer function that writes what it receives to a CSV File
         """
         while True:
-            http_res, db_res = await queue.get()
-            for http_data, db_data in zip(http_res, db_res):
-                row = (
-                    http_data['distance'], http_data['time'], db_data.amenity_id,
-                    db_data.residence_id, self.config.costing
-                )
+            rows = await queue.get()
+            if rows is None:
+                queue.task_done()
+                return
+            for row in rows:
                 await self._csv_writer.writerow(row)
+            self.report(len(rows))
             queue.task_done()
 
 
 class DBWriterBatch(WriterBatch):
     """
-    Saves the records inside of ValhallaReaderBatch to our database
+    Saves the records inside of ValhallaReaderBatch to our database.
+
+    Rows from many queue items are collected in a buffer which is written with a single `COPY`
+    once it holds `config.flush_size` rows or `config.flush_interval` seconds have passed. The
+    `COPY` runs in a thread on `cursor`, which is kept open for the whole run, so we can keep
+    buffering the next rows while the previous ones are being written.
     """
 
-    def __init__(self, config: BatchConfig):
+    def __init__(self, config: BatchConfig, cursor):
         self.config = config
+        self.cursor = cursor
+        self._buffer = []
+        self._flushing = None
 
     async def consume(self, queue: asyncio.Queue) -> None:
         """
         Writes records to PostgreSQL database
         """
+        loop = asyncio.get_running_loop()
+        flush_at = loop.time() + self.config.flush_interval
+
         while True:
-            http_res, db_res = await queue.get()
-            new_records = []
-            for http_data, db_data in zip(http_res, db_res):
-                row = (
-                    http_data['distance'], http_data['time'], db_data.amenity_id,
-                    db_data.residence_id, self.config.costing
-                )
-                logger.info(f'Record to be written: {row}')
-                new_records.append(row)
-
-            await self._insert_records(new_records)
-            queue.task_done()
+            try:
+                rows = await asyncio.wait_for(queue.get(), timeout=max(flush_at - loop.time(), 0))
+            except asyncio.TimeoutError:
+                rows = []
+            else:
+                queue.task_done()
+
+            if rows is None:
+                await self.flush()
+                await self._wait_for_flush()
+                return
+
+            self._buffer += rows
+
+            if len(self._buffer) >= self.config.flush_size or loop.time() >= flush_at:
+                await self.flush()
+                flush_at = loop.time() + self.config.flush_interval
+
+    async def flush(self) -> None:
+        """
+        Starts writing the buffered rows in a thread once the previous write has finished
+        """
+        await self._wait_for_flush()
+        if not self._buffer:
+            return
+
+        records, self._buffer = self._buffer, []
+        self._flushing = asyncio.get_running_loop().run_in_executor(None, self._insert_records, records)
+
+    async def _wait_for_flush(self) -> None:
+        if self._flushing is not None:
+            flushing, self._flushing = self._flushing, None
+            await flushing
 
-    @async_postgres_cursor_method
-    async def _insert_records(self, cur, new_records):
+    def _insert_records(self, new_records: list[tuple]) -> None:
         """
-        Attempt to insert data into database.
+        Insert data into database, overwriting records which are already present
         """
-        try:
-            await add_amenity_residence_distance_async(cur, new_records)
-            logger.info(f'Added {len(new_records)} new records')
-        except UniqueViolation as exc:
-            logger.error(f'{str(exc)}\n')
+        with self.config.metrics.flush_latency.time():
+            copy_amenity_residence_distance(self.cursor, new_records)
+            self.cursor.connection.commit()
+        self.report(len(new_records))
@@ -0,0 +1,253 @@
+from __future__ import annotations
+
+import asyncio
+import contextlib
+import dataclasses
+import os
+import random
+import resource
+import sys
+import tempfile
+import time
+from typing import Iterable, Iterator
+
+import aiofiles
+import click
+
+from altmo.api.fake_valhalla import FakeValhallaOptions, fake_valhalla_server
+from altmo.api.valhalla import ValhallaAsyncClient, ValhallaServer
+from altmo.batches import (
+    ValhallaReaderBatch,
+    DBWriterBatch,
+    StdOutWriterBatch,
+    CSVWriterBatch,
+    batch_manager,
+    BatchConfig
+)
+from altmo.data.decorators import psycopg_context
+from altmo.data.read import get_residence_amenity_straight_distance
+from altmo.data.types import Point, StraightDistanceRow
+from altmo.data.write import delete_amenity_residence_distance
+from altmo.planner import group_by_residence
+from altmo.settings import get_config, Config
+from altmo.validators import validate_study_area, validate_outs, OUT_DB, OUT_CSV, OUT_STDOUT
+
+# Network distances written to the database during a benchmark use this mode; they are removed afterwards
+BENCHMARK_MODE = "benchmark"
+
+# Synthetic residences and amenities are spread over a square of this many degrees
+SYNTHETIC_AREA_SIZE = 0.1
+
+# Number of amenities in the synthetic data for each amenity a residence needs a route to
+SYNTHETIC_AMENITY_RATIO = 10
+
+
+@dataclasses.dataclass
+class BenchmarkResult:
+    out: str
+    seconds: float = 0.0
+    pairs: int = 0
+    requests: int = 0
+    errors: int = 0
+    latencies: list[float] = dataclasses.field(default_factory=list)
+    # Peak resident set size in bytes of the whole process so far, not of this writer alone: writers run
+    # one after another in the same process and the stand-in server runs in it as well
+    peak_rss: int = 0
+
+    @property
+    def pairs_per_second(self) -> float:
+        return self.pairs / self.seconds if self.seconds else 0.0
+
+    @property
+    def requests_per_second(self) -> float:
+        return self.requests / self.seconds if self.seconds else 0.0
+
+    def get_latency_percentile(self, percentile: float) -> float:
+        """Returns the latency percentile (0-100) in milliseconds"""
+        if not self.latencies:
+            return 0.0
+        latencies = sorted(self.latencies)
+        idx = min(round(percentile / 100 * len(latencies)), len(latencies) - 1)
+        return latencies[idx] * 1000
+
+    def __str__(self):
+        return (
+            f'{self.out}: {self.pairs} pairs in {self.seconds:.2f}s, '
+            f'{self.pairs_per_second:.0f} pairs/s, {self.requests_per_second:.1f} requests/s '
+            f'({self.errors} failed), '
+            f'latency p50 {self.get_latency_percentile(50):.1f}ms p99 {self.get_latency_percentile(99):.1f}ms, '
+            f'process peak RSS so far {self.peak_rss / 1024 ** 2:.1f} MB'
+        )
+
+
+def get_peak_rss() -> int:
+    """
+    Returns the peak resident set size of this process in bytes; `ru_maxrss` is in bytes on macOS and
+    in kilobytes on Linux
+    """
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak_rss if sys.platform == 'darwin' else peak_rss * 1024
+
+
+class TimedValhallaClient(ValhallaAsyncClient):
+    """
+    ValhallaAsyncClient which records the latency of every request in `result`
+    """
+    def __init__(self, servers: list[ValhallaServer], result: BenchmarkResult):
+        super().__init__(servers)
+        self.result = result
+
+    async def source_to_targets(self, *args, **kwargs):
+        start = time.perf_counter()
+        self.result.requests += 1
+        try:
+            return await super().source_to_targets(*args, **kwargs)
+        except Exception:
+            self.result.errors += 1
+            raise
+        finally:
+            self.result.latencies.append(time.perf_counter() - start)
+
+
+def get_synthetic_rows(pairs: int, amenities_per_residence: int, seed: int = 1) -> Iterator[StraightDistanceRow]:
+    """
+    Generates residence amenity pairs ordered by residence, like the straight distance table would.
+
+    Amenities are laid out along the x axis of the area and every residence gets the
+    `amenities_per_residence` ones closest to it along this axis, so neighbouring residences share
+    most of their amenities just like they do in real data.
+    """
+    rand = random.Random(seed)
+    residences = max(pairs // amenities_per_residence, 1)
+    amenity_count = max(residences // SYNTHETIC_AMENITY_RATIO, amenities_per_residence)
+    amenities = sorted(
+        (rand.uniform(0, SYNTHETIC_AREA_SIZE), rand.uniform(0, SYNTHETIC_AREA_SIZE))
+        for _ in range(amenity_count)
+    )
+    lat, lng = 59.3, 18.0
+
+    for res_id in range(1, residences + 1):
+        x, y = rand.uniform(0, SYNTHETIC_AREA_SIZE), rand.uniform(0, SYNTHETIC_AREA_SIZE)
+        first = min(int(x / SYNTHETIC_AREA_SIZE * amenity_count), amenity_count - amenities_per_residence)
+
+        for amenity_id in range(first, first + amenities_per_residence):
+            amenity_x, amenity_y = amenities[amenity_id]
+            yield StraightDistanceRow(
+                res_id, amenity_id + 1, lat + y, lng + x, lat + amenity_y, lng + amenity_x
+            )
+
+
+async def run_benchmark(
+    url: str, out: str, groups: Iterable[tuple[Point, list[Point]]], batch_config: BatchConfig, config: Config
+) -> BenchmarkResult:
+    """
+    Sends `groups` through `ValhallaReaderBatch` to the writer for `out` and measures how long it takes
+    """
+    result = BenchmarkResult(out=out)
+
+    def on_progress(count: int) -> None:
+        result.pairs += count
+
+    batch_config = dataclasses.replace(batch_config, out=out, on_progress=on_progress)
+    server = ValhallaServer(url, connection_limit=config.VALHALLA_CONNECTION_LIMIT)
+    reader_batch = ValhallaReaderBatch(groups, TimedValhallaClient([server], result), batch_config)
+
+    start = time.perf_counter()
+
+    try:
+        if out == OUT_DB:
+            with psycopg_context(config.PG_DSN) as cursor:
+                write_batch = DBWriterBatch(batch_config, cursor)
+                try:
+                    await batch_manager(reader_batch, write_batch, queue_size=batch_config.queue_size)()
+                    result.seconds = time.perf_counter() - start
+                finally:
+                    delete_amenity_residence_distance(cursor, BENCHMARK_MODE)
+
+        elif out == OUT_CSV:
+            with tempfile.TemporaryDirectory() as tmp_dir:
+                async with aiofiles.open(os.path.join(tmp_dir, batch_config.file_name), 'w') as fp:
+                    write_batch = CSVWriterBatch(fp, batch_config)
+                    await batch_manager(reader_batch, write_batch, queue_size=batch_config.queue_size)()
+                result.seconds = time.perf_counter() - start
+
+        else:
+            # We want to measure formatting the rows, not how fast a terminal can scroll
+            with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+                write_batch = StdOutWriterBatch(batch_config)
+                await batch_manager(reader_batch, write_batch, queue_size=batch_config.queue_size)()
+            result.seconds = time.perf_counter() - start
+    finally:
+        await server.close()
+
+    result.peak_rss = get_peak_rss()
+
+    return result
+
+
+@click.command("benchmark")
+@click.option("-o", "--out", type=click.UNPROCESSED, multiple=True, default=(OUT_STDOUT, OUT_CSV),
+              callback=validate_outs)
+@click.option("-p", "--pairs", type=click.IntRange(min=1), default=100_000)
+@click.option("-a", "--amenities-per-residence", type=click.IntRange(min=1), default=10)
+@click.option("-C", "--concurrency", type=click.IntRange(min=1), default=10)
+@click.option("--latency", type=click.FloatRange(min=0), default=50.0)
+@click.option("--error-rate", type=click.FloatRange(min=0, max=1), default=0.0)
+@click.option("--server-matrix-limit", type=click.IntRange(min=1))
+@click.option("--study-area", type=click.UNPROCESSED)
+@get_config
+def benchmark(
+    config, out, pairs, amenities_per_residence, concurrency, latency, error_rate, server_matrix_limit, study_area
+):
+    """
+    Measure the throughput of the network distance pipeline against a local stand-in for Valhalla.
+
+    The stand-in server answers `sources_to_targets` requests with straight line distances after
+    `--latency` milliseconds on average (default value is `50`). Use `--error-rate` to make a share
+    of the requests fail and `--server-matrix-limit` to reject matrices larger than this number of
+    cells (default value is `VALHALLA_MATRIX_LIMIT`).
+
+    `--pairs|-p` synthetic residence amenity pairs (default value is `100000`) are routed with
+    `--concurrency|-C` requests at the same time and written with each `--out|-o` writer (default
+    values are "stdout" and "csv"). Output to stdout is discarded and csv files are written to a
+    temporary directory.
+
+    The memory reported is the peak of the whole process up to the end of each writer's run, so it only
+    grows from one writer to the next; benchmark writers one at a time to compare their memory usage.
+
+    Writing to the database needs real residences and amenities, so `--out=db` reads its pairs from
+    the straight distances of `--study-area` instead. These network distances are saved with the
+    mode "benchmark" and removed once the benchmark is done.
+    """
+    if OUT_DB in out and not study_area:
+        raise click.BadParameter('"--study-area" is required with "--out=db"', param_hint='--out')
+
+    options = FakeValhallaOptions(
+        latency=latency / 1000,
+        error_rate=error_rate,
+        matrix_limit=server_matrix_limit or config.VALHALLA_MATRIX_LIMIT
+    )
+    batch_config = BatchConfig(
+        costings=[BENCHMARK_MODE],
+        out=OUT_STDOUT,
+        file_name='benchmark.csv',
+        matrix_limit=config.VALHALLA_MATRIX_LIMIT,
+        concurrency=concurrency,
+        queue_size=concurrency * 10,
+        backoff=0.01,
+        # Requests which keep failing are counted, not kept
+        dead_letter_file=os.devnull
+    )
+
+    study_area_id = validate_study_area(None, None, study_area) if study_area else None
+
+    with fake_valhalla_server(options) as url:
+        for out_ in out:
+            if out_ == OUT_DB:
+                with psycopg_context(config.PG_DSN) as cursor:
+                    rows = get_residence_amenity_straight_distance(cursor, study_area_id, limit=pairs)
+            else:
+                rows = get_synthetic_rows(pairs, amenities_per_residence)
+
+            result = asyncio.run(run_benchmark(url, out_, group_by_residence(rows), batch_config, config))
+            click.echo(str(result))
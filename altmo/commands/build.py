@@ -1,41 +1,129 @@
+from concurrent.futures import ThreadPoolExecutor
+
 import click
 
 from altmo.settings import get_config
+from altmo.data.decorators import psycopg_context
 from altmo.data.write import (
     add_amenities,
     delete_amenities,
     add_amenities_category,
     add_residences,
+    add_residence_sample_keys,
     delete_residences,
     add_natural_amenities,
+    create_staging_tables,
+    index_staging_table,
+    swap_staging_tables,
+    vacuum_tables,
+    RESIDENCE_STRATEGY_JOIN,
+    RESIDENCE_STRATEGY_UNION,
 )
 from altmo.data.read import get_study_area
-from altmo.data.schema import psycopg2_cur
+from altmo.data.schema import psycopg2_cur, update_schema
 from altmo.utils import get_amenities_from_config, get_amenity_category_map
 
 
-@click.command()
-@click.argument("study_area", type=str)
-@psycopg2_cur()
 @get_config
-def build(config, cursor, study_area):
-    """Builds a database of amenities and residences from OSM data"""
-    study_area_id, *_ = get_study_area(cursor, study_area)
+def build_study_area(
+    config, study_area_id: int, staged: bool = False, residence_strategy: str = RESIDENCE_STRATEGY_UNION,
+    subdivide: int = None
+) -> None:
+    """
+    Adds the amenities and residences of a single study area on its own connection.
+
+    When `staged` is set they are built in staging tables first and swapped in at the end, see
+    `altmo.data.write.swap_staging_tables`. `residence_strategy` and `subdivide` are passed on to
+    `altmo.data.write.add_residences`.
+    """
     amenities = get_amenities_from_config(config.AMENITIES)
     amenity_category_map = get_amenity_category_map(config.AMENITIES)
     nature_amenities = tuple(config.AMENITIES.get('categories', {}).get('nature', {}).keys())
 
-    if study_area_id:
-        # Add amenity data
-        delete_amenities(cursor, study_area_id)
-        add_amenities(cursor, study_area_id, amenities)
-        add_amenities_category(cursor, study_area_id, amenity_category_map)
-        if nature_amenities:
-            add_natural_amenities(cursor, study_area_id, nature_amenities)
+    with psycopg_context(config.PG_DSN) as cursor:
+        try:
+            if staged:
+                amenities_table, residences_table = create_staging_tables(cursor, study_area_id)
+            else:
+                amenities_table, residences_table = None, None
+                delete_amenities(cursor, study_area_id)
+                delete_residences(cursor, study_area_id)
+
+            # Add amenity data
+            add_amenities(cursor, study_area_id, amenities, table=amenities_table)
+            if staged:
+                index_staging_table(cursor, amenities_table)
+            add_amenities_category(cursor, study_area_id, amenity_category_map, table=amenities_table)
+            if nature_amenities:
+                add_natural_amenities(cursor, study_area_id, nature_amenities, table=amenities_table)
+
+            # Add residence data
+            add_residences(
+                cursor, study_area_id, table=residences_table, strategy=residence_strategy, max_vertices=subdivide
+            )
+            if staged:
+                index_staging_table(cursor, residences_table)
+            add_residence_sample_keys(cursor, study_area_id, table=residences_table)
+
+            if staged:
+                swap_staging_tables(cursor, study_area_id, amenities_table, residences_table)
+        except BaseException:
+            # `psycopg_context` commits when it is done; roll back first so that a failed build neither
+            # leaves half a study area nor its staging tables behind
+            cursor.connection.rollback()
+            raise
+
+
+@click.command()
+@click.argument("study_area", type=str, nargs=-1, required=True)
+@click.option("-p", "--parallel", type=click.IntRange(min=1), default=1)
+@click.option("--staged", type=bool, is_flag=True)
+@click.option(
+    "--residence-strategy",
+    type=click.Choice((RESIDENCE_STRATEGY_UNION, RESIDENCE_STRATEGY_JOIN)),
+    default=RESIDENCE_STRATEGY_UNION
+)
+@click.option("--subdivide", type=click.IntRange(min=5), default=None)
+@psycopg2_cur()
+def build(cursor, study_area, parallel, staged, residence_strategy, subdivide):
+    """
+    Builds a database of amenities and residences from OSM data
+
+    Several study areas can be built at once, e.g. `altmo build berlin hamburg`. Use `--parallel|-p` to
+    build up to this many of them at the same time, each on its own connection (default value is `1`).
+
+    Use `--staged` to rebuild study areas without getting in the way of other commands: each study area
+    is built in UNLOGGED staging tables and swapped in with a single transaction, removing the distances
+    calculated for its old amenities and residences. The amenities and residences tables are vacuumed
+    afterwards.
+
+    Residences are the buildings within the union of all residential areas by default. For large study
+    areas use `--residence-strategy join`, which looks up the centroid of each building in an index of the
+    residential areas instead. `--subdivide` splits these areas into pieces of at most this many vertices
+    first, which makes each lookup cheaper.
+    """
+    study_area_ids = []
+    for name in study_area:
+        study_area_id, *_ = get_study_area(cursor, name)
+        if study_area_id:
+            study_area_ids.append(study_area_id)
+        else:
+            click.echo("study area not found")
+
+    if not study_area_ids:
+        return
+
+    update_schema(cursor)
+    # The schema changes lock the tables we are about to fill on other connections
+    cursor.connection.commit()
 
-        # Add residence data
-        delete_residences(cursor, study_area_id)
-        add_residences(cursor, study_area_id)
+    with ThreadPoolExecutor(max_workers=parallel) as pool:
+        futures = [
+            pool.submit(build_study_area, study_area_id, staged, residence_strategy, subdivide)
+            for study_area_id in study_area_ids
+        ]
+        for future in futures:
+            future.result()
 
-    else:
-        click.echo("study area not found")
+    if staged:
+        vacuum_tables(cursor)
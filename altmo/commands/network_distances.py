@@ -1,10 +1,22 @@
+from __future__ import annotations
+
 import asyncio
+import dataclasses
 import logging
+import multiprocessing
+import os
+import queue
+import shutil
+import sys
+from concurrent.futures import ProcessPoolExecutor
+from typing import AsyncIterable, Iterable, List, Optional, Tuple, Union
 
 import aiofiles
 import click
 from psycopg2.extensions import cursor as psycopg2_cursor
+from tqdm import tqdm
 
+from altmo.api.cache import RouteCache, CacheStats, DEFAULT_CACHE_SIZE
 from altmo.api.valhalla import async_http_client, ValhallaAsyncClient
 from altmo.batches import (
     ValhallaReaderBatch,
@@ -12,16 +24,31 @@ from altmo.batches import (
     StdOutWriterBatch,
     CSVWriterBatch,
     batch_manager,
-    BatchConfig
+    BatchConfig,
+    DeadLetterFile
 )
-from altmo.data.decorators import psycopg2_cur
-from altmo.data.result_sets import StraightDistanceResultSetContainer
-from altmo.settings import MODE_PEDESTRIAN
+from altmo.data.decorators import psycopg2_cur, psycopg_context, async_postgres_pool
+from altmo.data.read import get_residence_amenity_straight_distance_estimate, has_residences_without_sample_key
+from altmo.data.result_sets import AsyncStraightDistanceResultSet
+from altmo.data.types import Point
+from altmo.metrics import MetricsReporter
+from altmo.planner import group_by_residence
+from altmo.settings import MODE_PEDESTRIAN, get_config, Config
+from altmo.utils import as_async_iterator
 from altmo.validators import (
-    validate_study_area, validate_mode, validate_out,
+    validate_study_area, validate_modes, validate_out,
     OUT_DB, OUT_CSV, OUT_STDOUT
 )
 
+# Number of residence amenity pairs in each result set (and CSV file)
+RESULT_SET_PAGE_SIZE = 500_000
+
+# Default number of residence amenity pairs fetched from the database at a time
+RESULT_SET_FETCH_SIZE = 10_000
+
+# Residences grouped with their amenities, see `altmo.planner.group_by_residence`
+GroupsIterable = Union[Iterable[Tuple[Point, List[Point]]], AsyncIterable[Tuple[Point, List[Point]]]]
+
 BATCH_WRITERS_CLS = {
     OUT_DB: DBWriterBatch,
     OUT_CSV: CSVWriterBatch,
@@ -32,52 +59,219 @@ BATCH_WRITERS_CLS = {
 @async_http_client
 async def run(
     client: ValhallaAsyncClient,
-    result_set: StraightDistanceResultSetContainer,
+    result_sets: Union[Iterable[GroupsIterable], AsyncIterable[GroupsIterable]],
     config: BatchConfig
 ):
-    for data in result_set.result_sets:
-        reader_batch = ValhallaReaderBatch(data, client, config)
+    async for groups in as_async_iterator(result_sets):
+        reader_batch = ValhallaReaderBatch(groups, client, config)
         write_batch = BATCH_WRITERS_CLS[config.out](config)
 
-        run_tasks = batch_manager(reader_batch, write_batch)
+        run_tasks = batch_manager(reader_batch, write_batch, queue_size=config.queue_size)
         await run_tasks()
 
 
 @async_http_client
 async def run_with_file(
     client: ValhallaAsyncClient,
-    result_set: StraightDistanceResultSetContainer,
+    result_sets: Union[Iterable[GroupsIterable], AsyncIterable[GroupsIterable]],
     config: BatchConfig
 ):
-    for idx, data in enumerate(result_set.result_sets, start=1):
+    idx = 0
+    async for groups in as_async_iterator(result_sets):
+        idx += 1
         file_name = f'{idx}-{config.file_name}'
-        reader_batch = ValhallaReaderBatch(data, client, config)
+        reader_batch = ValhallaReaderBatch(groups, client, config)
 
         async with aiofiles.open(file_name, 'w') as fp:
             write_batch = BATCH_WRITERS_CLS[config.out](fp, config)
 
-            run_tasks = batch_manager(reader_batch, write_batch)
+            run_tasks = batch_manager(reader_batch, write_batch, queue_size=config.queue_size)
+            await run_tasks()
+
+
+@async_http_client
+@get_config
+async def run_with_db(
+    config: Config,
+    client: ValhallaAsyncClient,
+    result_sets: Union[Iterable[GroupsIterable], AsyncIterable[GroupsIterable]],
+    batch_config: BatchConfig
+):
+    with psycopg_context(config.PG_DSN) as cursor:
+        async for groups in as_async_iterator(result_sets):
+            reader_batch = ValhallaReaderBatch(groups, client, batch_config)
+            write_batch = DBWriterBatch(batch_config, cursor)
+
+            run_tasks = batch_manager(reader_batch, write_batch, queue_size=batch_config.queue_size)
             await run_tasks()
 
 
 BATCH_WRITERS_FUNCS = {
-    OUT_DB: run,
+    OUT_DB: run_with_db,
     OUT_STDOUT: run,
     OUT_CSV: run_with_file
 }
 
 
+async def run_with_metrics(
+    result_sets: Union[Iterable[GroupsIterable], AsyncIterable[GroupsIterable]],
+    batch_config: BatchConfig
+) -> None:
+    """
+    Runs the writer function for `batch_config.out` while reporting its metrics
+    """
+    reporter = MetricsReporter(
+        batch_config.metrics,
+        file_name=batch_config.metrics_file,
+        progress=batch_config.progress,
+        labels=batch_config.metrics_labels
+    )
+    async with reporter:
+        await BATCH_WRITERS_FUNCS[batch_config.out](result_sets, batch_config)
+
+
+@async_postgres_pool
+async def route_study_area(pool, study_area_id: int, query_kwargs: dict, batch_config: BatchConfig) -> None:
+    """
+    Reads the residence amenity pairs on an aiopg pool while they are being routed
+    """
+    result_set = AsyncStraightDistanceResultSet(
+        pool,
+        study_area_id=study_area_id,
+        page_size=batch_config.fetch_size,
+        batch_size=RESULT_SET_PAGE_SIZE,
+        query_kwargs=query_kwargs
+    )
+    await run_with_metrics(result_set.result_sets, batch_config)
+
+
+def run_network(
+    study_area_id: int,
+    query_kwargs: dict,
+    batch_config: BatchConfig,
+    cache_file: str = None,
+    cache_size: int = DEFAULT_CACHE_SIZE
+) -> Optional[CacheStats]:
+    """
+    Routes every residence amenity pair matching `query_kwargs` and returns the route cache statistics
+    """
+    cache = RouteCache(cache_file, max_size=cache_size) if cache_file else None
+    batch_config = dataclasses.replace(batch_config, cache=cache)
+
+    try:
+        asyncio.run(route_study_area(study_area_id, query_kwargs, batch_config))
+    finally:
+        if cache is not None:
+            cache.close()
+
+    return cache.stats if cache is not None else None
+
+
+# Set in each worker process by `_init_worker`
+_PROGRESS_QUEUE: Optional[multiprocessing.Queue] = None
+
+
+def _init_worker(progress_queue: multiprocessing.Queue) -> None:
+    global _PROGRESS_QUEUE
+    _PROGRESS_QUEUE = progress_queue
+
+
+def _get_worker_file_name(file_name: Optional[str], shard: int) -> Optional[str]:
+    """
+    Puts the worker number in front of the base name of `file_name`, e.g. "metrics/worker1-altmo.prom"
+    """
+    if file_name is None:
+        return None
+    directory, base_name = os.path.split(file_name)
+    return os.path.join(directory, f'worker{shard + 1}-{base_name}')
+
+
+def network_worker(shard: int, workers: int, *args, **kwargs) -> Optional[CacheStats]:
+    """
+    Runs `run_network` in a worker process for the residences where `residence_id % workers == shard`
+    """
+    study_area_id, query_kwargs, batch_config, *rest = args
+    query_kwargs = {**query_kwargs, 'shard': (shard, workers)}
+    batch_config = dataclasses.replace(
+        batch_config,
+        file_name=f'worker{shard + 1}-{batch_config.file_name}',
+        dead_letter_file=_get_worker_file_name(batch_config.dead_letter_file, shard),
+        on_progress=_PROGRESS_QUEUE.put,
+        metrics_file=_get_worker_file_name(batch_config.metrics_file, shard),
+        metrics_labels={**(batch_config.metrics_labels or {}), 'worker': str(shard + 1)},
+        # The parent shows the combined progress as a bar instead, so `--progress` is ignored here
+        progress=False
+    )
+    return run_network(study_area_id, query_kwargs, batch_config, *rest, **kwargs)
+
+
+def run_network_workers(workers: int, total: int, *args, **kwargs) -> Optional[CacheStats]:
+    """
+    Splits the residences over `workers` processes, each with its own event loop, HTTP pool and
+    writer. The parent shows the combined progress and fails if any of the workers failed.
+
+    `total` is only used for the progress bar, so an estimate is good enough.
+    """
+    progress_queue = multiprocessing.Queue()
+    stats = None
+    errors = []
+
+    with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker, initargs=(progress_queue,)) as pool:
+        futures = [pool.submit(network_worker, shard, workers, *args, **kwargs) for shard in range(workers)]
+
+        with tqdm(total=total, unit="pair", file=sys.stderr) as progress:
+            while not all(future.done() for future in futures):
+                try:
+                    progress.update(progress_queue.get(timeout=0.5))
+                except queue.Empty:
+                    pass
+
+            while not progress_queue.empty():
+                progress.update(progress_queue.get())
+
+    for shard, future in enumerate(futures, start=1):
+        try:
+            worker_stats = future.result()
+        except Exception as exc:
+            errors.append(f'Worker {shard} failed: {exc!r}')
+            continue
+        if worker_stats is not None:
+            stats = worker_stats if stats is None else stats + worker_stats
+
+    if errors:
+        raise click.ClickException('\n'.join(errors))
+
+    return stats
+
+
 @click.command("network")
 @click.argument("study_area", type=click.UNPROCESSED, callback=validate_study_area)
-@click.option("-m", "--mode", type=click.UNPROCESSED, default=MODE_PEDESTRIAN, callback=validate_mode)
+@click.option("-m", "--mode", type=click.UNPROCESSED, default=MODE_PEDESTRIAN, callback=validate_modes)
 @click.option("-c", "--category", type=str)
 @click.option("-n", "--name", type=str)
 @click.option("-o", "--out", type=click.UNPROCESSED, default=OUT_DB, callback=validate_out)
 @click.option("-f", "--file-name", type=str, default="out.csv")
-@click.option("-s", "--sample", type=int, default=None)
+@click.option("-s", "--sample", type=click.IntRange(min=1), default=None)
+@click.option("-C", "--concurrency", type=click.IntRange(min=1), default=10)
+@click.option("-w", "--workers", type=click.IntRange(min=1), default=1)
+@click.option("-r", "--retries", type=click.IntRange(min=0), default=3)
+@click.option("--fetch-size", type=click.IntRange(min=1), default=RESULT_SET_FETCH_SIZE)
+@click.option("-d", "--dead-letter-file", type=str, default="failed.jsonl")
+@click.option("--replay-failed", type=bool, is_flag=True)
+@click.option("--resume", type=bool, is_flag=True)
+@click.option("--cache-file", type=click.Path(dir_okay=False))
+@click.option("--cache-size", type=click.IntRange(min=1), default=DEFAULT_CACHE_SIZE)
+@click.option("--cache-stats", type=bool, is_flag=True)
+@click.option("--metrics-file", type=click.Path(dir_okay=False))
+@click.option("--progress", type=bool, is_flag=True)
 @click.option("-v", "--verbose", type=bool, is_flag=True)
 @psycopg2_cur()
-def network_distances(cur: psycopg2_cursor, study_area, mode, category, name, out, file_name, sample, verbose):
+@get_config
+def network_distances(
+    config, cur: psycopg2_cursor, study_area, mode, category, name, out, file_name, sample, concurrency,
+    workers, retries, fetch_size, dead_letter_file, replay_failed, resume, cache_file, cache_size, cache_stats,
+    metrics_file, progress, verbose
+):
     """
     Calculate network distances between residences and amenities.
 
@@ -87,22 +281,124 @@ def network_distances(cur: psycopg2_cursor, study_area, mode, category, name, ou
     This means csv files will be written with a number prefix like, "1-out.csv", "2-out.csv", etc.
 
     Default value for `--out` is `db` which writes to the configured database.
+
+    Use `--sample|-s` for a quick preview: it only routes about one in every `--sample` residences,
+    spread evenly over the study area (run `altmo build` first to compute the sample).
+
+    Use `--concurrency|-C` to set the number of requests sent to Valhalla at the same time (default value
+    is `10`).
+
+    Use `--workers|-w` to split the residences over several processes (default value is `1`). Each
+    process sends up to `--concurrency` requests at the same time. With --out=csv each process writes
+    its own files, e.g. "1-worker1-out.csv", "1-worker2-out.csv", etc. Failed requests are saved in a
+    dead letter file per process as well, e.g. "worker1-failed.jsonl"; replay them one at a time with
+    `--replay-failed --dead-letter-file worker1-failed.jsonl` (`--workers` cannot be used when replaying).
+
+    Use `--fetch-size` to set the number of residence amenity pairs read from the database at a time (default
+    value is `10,000`). Larger pages mean fewer queries but more memory for the pages read ahead.
+
+    Failed requests are retried `--retries|-r` times (default value is `3`) before they are written to
+    `--dead-letter-file|-d` (default value is "failed.jsonl"). Run again with `--replay-failed` to retry
+    only the requests saved in this file. With --out=csv, the files written by a replay start with the
+    mode, e.g. "1-pedestrian-out.csv".
+
+    Use `--mode|-m` to route with several costing models in one pass, e.g. "pedestrian,bicycle". The
+    residence amenity pairs are only read once and every row is written with its own mode.
+
+    Use `--resume` to skip residence amenity pairs which already have a network distance for every `--mode`.
+    This lets you pick up an interrupted run where it stopped.
+
+    Use `--cache-file` to keep the routes we calculate in a local SQLite database so that later runs
+    only send pairs to Valhalla which are not in it yet. `--cache-size` limits the number of routes kept
+    in this file and `--cache-stats` prints the hit rate once the run is finished.
+
+    Use `--metrics-file` to write requests in flight, queue depths, pairs per second, Valhalla and
+    database latencies and errors by type to a file every second. It is a Prometheus textfile unless the
+    name ends with ".json". With `--workers` each process writes its own file, e.g. "worker1-altmo.prom".
+    Use `--progress` to show the same numbers on a single line while the run is going. `--progress` is
+    ignored with `--workers`: the progress lines of several processes would overwrite each other, so a
+    progress bar of the pairs written by all workers is shown instead. Use `--metrics-file` for the details.
     """
     if verbose:
         logging.basicConfig(level=logging.INFO)
 
-    result_set = StraightDistanceResultSetContainer(
-        cur,
-        study_area_id=study_area,
-        batch_size=10_000_000,
-        query_kwargs={'category': category, 'name': name, 'sample': sample}
-    )
-
-    config = BatchConfig(
-        costing=mode,
+    batch_config = BatchConfig(
+        costings=mode,
         out=out,
-        file_name=file_name
+        file_name=file_name,
+        matrix_limit=config.VALHALLA_MATRIX_LIMIT,
+        concurrency=concurrency,
+        queue_size=concurrency * 10,
+        retries=retries,
+        fetch_size=fetch_size,
+        dead_letter_file=dead_letter_file,
+        metrics_file=metrics_file,
+        progress=progress
     )
+    query_kwargs = {
+        'category': category, 'name': name, 'sample': sample, 'missing_modes': mode if resume else None
+    }
+
+    if replay_failed and workers > 1:
+        raise click.BadOptionUsage(
+            'workers', '--workers cannot be used with --replay-failed; replay the file of each worker on its own'
+        )
+
+    if sample is not None and not replay_failed and has_residences_without_sample_key(cur, study_area):
+        raise click.ClickException(
+            'Some residences of this study area have no sample key yet; run "altmo build" again to use --sample'
+        )
+
+    if replay_failed:
+        stats = replay(batch_config, cache_file, cache_size)
+    elif workers > 1:
+        total = get_residence_amenity_straight_distance_estimate(cur, study_area, **query_kwargs)
+        stats = run_network_workers(workers, total, study_area, query_kwargs, batch_config, cache_file, cache_size)
+    else:
+        stats = run_network(study_area, query_kwargs, batch_config, cache_file, cache_size)
+
+    if stats is not None and cache_stats:
+        click.echo(str(stats), err=True)
+
+
+def replay(
+    batch_config: BatchConfig, cache_file: str = None, cache_size: int = DEFAULT_CACHE_SIZE
+) -> Optional[CacheStats]:
+    """
+    Runs the requests stored in the dead letter file again.
+
+    The file is moved out of the way first, so requests failing again end up in a fresh dead letter file.
+    A replay which did not finish leaves this moved file behind; its requests are replayed again along
+    with those which failed since.
+
+    Each costing is replayed on its own, so with --out=csv its name is put in front of the file names,
+    e.g. "1-pedestrian-out.csv".
+    """
+    replay_file = f'{batch_config.dead_letter_file}.replay'
+
+    if os.path.exists(batch_config.dead_letter_file):
+        if os.path.exists(replay_file):
+            with open(batch_config.dead_letter_file) as fp, open(replay_file, 'a') as replay_fp:
+                shutil.copyfileobj(fp, replay_fp)
+            os.unlink(batch_config.dead_letter_file)
+        else:
+            os.replace(batch_config.dead_letter_file, replay_file)
+    elif not os.path.exists(replay_file):
+        click.echo(f'{batch_config.dead_letter_file} not found; nothing to replay')
+        return
+
+    cache = RouteCache(cache_file, max_size=cache_size) if cache_file else None
+
+    try:
+        for costing, rows in DeadLetterFile(replay_file).read().items():
+            config = dataclasses.replace(
+                batch_config, costings=[costing], cache=cache, file_name=f'{costing}-{batch_config.file_name}'
+            )
+            asyncio.run(run_with_metrics([group_by_residence(rows)], config))
+    finally:
+        if cache is not None:
+            cache.close()
+
+    os.unlink(replay_file)
 
-    main_runner = BATCH_WRITERS_FUNCS[config.out]
-    asyncio.run(main_runner(result_set, config))
+    return cache.stats if cache is not None else None
@@ -1,12 +1,156 @@
+from __future__ import annotations
+
 import asyncio
 import sys
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from typing import Optional
 
 import click
+from tqdm import tqdm
 from tqdm.asyncio import tqdm_asyncio
 
-from altmo.data.decorators import psycopg2_cur
-from altmo.data.read import get_study_area, get_amenity_name_category
-from altmo.data.write import add_amenity_residence_distances_straight_async
+from altmo.data.decorators import psycopg2_cur, async_postgres_pool
+from altmo.data.read import (
+    get_study_area,
+    get_amenity_name_category,
+    get_study_area_amenity_points,
+    get_study_area_residence_points,
+    get_study_area_residence_ranges
+)
+from altmo.data.write import (
+    add_amenity_residence_distances_straight_async,
+    copy_amenity_residence_distances_straight,
+    copy_amenity_residence_unreachable,
+    delete_amenity_residence_unreachable,
+    STRAIGHT_DISTANCE_SQL,
+    STRAIGHT_STRATEGY_KNN
+)
+from altmo.settings import get_config
+from altmo.utils import get_amenity_max_distances
+
+# Where the nearest amenities are calculated
+ENGINE_DATABASE = 'database'
+ENGINE_LOCAL = 'local'
+
+# Number of nearest amenities we keep for each residence
+NEAREST_AMENITY_COUNT = 3
+
+
+# Number of residence ranges per `--parallel` connection each amenity type is split into. Having more
+# work units than connections keeps all of them busy until the end, even when one amenity type is
+# much larger than the others.
+RESIDENCE_RANGES_PER_CONNECTION = 4
+
+
+@async_postgres_pool
+async def run_database(
+    pool, study_area_id: int, amenities: list[tuple], residence_ranges: list[tuple], strategy: str,
+    max_distances: dict[str, float], show_status: bool, parallel: int
+):
+    """
+    Runs one query per (amenity type, residence range), `parallel` of them at the same time on a single pool
+    """
+    # This limits the number of running queries, defaults to `1`
+    sem = asyncio.Semaphore(parallel)
+
+    async def task(amty, cat, residence_range):
+        async with sem:
+            async with pool.acquire() as conn:
+                async with conn.cursor() as cursor:
+                    await add_amenity_residence_distances_straight_async(
+                        cursor, study_area_id, amty, cat, strategy=strategy, residence_range=residence_range,
+                        max_distance=max_distances.get(cat)
+                    )
+
+    tasks = tuple(
+        task(amty, cat, residence_range)
+        for amty, cat in amenities
+        for residence_range in residence_ranges
+    )
+
+    if show_status:
+        await tqdm_asyncio.gather(*tasks, unit="query")
+    else:
+        await asyncio.gather(*tasks)
+
+
+# Residence ids and coordinates; set in each worker process by `_init_local_worker`
+_RESIDENCES: Optional[tuple] = None
+
+
+def _init_local_worker(residence_ids, residence_xy) -> None:
+    global _RESIDENCES
+    _RESIDENCES = residence_ids, residence_xy
+
+
+def local_worker(amenity_ids, amenity_xy, max_distance: float = None) -> tuple[list[tuple], list[int]]:
+    """
+    Finds the nearest amenities of one type for every residence.
+
+    :returns: the (residence_id, amenity_id, distance) rows and the ids of the residences without any
+              amenity within `max_distance`
+    """
+    from altmo.nearest import get_nearest_amenities
+
+    residence_ids, residence_xy = _RESIDENCES
+    rows = get_nearest_amenities(
+        residence_ids, residence_xy, amenity_ids, amenity_xy, k=NEAREST_AMENITY_COUNT, max_distance=max_distance
+    )
+    if max_distance is None:
+        return rows, []
+
+    reachable = {residence_id for residence_id, *_ in rows}
+    return rows, [residence_id for residence_id in residence_ids.tolist() if residence_id not in reachable]
+
+
+def run_local(
+    cursor, study_area_id: int, category: str, name: str, max_distances: dict[str, float], show_status: bool,
+    parallel: int
+):
+    """
+    Reads all residences and amenities once and finds the nearest ones with NumPy, one amenity type
+    per process. The results are written back with `COPY` as each amenity type is finished.
+    """
+    try:
+        import numpy as np
+    except ImportError:
+        raise click.ClickException('--engine local needs NumPy; install it with "pip install altmo[local]"')
+
+    residences = get_study_area_residence_points(cursor, study_area_id)
+    residence_ids = np.array([residence[0] for residence in residences], dtype=np.int64)
+    residence_xy = np.array([residence[1:] for residence in residences], dtype=np.float64).reshape(-1, 2)
+
+    amenity_types = defaultdict(list)
+    for amenity_id, amenity_name, amenity_category, x, y in get_study_area_amenity_points(
+        cursor, study_area_id, category=category, name=name
+    ):
+        amenity_types[(amenity_name, amenity_category)].append((amenity_id, x, y))
+
+    with ProcessPoolExecutor(
+        max_workers=parallel, initializer=_init_local_worker, initargs=(residence_ids, residence_xy)
+    ) as pool:
+        futures = {
+            pool.submit(
+                local_worker,
+                np.array([amenity[0] for amenity in points], dtype=np.int64),
+                np.array([amenity[1:] for amenity in points], dtype=np.float64),
+                max_distances.get(amenity_category)
+            ): (amenity_name, amenity_category)
+            for (amenity_name, amenity_category), points in amenity_types.items()
+        }
+
+        for future in tqdm(as_completed(futures), total=len(futures), unit="amenity", disable=not show_status):
+            rows, unreachable = future.result()
+            amenity_name, amenity_category = futures[future]
+            copy_amenity_residence_distances_straight(cursor, rows)
+            if amenity_category in max_distances:
+                delete_amenity_residence_unreachable(cursor, study_area_id, amenity_name, amenity_category)
+            if unreachable:
+                copy_amenity_residence_unreachable(cursor, [
+                    (residence_id, amenity_category, amenity_name, max_distances[amenity_category])
+                    for residence_id in unreachable
+                ])
 
 
 @click.command("straight")
@@ -14,14 +158,30 @@ from altmo.data.write import add_amenity_residence_distances_straight_async
 @click.option("-c", "--category", type=str)
 @click.option("-n", "--name", type=str)
 @click.option("-s", "--show-status", is_flag=True)
-@click.option("-p", "--parallel", type=int, default=1)
+@click.option("-p", "--parallel", type=click.IntRange(min=1), default=1)
+@click.option("--strategy", type=click.Choice(tuple(STRAIGHT_DISTANCE_SQL)), default=STRAIGHT_STRATEGY_KNN)
+@click.option("--engine", type=click.Choice((ENGINE_DATABASE, ENGINE_LOCAL)), default=ENGINE_DATABASE)
 @psycopg2_cur()
-def straight_distance(cursor, study_area, category, name, show_status, parallel):
+@get_config
+def straight_distance(config, cursor, study_area, category, name, show_status, parallel, strategy, engine):
     """
     Calculates the straight line distance from a residence to the nearest amenity.
 
     Use `--parallel|-p` to increase the number of concurrent queries being run against
-    the database (default value is `1`).
+    the database (default value is `1`). Each amenity type is split into several ranges of
+    residences, so even a single large amenity type keeps every connection busy.
+
+    Use `--strategy` to choose how the three nearest amenities are found: "knn" (default) looks them up
+    per residence through the spatial index, "rank" ranks every residence amenity pair. Run
+    `altmo build` first on databases created before the spatial indexes were added.
+
+    Use `--engine local` to read the residences and amenities once and find the nearest amenities with
+    NumPy instead (`pip install altmo[local]`). `--parallel` then sets the number of processes, each
+    working on one amenity type at a time.
+
+    Set `max_distance` for a category in the `AMENITIES` section of the config file to ignore amenities
+    of that category further away than this from a residence. Residences without any amenity of a type
+    within this distance are stored in the unreachable table instead.
 
     Cancelling this command (e.g. with Ctrl-C) will not cancel the current running queries.
     """
@@ -30,24 +190,20 @@ def straight_distance(cursor, study_area, category, name, show_status, parallel)
         click.echo("study area not found")
         sys.exit(1)
 
+    max_distances = get_amenity_max_distances(config.AMENITIES or {})
+
+    if engine == ENGINE_LOCAL:
+        run_local(cursor, study_area_id, category, name, max_distances, show_status, parallel)
+        return
+
     # Add residence amenity distance
     amenities = get_amenity_name_category(
         cursor, study_area_id, category=category, name=name
     )
-
-    async def main():
-        # This limits the number of running queries, defaults to `1`
-        sem = asyncio.Semaphore(parallel)
-
-        async def task(amty, cat):
-            async with sem:
-                await add_amenity_residence_distances_straight_async(study_area_id, amty, cat)
-
-        tasks = tuple(task(amty, cat) for amty, cat in amenities)
-
-        if show_status:
-            await tqdm_asyncio.gather(*tasks, unit="amenity")
-        else:
-            await asyncio.gather(*tasks)
-
-    asyncio.run(main())
+    residence_ranges = get_study_area_residence_ranges(
+        cursor, study_area_id, parallel * RESIDENCE_RANGES_PER_CONNECTION
+    )
+    asyncio.run(run_database(
+        study_area_id, amenities, residence_ranges, strategy, max_distances, show_status, parallel,
+        pool_size=parallel
+    ))
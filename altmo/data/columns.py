@@ -0,0 +1,93 @@
+"""
+Compact, column oriented storage for residence amenity pairs
+"""
+from __future__ import annotations
+
+from array import array
+from typing import Iterable, Iterator
+
+from altmo.data.types import Point, StraightDistanceRow
+
+
+class PairColumns:
+    """
+    Residence amenity pairs stored column by column in `array.array` objects instead of one Python
+    object per pair.
+
+    Pairs are grouped by residence as they are appended: each residence is stored once along with
+    the offset of its first amenity, so the amenities of residence `idx` are found at
+    `offsets[idx]:offsets[idx + 1]`. This takes 20 bytes per pair (a 4 byte id and two 8 byte
+    coordinates) plus 28 bytes per residence; measured with `tracemalloc` on residences with ten
+    amenities each, that is about 23 bytes per pair against about 560 bytes for the
+    `StraightDistanceRow` and `Point` objects of the same pair.
+
+    Like `itertools.groupby`, a residence which shows up again after other residences starts a new group,
+    so pairs should be appended ordered by residence.
+    """
+    def __init__(self):
+        self.residence_ids = array('i')
+        self.residence_lats = array('d')
+        self.residence_lngs = array('d')
+        self.offsets = array('q')
+        self.amenity_ids = array('i')
+        self.amenity_lats = array('d')
+        self.amenity_lngs = array('d')
+
+    def __len__(self):
+        return len(self.amenity_ids)
+
+    def __repr__(self):
+        return f'<PairColumns pairs={len(self)} residences={self.residence_count} nbytes={self.nbytes}>'
+
+    @classmethod
+    def from_rows(cls, rows: Iterable[StraightDistanceRow]) -> PairColumns:
+        columns = cls()
+        for row in rows:
+            columns.append(row)
+        return columns
+
+    @property
+    def residence_count(self) -> int:
+        return len(self.residence_ids)
+
+    @property
+    def nbytes(self) -> int:
+        """Number of bytes used by the data in our columns"""
+        return sum(
+            len(column) * column.itemsize
+            for column in (
+                self.residence_ids, self.residence_lats, self.residence_lngs, self.offsets,
+                self.amenity_ids, self.amenity_lats, self.amenity_lngs
+            )
+        )
+
+    def append(self, row: StraightDistanceRow) -> None:
+        if not self.residence_ids or self.residence_ids[-1] != row.residence_id:
+            self.residence_ids.append(row.residence_id)
+            self.residence_lats.append(row.residence_lat)
+            self.residence_lngs.append(row.residence_lng)
+            self.offsets.append(len(self.amenity_ids))
+
+        self.amenity_ids.append(row.amenity_id)
+        self.amenity_lats.append(row.amenity_lat)
+        self.amenity_lngs.append(row.amenity_lng)
+
+    def get_group(self, idx: int) -> tuple[Point, list[Point]]:
+        """
+        Returns residence `idx` along with its amenities
+        """
+        start = self.offsets[idx]
+        end = self.offsets[idx + 1] if idx + 1 < len(self.offsets) else len(self.amenity_ids)
+
+        return Point(self.residence_ids[idx], self.residence_lats[idx], self.residence_lngs[idx]), [
+            Point(self.amenity_ids[amt_idx], self.amenity_lats[amt_idx], self.amenity_lngs[amt_idx])
+            for amt_idx in range(start, end)
+        ]
+
+    def groups(self) -> Iterator[tuple[Point, list[Point]]]:
+        """
+        Lazily yields every residence along with its amenities; `Point` objects are only created
+        for the group being yielded
+        """
+        for idx in range(self.residence_count):
+            yield self.get_group(idx)
@@ -51,10 +51,13 @@ def psycopg_context(conn_info):
 
 
 def async_postgres_pool(func):
+    """
+    Passes an aiopg pool to the decorated coroutine; `pool_size` sets the maximum number of connections
+    """
     @wraps(func)
     @get_config
-    async def wrapper(config, *args, **kwargs):
-        async with aiopg.create_pool(config.PG_DSN, timeout=600) as pool:
+    async def wrapper(config, *args, pool_size: int = 10, **kwargs):
+        async with aiopg.create_pool(config.PG_DSN, minsize=1, maxsize=pool_size, timeout=600) as pool:
             return await func(pool, *args, **kwargs)
     return wrapper
 
@@ -1,6 +1,8 @@
 from __future__ import annotations
 
-from altmo.settings import TABLES
+import json
+
+from altmo.settings import TABLES, RESIDENCE_BUILDINGS_SQL
 from altmo.utils import get_category_amenity_keys
 
 
@@ -39,7 +41,7 @@ def get_study_area_residences(cursor, study_area_id: int) -> list[tuple]:
     """fetch all residences for a study area"""
     sql = f"""
         SELECT
-            id, ST_X(ST_Transform(geom, 4326)), ST_Y(ST_Transform(geom, 4326))
+            id, lng, lat
         FROM
             {TABLES.RESIDENCES_TBL}
         WHERE study_area_id = %s
@@ -48,94 +50,98 @@ def get_study_area_residences(cursor, study_area_id: int) -> list[tuple]:
     return cursor.fetchall()
 
 
-def get_residence_amenity_straight_distance(
-        cursor,
-        study_area_id: int, /, *,
-        start: int = 0,
-        limit: int = 1000,
-        srs_id: int = 4326,
-        category: str = None,
-        name: str = None,
-        sample: int = None
-) -> list[tuple]:
+def get_study_area_residence_ranges(cursor, study_area_id: int, count: int) -> list[tuple]:
     """
-    Used to retrieve a subset of `*_residence_amenity_distances_straight` records.
-    These records are used to calculate the network distances.
-
-    :param cursor:
-    :param study_area_id: unique identify for study area
-    :param start: begin offset here
-    :param limit: limit offset to this value
-    :param srs_id: e.g. 4326 or 3857
-    :param category: amenity category to filter by
-    :param name: amenity name to filter by
-    :param sample: only grab every nth element; useful for reducing calculations needed.
-
-    :return: result set from the database cursor.
+    split the residences `altmo straight` finds amenities for into `count` id ranges holding about
+    the same number of residences; returns (lowest id, highest id) for each of them
     """
-    params = {
-        'study_area_id': study_area_id,
-        'srs_id': srs_id,
-        'start': start,
-        'limit': limit,
-    }
+    sql = f"""
+        SELECT
+            min(id), max(id)
+        FROM (
+            SELECT id, ntile(%s) OVER (ORDER BY id) AS tile
+            FROM {TABLES.RESIDENCES_TBL}
+            WHERE study_area_id = %s AND building IN {RESIDENCE_BUILDINGS_SQL}
+        ) tiles
+        GROUP BY tile
+        ORDER BY tile
+    """
+    cursor.execute(sql, (count, study_area_id))
+    return cursor.fetchall()
 
-    extra_where_sql = ''
-    if category is not None:
-        extra_where_sql += " AND am.category = %(category)s"
-        params['category'] = category
 
-    if name is not None:
-        extra_where_sql += " AND am.name = %(name)s"
-        params['name'] = name
+def get_study_area_residence_points(cursor, study_area_id: int) -> list[tuple]:
+    """
+    fetch the id and projected coordinates of the residences `altmo straight` finds amenities for
+    """
+    sql = f"""
+        SELECT
+            id, ST_X(geom), ST_Y(geom)
+        FROM
+            {TABLES.RESIDENCES_TBL}
+        WHERE
+            study_area_id = %s
+        AND
+            building IN {RESIDENCE_BUILDINGS_SQL}
+    """
+    cursor.execute(sql, (study_area_id,))
+    return cursor.fetchall()
 
-    if sample is not None:
-        extra_where_sql += " AND residence_id %% %(sample)s = 0"
-        params['sample'] = sample
 
+def get_study_area_amenity_points(cursor, study_area_id: int, category=None, name=None) -> list[tuple]:
+    """
+    fetch the id, name, category and projected coordinates of the amenities in a study area
+    """
     sql = f"""
-    SELECT
-        residence_id,
-        amenity_id,
-        ST_Y(ST_Transform(r.geom, %(srs_id)s)) as residence_lat,
-        ST_X(ST_Transform(r.geom, %(srs_id)s)) as residence_lng,
-        ST_Y(ST_Transform(am.geom, %(srs_id)s)) as amenity_lat,
-        ST_X(ST_Transform(am.geom, %(srs_id)s)) as amenity_lng
-    FROM
-        {TABLES.RES_AMENITY_DIST_STR_TBL}
-    JOIN
-        {TABLES.AMENITIES_TBL} am
-    ON
-        amenity_id = am.id
-    JOIN
-        {TABLES.RESIDENCES_TBL} r
-    ON
-        residence_id = r.id
-    WHERE
-        r.study_area_id = %(study_area_id)s
-    {extra_where_sql}
-    ORDER BY
-        r.id
-    OFFSET %(start)s
-    LIMIT %(limit)s
+        SELECT
+            id, name, category, ST_X(geom), ST_Y(geom)
+        FROM
+            {TABLES.AMENITIES_TBL}
+        WHERE
+            study_area_id = %s
     """
+    params = (study_area_id,)
+
+    if category:
+        sql += " AND category = %s"
+        params += (category,)
+
+    if name:
+        sql += " AND name = %s"
+        params += (name,)
 
     cursor.execute(sql, params)
     return cursor.fetchall()
 
 
-def get_residence_amenity_straight_distance_count(
-        cursor, study_area_id: int,
-        sample: int = None,
-        category: str = None,
-        name: str = None,
-) -> int:
+def has_residences_without_sample_key(cursor, study_area_id: int) -> bool:
     """
-    Gets the count of the current number of records in the straight distances table for a study_area_id
+    Whether a study area has residences without a `sample_key`, e.g. because it was built before we added them
+    """
+    sql = f"""
+    SELECT EXISTS (
+        SELECT 1 FROM {TABLES.RESIDENCES_TBL} WHERE study_area_id = %s AND sample_key IS NULL
+    )
+    """
+    cursor.execute(sql, (study_area_id,))
+
+    result = cursor.fetchone()
+
+    return bool(result[0]) if result else False
+
+
+def _get_straight_distance_filters(
+    params: dict,
+    category: str = None,
+    name: str = None,
+    sample: int = None,
+    missing_modes: list[str] = None,
+    shard: tuple[int, int] = None
+) -> str:
+    """
+    Returns the extra WHERE clauses shared by the `get_residence_amenity_straight_distance*` functions
+    and adds their values to `params`
     """
-    params = {
-        'study_area_id': study_area_id
-    }
     extra_where_sql = ''
 
     if category is not None:
@@ -147,80 +153,145 @@ def get_residence_amenity_straight_distance_count(
         params['name'] = name
 
     if sample is not None:
-        extra_where_sql += " AND residence_id %% %(sample)s = 0"
-        params['sample'] = sample
-
-    sql = f"""
-    SELECT
-        count(*)
-    FROM
-        {TABLES.RES_AMENITY_DIST_STR_TBL}
-    JOIN
-        {TABLES.RESIDENCES_TBL} r
-    ON
-        residence_id = r.id
-    WHERE
-        r.study_area_id = %(study_area_id)s
-    {extra_where_sql}
-    """
-    cursor.execute(sql, params)
+        extra_where_sql += " AND r.sample_key < %(sample_fraction)s"
+        params['sample_fraction'] = 1 / sample
+
+    if missing_modes:
+        # One NOT EXISTS per mode, so that with a single mode Postgres can plan a (hash) anti join
+        # instead of counting the stored distances of every pair
+        not_exists_sql = ' OR '.join(
+            f"""NOT EXISTS (
+                SELECT 1 FROM {TABLES.RES_AMENITY_DIST_TBL} d
+                WHERE d.residence_id = s.residence_id AND d.amenity_id = s.amenity_id
+                AND d.mode = %(missing_mode_{idx})s
+            )"""
+            for idx in range(len(missing_modes))
+        )
+        extra_where_sql += f" AND ({not_exists_sql})"
+        for idx, mode in enumerate(missing_modes):
+            params[f'missing_mode_{idx}'] = mode
 
-    result = cursor.fetchone()
+    if shard is not None:
+        extra_where_sql += " AND s.residence_id %% %(shard_count)s = %(shard_index)s"
+        params['shard_index'], params['shard_count'] = shard
 
-    return result[0] if result else 0
+    return extra_where_sql
 
 
-async def get_residence_amenity_straight_distance_async(
-    cursor, study_area_id: int, /, *,
-    start: int = 0, limit: int = 1000, srs_id: int = 4326,
-    category: str = None, name: str = None
-) -> list[tuple]:
+def _get_straight_distance_query(
+        study_area_id: int,
+        after: tuple[int, int] = None,
+        limit: int = None,
+        **filters
+) -> tuple[str, dict]:
+    """
+    Returns the SQL and parameters used by the `get_residence_amenity_straight_distance*` functions
+    """
     params = {
         'study_area_id': study_area_id,
-        'srs_id': srs_id,
-        'start': start,
         'limit': limit,
     }
+    extra_where_sql = _get_straight_distance_filters(params, **filters)
 
-    extra_where_sql = ''
-    if category is not None:
-        extra_where_sql += " AND am.category = %s"
-        params += (category,)
+    if after is not None:
+        extra_where_sql += " AND (s.residence_id, s.amenity_id) > (%(after_residence_id)s, %(after_amenity_id)s)"
+        params['after_residence_id'], params['after_amenity_id'] = after
 
-    if name is not None:
-        extra_where_sql += " AND am.name = %s"
-        params += (name,)
+    limit_sql = "LIMIT %(limit)s" if limit is not None else ""
 
     sql = f"""
     SELECT
-        residence_id,
-        amenity_id,
-        ST_Y(ST_Transform(r.geom, %(srs_id)s)) as residence_lat,
-        ST_X(ST_Transform(r.geom, %(srs_id)s)) as residence_lng,
-        ST_Y(ST_Transform(am.geom, %(srs_id)s)) as amenity_lat,
-        ST_X(ST_Transform(am.geom, %(srs_id)s)) as amenity_lng
+        s.residence_id,
+        s.amenity_id,
+        r.lat as residence_lat,
+        r.lng as residence_lng,
+        am.lat as amenity_lat,
+        am.lng as amenity_lng
     FROM
-        {TABLES.RES_AMENITY_DIST_STR_TBL}
+        {TABLES.RES_AMENITY_DIST_STR_TBL} s
     JOIN
         {TABLES.AMENITIES_TBL} am
     ON
-        amenity_id = am.id
+        s.amenity_id = am.id
     JOIN
         {TABLES.RESIDENCES_TBL} r
     ON
-        residence_id = r.id
+        s.residence_id = r.id
     WHERE
         r.study_area_id = %(study_area_id)s
     {extra_where_sql}
     ORDER BY
-        r.id
-    OFFSET %(start)s
-    LIMIT %(limit)s
+        s.residence_id, s.amenity_id
+    {limit_sql}
+    """
+
+    return sql, params
+
+
+def get_residence_amenity_straight_distance(
+        cursor,
+        study_area_id: int, /, *,
+        after: tuple[int, int] = None,
+        limit: int = 1000,
+        category: str = None,
+        name: str = None,
+        sample: int = None,
+        missing_modes: list[str] = None,
+        shard: tuple[int, int] = None
+) -> list[tuple]:
+    """
+    Used to retrieve a subset of `*_residence_amenity_distances_straight` records.
+    These records are used to calculate the network distances.
+
+    :param cursor:
+    :param study_area_id: unique identify for study area
+    :param after: only grab pairs after this (residence_id, amenity_id); used to page through results
+    :param limit: limit offset to this value; `None` grabs everything
+    :param category: amenity category to filter by
+    :param name: amenity name to filter by
+    :param sample: only grab about one in every n residences, spread evenly over the study area; useful for
+        reducing calculations needed.
+    :param missing_modes: only grab pairs missing a network distance for any of these modes; used to resume runs.
+    :param shard: (index, count) only grab residences where `residence_id % count == index`
+
+    :return: result set from the database cursor.
+    """
+    sql, params = _get_straight_distance_query(
+        study_area_id, after=after, limit=limit, category=category, name=name, sample=sample,
+        missing_modes=missing_modes, shard=shard
+    )
+    cursor.execute(sql, params)
+    return cursor.fetchall()
+
+
+def get_residence_amenity_straight_distance_estimate(cursor, study_area_id: int, **filters) -> int:
+    """
+    Returns the planner's estimate of the number of records `get_residence_amenity_straight_distance` would
+    return. `EXPLAIN` does not run the query, so unlike `count(*)` this is cheap no matter how large the
+    study area is; use it for progress reporting only.
+    """
+    sql, params = _get_straight_distance_query(study_area_id, **filters)
+    cursor.execute(f"EXPLAIN (FORMAT JSON) {sql}", params)
+
+    result = cursor.fetchone()
+    if not result:
+        return 0
+
+    plan = json.loads(result[0]) if isinstance(result[0], str) else result[0]
+
+    return int(plan[0]['Plan']['Plan Rows'])
+
+
+async def get_residence_amenity_straight_distance_async(
+        cursor, study_area_id: int, /, *, after: tuple[int, int] = None, limit: int = 1000, **filters
+) -> list[tuple]:
+    """
+    Async version of `get_residence_amenity_straight_distance` for aiopg cursors; accepts the same filters
     """
+    sql, params = _get_straight_distance_query(study_area_id, after=after, limit=limit, **filters)
 
     await cursor.execute(sql, params)
-    result = await cursor.fetchall()
-    return result
+    return await cursor.fetchall()
 
 
 def _get_residence_composite_average_times_sql(
@@ -1,60 +1,106 @@
-import abc
-from typing import Callable, Generator
+import asyncio
+import contextlib
+from typing import AsyncIterator
 
-from psycopg2.extensions import cursor
+from altmo.data.columns import PairColumns
+from altmo.data.read import get_residence_amenity_straight_distance_async
+from altmo.data.types import Point, StraightDistanceRow
+from altmo.planner import chunk_groups_async
 
-from altmo.data.read import get_residence_amenity_straight_distance_count, get_residence_amenity_straight_distance
-from altmo.data.utils import page_query
 
-
-class ResultSetContainer(abc.ABC):
-    """
-    Holds information about the result sets we want to retrieve and the data itself in the `result_sets` property.
+class AsyncStraightDistanceResultSet:
     """
+    Reads straight distances on an aiopg pool while the pairs we already have are being routed.
+
+    A background task fetches pages of `page_size` rows by keyset, each one starting after the last
+    (residence_id, amenity_id) of the previous page, into a queue holding at most `prefetch` pages.
+    Database round trips therefore overlap with the Valhalla requests in flight instead of alternating
+    with them, while memory stays bounded.
 
-    def __init__(self, cur: cursor, study_area_id: int, batch_size: int, query_kwargs: dict = None):
-        self.cursor = cur
+    Pages are packed into `PairColumns` as soon as they arrive, so the queued pages stay compact and
+    `Point` objects are only created for the residences the planner is currently windowing over.
+    """
+    def __init__(
+        self, pool, study_area_id: int, page_size: int, batch_size: int, query_kwargs: dict = None,
+        prefetch: int = 2
+    ):
+        self.pool = pool
         self.study_area_id = study_area_id
+        self.page_size = page_size
         self.batch_size = batch_size
+        self.prefetch = prefetch
         self.query_kwargs = query_kwargs if query_kwargs else {}
-        self._count = self._get_result_set_count()
 
     def __repr__(self):
         return (
-            '<ResultSetContainer'
+            '<AsyncStraightDistanceResultSet '
             f'study_area_id={self.study_area_id} '
+            f'page_size={self.page_size} '
             f'batch_size={self.batch_size} '
             f'query_kwargs={self.query_kwargs}>'
         )
 
-    @abc.abstractmethod
-    def _get_result_set_count(self) -> int:
-        ...
+    async def _read_pages(self, pages: asyncio.Queue) -> None:
+        """
+        Puts every page on `pages` as `PairColumns` followed by `None`, or the exception which stopped us
+        """
+        after = None
 
-    @abc.abstractmethod
-    def _get_result_set_func(self) -> Callable:
-        ...
+        try:
+            while True:
+                async with self.pool.acquire() as conn:
+                    async with conn.cursor() as cursor:
+                        rows = await get_residence_amenity_straight_distance_async(
+                            cursor, self.study_area_id, after=after, limit=self.page_size, **self.query_kwargs
+                        )
+                page = PairColumns.from_rows(map(StraightDistanceRow._make, rows))
+                del rows
+                if len(page):
+                    await pages.put(page)
+                if len(page) < self.page_size:
+                    break
+                after = page.residence_ids[-1], page.amenity_ids[-1]
+        except Exception as exc:
+            await pages.put(exc)
+            return
 
-    @property
-    def result_sets(self) -> Generator:
-        return page_query(
-            self._get_result_set_func(), self._count, self.batch_size,
-            self.cursor, self.study_area_id, **self.query_kwargs
-        )
+        await pages.put(None)
 
-    @result_sets.setter
-    def result_sets(self, value):
-        raise TypeError('Results is a read-only value')
+    async def groups(self) -> AsyncIterator[tuple[Point, list[Point]]]:
+        """
+        Residences grouped with their amenities, merging residences which are split over two pages
+        """
+        pages = asyncio.Queue(maxsize=self.prefetch)
+        reader = asyncio.create_task(self._read_pages(pages))
+        pending = None
 
+        try:
+            while True:
+                page = await pages.get()
+                if page is None:
+                    break
+                if isinstance(page, Exception):
+                    raise page
 
-class StraightDistanceResultSetContainer(ResultSetContainer):
-    """
-    Implementation of ResultSetContainer that uses the `get_residence_amenity_straight_distance*` functions
-    """
-    def _get_result_set_count(self) -> int:
-        return get_residence_amenity_straight_distance_count(
-            self.cursor, self.study_area_id, **self.query_kwargs
-        )
+                for residence, amenities in page.groups():
+                    if pending is not None and pending[0].id == residence.id:
+                        pending[1].extend(amenities)
+                        continue
+                    if pending is not None:
+                        yield pending
+                    pending = residence, amenities
 
-    def _get_result_set_func(self, *args, **kwargs) -> Callable:
-        return get_residence_amenity_straight_distance
+            if pending is not None:
+                yield pending
+        finally:
+            reader.cancel()
+            with contextlib.suppress(asyncio.CancelledError):
+                await reader
+
+    @property
+    def result_sets(self) -> AsyncIterator[AsyncIterator[tuple[Point, list[Point]]]]:
+        """
+        Residences grouped with their amenities, split into result sets of about `batch_size` rows.
+        Each result set is lazy and has to be consumed before the next one is taken.
+        """
+        return chunk_groups_async(self.groups(), self.batch_size)
@@ -1,8 +1,62 @@
+from __future__ import annotations
+
 from altmo.settings import get_config, TABLES
 
 from .decorators import psycopg2_cur
 
 
+# Longitude and latitude in WGS84, which is what Valhalla expects. These are kept in sync with `geom`
+# by Postgres so that we do not have to re-project the same points on every read.
+WGS84_COLUMNS = {
+    'lng': 'DOUBLE PRECISION GENERATED ALWAYS AS (ST_X(ST_Transform(geom, 4326))) STORED',
+    'lat': 'DOUBLE PRECISION GENERATED ALWAYS AS (ST_Y(ST_Transform(geom, 4326))) STORED',
+}
+
+
+# Random value in [0, 1) stratified over a spatial grid, see `altmo.data.write.add_residence_sample_keys`.
+# Selecting `sample_key < 1 / n` gives us about one in n residences from every part of the study area.
+SAMPLE_KEY_COLUMN = ('sample_key', 'DOUBLE PRECISION')
+
+
+def _get_sample_key_index_sql() -> str:
+    return (
+        f"CREATE INDEX IF NOT EXISTS {TABLES.RESIDENCES_TBL}_sample_key_idx "
+        f"ON {TABLES.RESIDENCES_TBL} (study_area_id, sample_key)"
+    )
+
+
+def _get_spatial_indexes_sql() -> list[str]:
+    """
+    GiST indexes used for nearest neighbour (`<->`) lookups, see `altmo.data.write.STRAIGHT_STRATEGY_KNN`.
+
+    Nearest neighbour lookups always ask for one type of amenity in one study area. With `btree_gist` these
+    columns can lead the amenities index, so that its scan only visits amenities of that type instead of
+    walking past all other amenities nearby and filtering them out afterwards.
+    """
+    return [
+        "CREATE EXTENSION IF NOT EXISTS btree_gist",
+        f"CREATE INDEX IF NOT EXISTS {TABLES.AMENITIES_TBL}_type_geom_idx "
+        f"ON {TABLES.AMENITIES_TBL} USING GIST (study_area_id, category, name, geom)",
+        f"CREATE INDEX IF NOT EXISTS {TABLES.RESIDENCES_TBL}_geom_idx ON {TABLES.RESIDENCES_TBL} USING GIST (geom)",
+    ]
+
+
+def _get_residence_amenity_unreachable_sql() -> str:
+    return f"""
+        CREATE TABLE IF NOT EXISTS {TABLES.RES_AMENITY_UNREACHABLE_TBL} (
+            residence_id INTEGER REFERENCES {TABLES.RESIDENCES_TBL}(id),
+            amenity_category VARCHAR(100),
+            amenity_name VARCHAR(200),
+            max_distance FLOAT,
+            PRIMARY KEY (residence_id, amenity_category, amenity_name)
+        )
+    """
+
+
+def _get_wgs84_columns_sql() -> str:
+    return ",\n".join(f"{column} {definition}" for column, definition in WGS84_COLUMNS.items())
+
+
 @psycopg2_cur()
 @get_config
 def create_schema(config, cursor):
@@ -31,7 +85,8 @@ def create_schema(config, cursor):
             study_area_id INTEGER REFERENCES {TABLES.STUDY_AREA_TBL}(id),
             name VARCHAR(200),
             category VARCHAR(100),
-            geom Geometry(Point, {config.SRS_ID})
+            geom Geometry(Point, {config.SRS_ID}),
+            {_get_wgs84_columns_sql()}
         )
     """
 
@@ -42,7 +97,9 @@ def create_schema(config, cursor):
             tags HSTORE,
             house_number VARCHAR(100),
             building VARCHAR(100),
-            geom Geometry(Point, {config.SRS_ID})
+            geom Geometry(Point, {config.SRS_ID}),
+            {' '.join(SAMPLE_KEY_COLUMN)},
+            {_get_wgs84_columns_sql()}
         )
     """
 
@@ -84,14 +141,36 @@ def create_schema(config, cursor):
     cursor.execute(study_areas_parts_sql)
     cursor.execute(amenities_sql)
     cursor.execute(residences_sql)
+    cursor.execute(_get_sample_key_index_sql())
+    for index_sql in _get_spatial_indexes_sql():
+        cursor.execute(index_sql)
     cursor.execute(residence_amenity_distances_sql)
     cursor.execute(residence_amenity_distances_straight_sql)
     cursor.execute(residence_amenity_standardized_sql)
+    cursor.execute(_get_residence_amenity_unreachable_sql())
+
+
+def update_schema(cursor) -> None:
+    """
+    Adds the columns and indexes introduced after a schema was created, i.e. the `WGS84_COLUMNS` of
+    the amenities and residences tables, the `SAMPLE_KEY_COLUMN` of the residences table, the
+    spatial indexes and the unreachable residences table
+    """
+    for table in (TABLES.AMENITIES_TBL, TABLES.RESIDENCES_TBL):
+        for column, definition in WGS84_COLUMNS.items():
+            cursor.execute(f"ALTER TABLE {table} ADD COLUMN IF NOT EXISTS {column} {definition}")
+
+    cursor.execute(f"ALTER TABLE {TABLES.RESIDENCES_TBL} ADD COLUMN IF NOT EXISTS {' '.join(SAMPLE_KEY_COLUMN)}")
+    cursor.execute(_get_sample_key_index_sql())
+    for index_sql in _get_spatial_indexes_sql():
+        cursor.execute(index_sql)
+    cursor.execute(_get_residence_amenity_unreachable_sql())
 
 
 @psycopg2_cur()
 def remove_schema(cursor):
     cursor.execute(f"DROP TABLE {TABLES.RES_AMENITY_CAT_DIST_TBL} CASCADE")
+    cursor.execute(f"DROP TABLE IF EXISTS {TABLES.RES_AMENITY_UNREACHABLE_TBL} CASCADE")
     cursor.execute(f"DROP TABLE {TABLES.RES_AMENITY_DIST_TBL} CASCADE")
     cursor.execute(f"DROP TABLE {TABLES.RES_AMENITY_DIST_STR_TBL} CASCADE")
     cursor.execute(f"DROP TABLE {TABLES.STUDY_PARTS_TBL} CASCADE")
@@ -20,3 +20,11 @@ StraightDistanceRow = namedtuple('StraightDistanceRow', [
     'amenity_lat',
     'amenity_lng'
 ])
+
+NetworkDistanceRow = namedtuple('NetworkDistanceRow', [
+    'distance',
+    'time',
+    'amenity_id',
+    'residence_id',
+    'mode'
+])
@@ -1,5 +1,7 @@
+import io
 import re as _re
-from typing import Callable, Generator
+import struct
+from typing import Iterable, Sequence
 
 from psycopg2 import extensions as _ext
 
@@ -144,11 +146,47 @@ def _paginate(seq, page_size):
             return
 
 
-def page_query(func: Callable, count: int, batch_size: int, *args, **kwargs) -> Generator:
+_COPY_BINARY_HEADER = b'PGCOPY\n\xff\r\n\x00' + struct.pack('!ii', 0, 0)
+_COPY_BINARY_TRAILER = struct.pack('!h', -1)
+_COPY_BINARY_NULL = struct.pack('!i', -1)
+
+# Encoders for the column types we write with `COPY ... WITH (FORMAT binary)`
+COPY_FLOAT8 = struct.Struct('!id')
+COPY_INT8 = struct.Struct('!iq')
+COPY_INT4 = struct.Struct('!ii')
+COPY_TEXT = 'text'
+
+
+def get_copy_binary_buffer(records: Iterable[Sequence], types: Sequence) -> io.BytesIO:
     """
-    This function is used to iterate over potentially very large query result sets.
-    `func` should defined kwargs `start` and `limit` and these kwargs should limit the query result accordingly
+    Encodes `records` in PostgreSQL's binary `COPY` format.
+
+    :param records: rows to encode; `None` values are written as NULL
+    :param types: one of `COPY_FLOAT8`, `COPY_INT8`, `COPY_INT4` or `COPY_TEXT` for each column;
+                  these have to match the column types of the table exactly
+
+    More information about the format here:
+        - https://www.postgresql.org/docs/current/sql-copy.html#id-1.9.3.55.9.4
     """
-    for batch_start in range(0, count, batch_size):
-        kwargs.update(start=batch_start, limit=batch_size)
-        yield func(*args, **kwargs)
+    buffer = io.BytesIO()
+    buffer.write(_COPY_BINARY_HEADER)
+    field_count = struct.pack('!h', len(types))
+
+    for record in records:
+        buffer.write(field_count)
+        for value, type_ in zip(record, types):
+            if value is None:
+                buffer.write(_COPY_BINARY_NULL)
+            elif type_ is COPY_TEXT:
+                data = value.encode('utf-8')
+                buffer.write(struct.pack('!i', len(data)))
+                buffer.write(data)
+            elif type_ is COPY_FLOAT8:
+                buffer.write(type_.pack(8, value))
+            else:
+                buffer.write(type_.pack(type_.size - 4, int(value)))
+
+    buffer.write(_COPY_BINARY_TRAILER)
+    buffer.seek(0)
+
+    return buffer
@@ -5,9 +5,15 @@ from typing import Union, Generator
 
 from psycopg2.extras import execute_values
 
-from altmo.data.decorators import async_postgres_cursor
-from altmo.data.utils import execute_values as execute_values_async
-from altmo.settings import TABLES
+from altmo.data.utils import (
+    execute_values as execute_values_async,
+    get_copy_binary_buffer,
+    COPY_FLOAT8,
+    COPY_INT8,
+    COPY_INT4,
+    COPY_TEXT,
+)
+from altmo.settings import TABLES, RESIDENCE_BUILDINGS_SQL
 
 
 def create_study_area(cursor, data: dict, srs_id: Union[int, str]) -> None:
@@ -34,68 +40,51 @@ def delete_amenities(cursor, study_area_id: int) -> None:
     cursor.execute(sql, (study_area_id,))
 
 
-def add_amenities(cursor, study_area_id: int, amenities: list[str]) -> None:
-    """adds amenities to the amenities table without category"""
-    amenities_sql_str = "','".join(amenities)
-
-    # Add points from amenities column
-    sql = f"""
-    INSERT INTO {TABLES.AMENITIES_TBL} (name, geom, study_area_id)
-    SELECT
-        amenity, way, {study_area_id}
-    FROM
-        planet_osm_point pp
-    WHERE
-        ST_Contains((SELECT geom FROM {TABLES.STUDY_AREA_TBL} where id = %s), pp.way)
-    AND
-        amenity IN ('{amenities_sql_str}')
-    """
-    cursor.execute(sql, (study_area_id,))
-
-    # Add polygons from amenities column
-    sql = f"""
-    INSERT INTO {TABLES.AMENITIES_TBL} (name, geom, study_area_id)
-    SELECT
-        amenity, ST_Centroid(way), {study_area_id}
-    FROM
-        planet_osm_polygon pp
-    WHERE
-        ST_Contains((SELECT geom FROM {TABLES.STUDY_AREA_TBL} WHERE id = %s), pp.way)
-    AND
-        amenity IN ('{amenities_sql_str}')
+def add_amenities(cursor, study_area_id: int, amenities: list[str], table: str = None) -> None:
     """
-    cursor.execute(sql, (study_area_id,))
+    adds amenities to the amenities table (or `table`, e.g. a staging table) without category
 
-    # Add points from shop column
-    sql = f"""
-    INSERT INTO {TABLES.AMENITIES_TBL} (name, geom, study_area_id)
-    SELECT
-        shop, way, {study_area_id}
-    FROM
-        planet_osm_point pp
-    WHERE
-        ST_Contains((SELECT geom FROM {TABLES.STUDY_AREA_TBL} WHERE id = %s), pp.way)
-    AND
-        shop IN ('{amenities_sql_str}')
+    Points and polygons (as their centroid) are taken from both the `amenity` and `shop` columns. Each
+    OSM table is only scanned once: the study area geometry is computed once up front and each row
+    matching either column is split into one amenity per matching column.
     """
-    cursor.execute(sql, (study_area_id,))
-
-    # Add polygons from shop column
+    table = table or TABLES.AMENITIES_TBL
     sql = f"""
-    INSERT INTO {TABLES.AMENITIES_TBL} (name, geom, study_area_id)
+    WITH study_area AS MATERIALIZED (
+        SELECT geom FROM {TABLES.STUDY_AREA_TBL} WHERE id = %(study_area_id)s
+    )
+    INSERT INTO {table} (name, geom, study_area_id)
     SELECT
-        shop, ST_Centroid(way), {study_area_id}
-    FROM
-        planet_osm_polygon pp
+        tag.name, osm.geom, %(study_area_id)s
+    FROM (
+        SELECT
+            pp.amenity, pp.shop, pp.way AS geom
+        FROM
+            planet_osm_point pp, study_area
+        WHERE
+            ST_Contains(study_area.geom, pp.way)
+        AND
+            (pp.amenity = ANY(%(amenities)s) OR pp.shop = ANY(%(amenities)s))
+        UNION ALL
+        SELECT
+            pp.amenity, pp.shop, ST_Centroid(pp.way) AS geom
+        FROM
+            planet_osm_polygon pp, study_area
+        WHERE
+            ST_Contains(study_area.geom, pp.way)
+        AND
+            (pp.amenity = ANY(%(amenities)s) OR pp.shop = ANY(%(amenities)s))
+    ) osm
+    CROSS JOIN LATERAL (
+        VALUES (osm.amenity), (osm.shop)
+    ) AS tag(name)
     WHERE
-        ST_Contains((SELECT geom FROM {TABLES.STUDY_AREA_TBL} WHERE id = %s), pp.way)
-    AND
-        shop IN ('{amenities_sql_str}')
+        tag.name = ANY(%(amenities)s)
     """
-    cursor.execute(sql, (study_area_id,))
+    cursor.execute(sql, {'study_area_id': study_area_id, 'amenities': list(amenities)})
 
 
-def add_natural_amenities(cursor, study_area_id: int, include: tuple) -> None:
+def add_natural_amenities(cursor, study_area_id: int, include: tuple, table: str = None) -> None:
     """
     Runs special queries that add natural amenities for a study area.
 
@@ -107,6 +96,7 @@ def add_natural_amenities(cursor, study_area_id: int, include: tuple) -> None:
 
     Another problem here is that we assume an SRS that uses meters.
     """
+    table = table or TABLES.AMENITIES_TBL
     sql = f"""
     SELECT
         (ST_Dump(ST_GeneratePoints(pp.way, (ceil(pp.way_area/50000.0))::integer))).geom,
@@ -155,19 +145,20 @@ def add_natural_amenities(cursor, study_area_id: int, include: tuple) -> None:
             records.append((geom, "nature", "park", study_area_id))
 
     insert_sql = f"""
-        INSERT INTO {TABLES.AMENITIES_TBL} (geom, category, name, study_area_id) VALUES %s
+        INSERT INTO {table} (geom, category, name, study_area_id) VALUES %s
     """
     execute_values(cursor, insert_sql, records, template=None, page_size=100)
 
 
 def add_amenities_category(
-    cursor, study_area_id: int, amenity_category_map: dict[str, str]
+    cursor, study_area_id: int, amenity_category_map: dict[str, str], table: str = None
 ) -> None:
+    table = table or TABLES.AMENITIES_TBL
     values = amenity_category_map.items()
     values_str = ",".join([f"('{name}', '{category}')" for name, category in values])
 
     sql = f"""
-    UPDATE {TABLES.AMENITIES_TBL} as a set
+    UPDATE {table} as a set
         category = c.category
     FROM (VALUES
         {values_str}
@@ -182,8 +173,28 @@ def add_amenities_category(
     cursor.execute(sql, (study_area_id,))
 
 
-def add_residences(cursor, study_area_id: int) -> None:
-    """copy residences from the OSM tables to our custom table"""
+# Ways of finding the buildings within residential areas, see `add_residences`
+RESIDENCE_STRATEGY_UNION = 'union'
+RESIDENCE_STRATEGY_JOIN = 'join'
+
+
+def add_residences(
+    cursor, study_area_id: int, table: str = None, strategy: str = RESIDENCE_STRATEGY_UNION,
+    max_vertices: int = None
+) -> None:
+    """
+    copy residences from the OSM tables to our custom table (or `table`, e.g. a staging table)
+
+    With the "union" strategy every building within the union of all residential areas is a residence.
+    The "join" strategy does not build this union, which gets very slow for large study areas, see
+    `_add_residences_join`.
+    """
+    table = table or TABLES.RESIDENCES_TBL
+
+    if strategy == RESIDENCE_STRATEGY_JOIN:
+        _add_residences_join(cursor, study_area_id, table, max_vertices)
+        return
+
     sql = f"""
     WITH boundary AS (
       SELECT ST_Union(way) as way
@@ -193,7 +204,7 @@ def add_residences(cursor, study_area_id: int) -> None:
       AND
         ST_Contains((SELECT ST_Buffer(geom, 100) FROM {TABLES.STUDY_AREA_TBL} WHERE id = %s), pp.way)
     )
-    INSERT INTO {TABLES.RESIDENCES_TBL} (study_area_id, building, house_number, tags, geom)
+    INSERT INTO {table} (study_area_id, building, house_number, tags, geom)
     SELECT
       {study_area_id}, p.building, p."addr:housenumber", p.tags,
       ST_Centroid(p.way)
@@ -208,13 +219,207 @@ def add_residences(cursor, study_area_id: int) -> None:
     cursor.execute(sql, (study_area_id,))
 
 
+def _add_residences_join(cursor, study_area_id: int, table: str, max_vertices: int = None) -> None:
+    """
+    Copies every building whose centroid lies in a residential area to `table`.
+
+    The residential areas are put in a temporary table with a spatial index, optionally split into
+    pieces of at most `max_vertices` vertices with `ST_Subdivide` so that each index lookup only has to
+    test a small polygon. Each building in the study area's bounding box is then looked up in this index;
+    `EXISTS` makes sure a building is only added once, even when its centroid touches several areas.
+
+    Unlike the "union" strategy, a building crossing the edge of a residential area is included as long
+    as its centroid is inside it.
+    """
+    if max_vertices:
+        area_sql = "ST_Subdivide(pp.way, %(max_vertices)s)"
+    else:
+        area_sql = "pp.way"
+
+    # Qualified with pg_temp, so that we never drop a permanent table which happens to have the same name
+    cursor.execute("DROP TABLE IF EXISTS pg_temp.residential_areas")
+    cursor.execute(f"""
+    CREATE TEMP TABLE pg_temp.residential_areas ON COMMIT DROP AS
+    SELECT
+      {area_sql} AS way
+    FROM
+      planet_osm_polygon pp
+    WHERE
+      landuse = 'residential'
+    AND
+      ST_Contains((SELECT ST_Buffer(geom, 100) FROM {TABLES.STUDY_AREA_TBL} WHERE id = %(study_area_id)s), pp.way)
+    """, {'study_area_id': study_area_id, 'max_vertices': max_vertices})
+    cursor.execute("CREATE INDEX residential_areas_way_idx ON pg_temp.residential_areas USING GIST (way)")
+    cursor.execute("ANALYZE pg_temp.residential_areas")
+
+    cursor.execute(f"""
+    INSERT INTO {table} (study_area_id, building, house_number, tags, geom)
+    SELECT
+      %(study_area_id)s, p.building, p."addr:housenumber", p.tags,
+      ST_Centroid(p.way)
+    FROM
+      planet_osm_polygon p
+    WHERE
+      p.way && (SELECT ST_Envelope(ST_Buffer(geom, 100)) FROM {TABLES.STUDY_AREA_TBL} WHERE id = %(study_area_id)s)
+    AND
+      p.building IS NOT NULL
+    AND EXISTS (
+      SELECT 1 FROM pg_temp.residential_areas ra WHERE ST_Intersects(ra.way, ST_Centroid(p.way))
+    )
+    """, {'study_area_id': study_area_id})
+
+
+def add_residence_sample_keys(cursor, study_area_id: int, grid_size: float = 500, table: str = None) -> None:
+    """
+    Sets the `sample_key` of every residence in a study area.
+
+    The study area is divided into cells of about `grid_size` meters. Within each cell, residences are put
+    in a random order and the k-th of n residences gets a random key between (k - 1) / n and k / n, so
+    `sample_key < 1 / s` picks about one in s residences from every cell.
+
+    The cells are laid out in Web Mercator (EPSG:3857) rather than in `SRS_ID`, whose units may be degrees.
+    Its meters grow towards the poles, but for spreading a sample evenly that does not matter.
+    """
+    table = table or TABLES.RESIDENCES_TBL
+    sql = f"""
+    UPDATE {table} r
+    SET sample_key = (cell.position - random()) / cell.size
+    FROM (
+        SELECT
+            id,
+            row_number() OVER (PARTITION BY cell_x, cell_y ORDER BY random()) AS position,
+            count(*) OVER (PARTITION BY cell_x, cell_y) AS size
+        FROM (
+            SELECT
+                id,
+                floor(ST_X(ST_Transform(geom, 3857)) / %(grid_size)s) AS cell_x,
+                floor(ST_Y(ST_Transform(geom, 3857)) / %(grid_size)s) AS cell_y
+            FROM
+                {table}
+            WHERE
+                study_area_id = %(study_area_id)s
+        ) cells
+    ) cell
+    WHERE
+        r.id = cell.id
+    """
+
+    cursor.execute(sql, {'study_area_id': study_area_id, 'grid_size': grid_size})
+
+
 def delete_residences(cursor, study_area_id: int) -> None:
     """removes all residences for a study area"""
     sql = f"DELETE FROM {TABLES.RESIDENCES_TBL} WHERE study_area_id = %s"
     cursor.execute(sql, (study_area_id,))
 
 
-def _get_amenity_residence_distance_straight_top_three_sql() -> str:
+# Ways of finding the three nearest amenities of each residence, see `STRAIGHT_DISTANCE_SQL`
+STRAIGHT_STRATEGY_RANK = 'rank'
+STRAIGHT_STRATEGY_KNN = 'knn'
+
+
+def create_staging_tables(cursor, study_area_id: int) -> tuple[str, str]:
+    """
+    Creates empty UNLOGGED copies of the amenities and residences tables to build a study area in.
+
+    New rows still take their ids from the sequences of the real tables, so they can be swapped in
+    as they are with `swap_staging_tables`.
+
+    :returns: the names of the amenities and residences staging tables
+    """
+    staging_tables = (
+        f"{TABLES.AMENITIES_TBL}_staging_{study_area_id}",
+        f"{TABLES.RESIDENCES_TBL}_staging_{study_area_id}",
+    )
+    for staging_table, table in zip(staging_tables, (TABLES.AMENITIES_TBL, TABLES.RESIDENCES_TBL)):
+        cursor.execute(f"DROP TABLE IF EXISTS {staging_table}")
+        cursor.execute(
+            f"CREATE UNLOGGED TABLE {staging_table} (LIKE {table} INCLUDING DEFAULTS INCLUDING GENERATED)"
+        )
+
+    return staging_tables
+
+
+def index_staging_table(cursor, staging_table: str) -> None:
+    """
+    Adds the primary key the category and sample key updates join on and refreshes the planner statistics
+    """
+    cursor.execute(f"ALTER TABLE {staging_table} ADD PRIMARY KEY (id)")
+    cursor.execute(f"ANALYZE {staging_table}")
+
+
+def swap_staging_tables(cursor, study_area_id: int, amenities_table: str, residences_table: str) -> None:
+    """
+    Replaces the amenities and residences of a study area with those in the staging tables and drops them.
+
+    Distances calculated for the old amenities and residences are removed as well, since their ids no
+    longer exist. This all happens in a single transaction: readers keep seeing the old rows until it
+    is committed and are never blocked by it.
+    """
+    residence_ids_sql = f"SELECT id FROM {TABLES.RESIDENCES_TBL} WHERE study_area_id = %(study_area_id)s"
+    amenity_ids_sql = f"SELECT id FROM {TABLES.AMENITIES_TBL} WHERE study_area_id = %(study_area_id)s"
+    params = {'study_area_id': study_area_id}
+
+    for table in (
+        TABLES.RES_AMENITY_DIST_TBL, TABLES.RES_AMENITY_DIST_STR_TBL,
+        TABLES.RES_AMENITY_CAT_DIST_TBL, TABLES.RES_AMENITY_UNREACHABLE_TBL
+    ):
+        cursor.execute(f"DELETE FROM {table} WHERE residence_id IN ({residence_ids_sql})", params)
+    for table in (TABLES.RES_AMENITY_DIST_TBL, TABLES.RES_AMENITY_DIST_STR_TBL):
+        cursor.execute(f"DELETE FROM {table} WHERE amenity_id IN ({amenity_ids_sql})", params)
+
+    delete_amenities(cursor, study_area_id)
+    delete_residences(cursor, study_area_id)
+
+    cursor.execute(f"""
+        INSERT INTO {TABLES.AMENITIES_TBL} (id, study_area_id, name, category, geom)
+        SELECT id, study_area_id, name, category, geom FROM {amenities_table}
+    """)
+    cursor.execute(f"""
+        INSERT INTO {TABLES.RESIDENCES_TBL} (id, study_area_id, tags, house_number, building, geom, sample_key)
+        SELECT id, study_area_id, tags, house_number, building, geom, sample_key FROM {residences_table}
+    """)
+
+    cursor.execute(f"DROP TABLE {amenities_table}")
+    cursor.execute(f"DROP TABLE {residences_table}")
+    cursor.connection.commit()
+
+
+def vacuum_tables(cursor) -> None:
+    """
+    Makes the space taken by replaced rows available again and refreshes the planner statistics of the
+    amenities and residences tables, which are read right after a build. `VACUUM` cannot run inside a
+    transaction, so this commits first.
+
+    The distance tables hold every study area and a rebuild only removes a small part of them, so we
+    leave those to autovacuum rather than scanning them in full.
+    """
+    cursor.connection.commit()
+    autocommit = cursor.connection.autocommit
+    cursor.connection.autocommit = True
+    try:
+        for table in (TABLES.AMENITIES_TBL, TABLES.RESIDENCES_TBL):
+            cursor.execute(f"VACUUM (ANALYZE) {table}")
+    finally:
+        cursor.connection.autocommit = autocommit
+
+
+def _get_straight_distance_filters_sql(residence_range: bool, max_distance: bool) -> str:
+    """
+    Limits the residences to an id range and the amenities to those within `max_distance` of them
+    """
+    sql = ""
+    if residence_range:
+        sql += " AND re.id BETWEEN %(residence_min_id)s AND %(residence_max_id)s"
+    if max_distance:
+        # `ST_DWithin` uses the GiST index on the amenities' `geom`, unlike comparing `ST_Distance`
+        sql += " AND ST_DWithin(am.geom, re.geom, %(max_distance)s)"
+    return sql
+
+
+def _get_amenity_residence_distance_straight_top_three_sql(
+        residence_range: bool = False, max_distance: bool = False
+) -> str:
     return f"""
     INSERT INTO {TABLES.RES_AMENITY_DIST_STR_TBL} (residence_id, amenity_id, distance)
     SELECT rank_filter.residence_id, rank_filter.amenity_id, rank_filter.distance FROM (
@@ -227,63 +432,289 @@ def _get_amenity_residence_distance_straight_top_three_sql() -> str:
         FROM
             {TABLES.RESIDENCES_TBL} re, {TABLES.AMENITIES_TBL} am
         WHERE
-            am.name = %s AND am.category = %s
+            am.name = %(amenity)s AND am.category = %(category)s
         AND
-            building IN ('yes', 'house', 'residential', 'apartments', 'terrace', 'detached')
+            building IN {RESIDENCE_BUILDINGS_SQL}
         AND
-            re.study_area_id = %s AND am.study_area_id = %s
+            re.study_area_id = %(study_area_id)s AND am.study_area_id = %(study_area_id)s
+        {_get_straight_distance_filters_sql(residence_range, max_distance)}
     ) rank_filter WHERE RANK <= 3;
     """
 
 
+def _get_amenity_residence_distance_straight_knn_sql(
+        residence_range: bool = False, max_distance: bool = False
+) -> str:
+    """
+    Looks up the three nearest amenities of each residence with a K-nearest-neighbour scan of the GiST
+    index on the amenities' `(study_area_id, category, name, geom)` (see
+    `altmo.data.schema._get_spatial_indexes_sql`). Unlike ranking every residence amenity pair, this takes
+    about R * log(A) instead of R * A distance calculations, A being the amenities of the requested type.
+
+    Takes the same parameters as `_get_amenity_residence_distance_straight_top_three_sql`.
+    """
+    return f"""
+    INSERT INTO {TABLES.RES_AMENITY_DIST_STR_TBL} (residence_id, amenity_id, distance)
+    SELECT
+        re.id as residence_id, nearest.amenity_id, nearest.distance
+    FROM
+        {TABLES.RESIDENCES_TBL} re
+    CROSS JOIN LATERAL (
+        SELECT
+            am.id as amenity_id, ST_Distance(am.geom, re.geom) as distance
+        FROM
+            {TABLES.AMENITIES_TBL} am
+        WHERE
+            am.name = %(amenity)s AND am.category = %(category)s AND am.study_area_id = %(study_area_id)s
+        {_get_straight_distance_filters_sql(False, max_distance)}
+        ORDER BY
+            am.geom <-> re.geom
+        LIMIT 3
+    ) nearest
+    WHERE
+        re.study_area_id = %(study_area_id)s
+    AND
+        re.building IN {RESIDENCE_BUILDINGS_SQL}
+    {_get_straight_distance_filters_sql(residence_range, False)};
+    """
+
+
+def _get_delete_amenity_residence_unreachable_sql(residence_range: bool = False) -> str:
+    """
+    Removes the unreachable marks of an amenity type, so that marks made with an older `max_distance`
+    do not linger
+    """
+    return f"""
+    DELETE FROM {TABLES.RES_AMENITY_UNREACHABLE_TBL} un
+    USING {TABLES.RESIDENCES_TBL} re
+    WHERE
+        un.residence_id = re.id
+    AND
+        un.amenity_category = %(category)s AND un.amenity_name = %(amenity)s
+    AND
+        re.study_area_id = %(study_area_id)s
+    {_get_straight_distance_filters_sql(residence_range, False)};
+    """
+
+
+def _get_amenity_residence_unreachable_sql(residence_range: bool = False) -> str:
+    """
+    Marks the residences without any amenity of a type within `max_distance` of them
+    """
+    return f"""
+    INSERT INTO {TABLES.RES_AMENITY_UNREACHABLE_TBL} (residence_id, amenity_category, amenity_name, max_distance)
+    SELECT
+        re.id, %(category)s, %(amenity)s, %(max_distance)s
+    FROM
+        {TABLES.RESIDENCES_TBL} re
+    WHERE
+        re.study_area_id = %(study_area_id)s
+    AND
+        re.building IN {RESIDENCE_BUILDINGS_SQL}
+    {_get_straight_distance_filters_sql(residence_range, False)}
+    AND NOT EXISTS (
+        SELECT 1 FROM {TABLES.AMENITIES_TBL} am
+        WHERE
+            am.name = %(amenity)s AND am.category = %(category)s AND am.study_area_id = %(study_area_id)s
+        {_get_straight_distance_filters_sql(False, True)}
+    )
+    ON CONFLICT (residence_id, amenity_category, amenity_name) DO UPDATE SET
+        max_distance = EXCLUDED.max_distance;
+    """
+
+
+STRAIGHT_DISTANCE_SQL = {
+    STRAIGHT_STRATEGY_RANK: _get_amenity_residence_distance_straight_top_three_sql,
+    STRAIGHT_STRATEGY_KNN: _get_amenity_residence_distance_straight_knn_sql,
+}
+
+
+def _get_straight_distance_params(
+        study_area_id: int,
+        amenity: str,
+        category: str,
+        residence_range: tuple[int, int] = None,
+        max_distance: float = None
+) -> dict:
+    params = {'study_area_id': study_area_id, 'amenity': amenity, 'category': category}
+    if residence_range is not None:
+        params['residence_min_id'], params['residence_max_id'] = residence_range
+    if max_distance is not None:
+        params['max_distance'] = max_distance
+    return params
+
+
 def add_amenity_residence_distances_straight(
-        cursor, study_area_id: int, amenities: list
+        cursor, study_area_id: int, amenities: list, strategy: str = STRAIGHT_STRATEGY_KNN
 ) -> Generator:
     """
     Finds the straight line distance amenity and residences.
     We only do this for the first three amenities that we find.
+
+    `strategy` is one of the keys of `STRAIGHT_DISTANCE_SQL`.
     """
     for amenity, category in amenities:
-        sql = _get_amenity_residence_distance_straight_top_three_sql()
-        yield cursor.execute(sql, (amenity, category, study_area_id, study_area_id))
+        sql = STRAIGHT_DISTANCE_SQL[strategy]()
+        yield cursor.execute(sql, _get_straight_distance_params(study_area_id, amenity, category))
 
 
-@async_postgres_cursor
 async def add_amenity_residence_distances_straight_async(
-        cursor, study_area_id: int, amenity: str, category: str
+        cursor,
+        study_area_id: int,
+        amenity: str,
+        category: str,
+        strategy: str = STRAIGHT_STRATEGY_KNN,
+        residence_range: tuple[int, int] = None,
+        max_distance: float = None
 ) -> None:
-    sql = _get_amenity_residence_distance_straight_top_three_sql()
-    await cursor.execute(sql, (amenity, category, study_area_id, study_area_id))
+    """
+    Async version of `add_amenity_residence_distances_straight` for a single amenity type on an aiopg cursor.
 
+    `residence_range` (lowest id, highest id) limits it to a part of the residences, so that a large
+    amenity type can be split over several connections.
 
-def add_amenity_residence_distance(cursor, records: list[tuple]) -> None:
+    With `max_distance`, only amenities within this distance (in units of the SRS) are considered and
+    residences without any of them are stored in the unreachable table instead. Marks left by an earlier
+    run are removed first. Without it the unreachable table (created by `altmo build`) is left alone.
     """
-    adds network residence amenity distances
+    sql = STRAIGHT_DISTANCE_SQL[strategy](
+        residence_range=residence_range is not None, max_distance=max_distance is not None
+    )
+    params = _get_straight_distance_params(study_area_id, amenity, category, residence_range, max_distance)
+
+    if max_distance is not None:
+        await cursor.execute(_get_delete_amenity_residence_unreachable_sql(residence_range is not None), params)
+
+    await cursor.execute(sql, params)
+
+    if max_distance is not None:
+        await cursor.execute(_get_amenity_residence_unreachable_sql(residence_range is not None), params)
+
+
+def copy_amenity_residence_distances_straight(cursor, records: list[tuple]) -> None:
+    """
+    adds straight residence amenity distances in bulk using `COPY`
 
     tuple needs to be in the following order:
-        distance, time, amenity_id, residence_id, mode
+        residence_id, amenity_id, distance
     """
-    sql = f"""
+    buffer = get_copy_binary_buffer(records, (COPY_INT4, COPY_INT4, COPY_FLOAT8))
+    cursor.copy_expert(
+        f"COPY {TABLES.RES_AMENITY_DIST_STR_TBL} (residence_id, amenity_id, distance) FROM STDIN WITH (FORMAT binary)",
+        buffer
+    )
+
+
+def delete_amenity_residence_unreachable(cursor, study_area_id: int, amenity: str, category: str) -> None:
+    """
+    removes the unreachable marks of an amenity type in a study area
+    """
+    cursor.execute(
+        _get_delete_amenity_residence_unreachable_sql(),
+        _get_straight_distance_params(study_area_id, amenity, category)
+    )
+
+
+def copy_amenity_residence_unreachable(cursor, records: list[tuple]) -> None:
+    """
+    marks residences without an amenity of a type within `max_distance` of them in bulk using `COPY`;
+    existing marks for the same residence and amenity type are overwritten
+
+    Rows are copied into a temporary table first because `COPY` cannot handle conflicts itself.
+
+    tuple needs to be in the following order:
+        residence_id, amenity_category, amenity_name, max_distance
+    """
+    cursor.execute(f"""
+        CREATE TEMP TABLE IF NOT EXISTS residence_amenity_unreachable_copy
+        (LIKE {TABLES.RES_AMENITY_UNREACHABLE_TBL}) ON COMMIT DELETE ROWS
+    """)
+
+    buffer = get_copy_binary_buffer(records, (COPY_INT4, COPY_TEXT, COPY_TEXT, COPY_FLOAT8))
+    cursor.copy_expert(
+        "COPY residence_amenity_unreachable_copy (residence_id, amenity_category, amenity_name, max_distance) "
+        "FROM STDIN WITH (FORMAT binary)",
+        buffer
+    )
+
+    cursor.execute(f"""
+        INSERT INTO
+            {TABLES.RES_AMENITY_UNREACHABLE_TBL} (residence_id, amenity_category, amenity_name, max_distance)
+        SELECT DISTINCT ON (residence_id, amenity_category, amenity_name)
+            residence_id, amenity_category, amenity_name, max_distance
+        FROM
+            residence_amenity_unreachable_copy
+        ON CONFLICT (residence_id, amenity_category, amenity_name) DO UPDATE SET
+            max_distance = EXCLUDED.max_distance
+    """)
+    # Rows are only deleted on commit, so empty the table for the next amenity type in this transaction
+    cursor.execute("TRUNCATE residence_amenity_unreachable_copy")
+
+
+def _get_amenity_residence_distance_upsert_sql() -> str:
+    return f"""
         INSERT INTO
             {TABLES.RES_AMENITY_DIST_TBL} (distance, time, amenity_id, residence_id, mode)
         VALUES %s
+        ON CONFLICT (residence_id, amenity_id, mode) DO UPDATE SET
+            distance = EXCLUDED.distance, time = EXCLUDED.time
+    """
+
+
+def add_amenity_residence_distance(cursor, records: list[tuple]) -> None:
+    """
+    adds network residence amenity distances; existing distances for the same pair and mode are overwritten
+
+    tuple needs to be in the following order:
+        distance, time, amenity_id, residence_id, mode
     """
+    sql = _get_amenity_residence_distance_upsert_sql()
     execute_values(cursor, sql, records, template=None, page_size=100)
 
 
 async def add_amenity_residence_distance_async(cursor, records: list[tuple]) -> None:
     """
-    adds network residence amenity distances
+    adds network residence amenity distances; existing distances for the same pair and mode are overwritten
 
     tuple needs to be in the following order:
         distance, time, amenity_id, residence_id, mode
     """
-    sql = f"""
+    sql = _get_amenity_residence_distance_upsert_sql()
+    await execute_values_async(cursor, sql, records, template=None, page_size=100)
+
+
+def copy_amenity_residence_distance(cursor, records: list[tuple]) -> None:
+    """
+    adds network residence amenity distances in bulk using `COPY`; existing distances for the same
+    pair and mode are overwritten
+
+    Rows are copied into a temporary table first because `COPY` cannot handle conflicts itself.
+
+    tuple needs to be in the following order:
+        distance, time, amenity_id, residence_id, mode
+    """
+    cursor.execute(f"""
+        CREATE TEMP TABLE IF NOT EXISTS residence_amenity_distances_copy
+        (LIKE {TABLES.RES_AMENITY_DIST_TBL}) ON COMMIT DELETE ROWS
+    """)
+
+    buffer = get_copy_binary_buffer(records, (COPY_FLOAT8, COPY_INT8, COPY_INT4, COPY_INT4, COPY_TEXT))
+    cursor.copy_expert(
+        "COPY residence_amenity_distances_copy (distance, time, amenity_id, residence_id, mode) "
+        "FROM STDIN WITH (FORMAT binary)",
+        buffer
+    )
+
+    cursor.execute(f"""
         INSERT INTO
             {TABLES.RES_AMENITY_DIST_TBL} (distance, time, amenity_id, residence_id, mode)
-        VALUES %s
-    """
-    await execute_values_async(cursor, sql, records, template=None, page_size=100)
+        SELECT DISTINCT ON (residence_id, amenity_id, mode)
+            distance, time, amenity_id, residence_id, mode
+        FROM
+            residence_amenity_distances_copy
+        ON CONFLICT (residence_id, amenity_id, mode) DO UPDATE SET
+            distance = EXCLUDED.distance, time = EXCLUDED.time
+    """)
 
 
 def add_residence_amenity_category_distances(
@@ -341,3 +772,9 @@ def add_residence_amenity_category_distances(
     """
 
     cursor.execute(sql, (mode, study_area_id, study_area_id, mode))
+
+
+def delete_amenity_residence_distance(cursor, mode: str) -> None:
+    """removes all network distances for a mode"""
+    sql = f"DELETE FROM {TABLES.RES_AMENITY_DIST_TBL} WHERE mode = %s"
+    cursor.execute(sql, (mode,))
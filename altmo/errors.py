@@ -9,3 +9,18 @@ CONFIG_ERROR_MSG = (
 
 class AltmoConfigError(Exception):
     pass
+
+
+class ValhallaError(Exception):
+    """Base class for errors returned when talking to a Valhalla server"""
+    pass
+
+
+class ValhallaServerError(ValhallaError):
+    """Transient errors (5xx responses, dropped connections, timeouts); these are worth retrying"""
+    pass
+
+
+class ValhallaRequestError(ValhallaError):
+    """The server rejected our request (4xx responses); retrying will not help"""
+    pass
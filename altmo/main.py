@@ -1,5 +1,6 @@
 import click
 
+from altmo.commands.benchmark import benchmark
 from altmo.commands.build import build
 from altmo.commands.schema import schema
 from altmo.commands.create_study_area import create_study_area
@@ -19,6 +20,7 @@ cli.add_command(create_study_area)
 cli.add_command(network_distances)
 cli.add_command(straight_distance)
 cli.add_command(export)
+cli.add_command(benchmark)
 
 # Only available with optional dependency
 try:
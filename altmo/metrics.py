@@ -0,0 +1,237 @@
+"""
+Counters and histograms describing a running network pipeline.
+
+They are periodically written to a Prometheus textfile (https://github.com/prometheus/node_exporter#textfile-collector)
+or, when the file name ends with ".json", to a JSON status file. A compact progress line can be shown in the
+terminal as well.
+"""
+from __future__ import annotations
+
+import asyncio
+import bisect
+import collections
+import contextlib
+import json
+import os
+import sys
+import time
+from dataclasses import dataclass, field
+from typing import Callable, Iterator
+
+# Upper bounds in seconds of the buckets we sort latencies into
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+# Seconds between two writes of the metrics file and the progress line
+DEFAULT_REPORT_INTERVAL = 1.0
+
+METRICS_PREFIX = 'altmo'
+
+
+class Histogram:
+    """
+    Prometheus style histogram: the number of observations in each bucket plus their count and sum
+    """
+    def __init__(self, buckets: tuple[float, ...] = DEFAULT_BUCKETS):
+        self.buckets = buckets
+        # The last bucket holds everything larger than the largest bound
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value: float) -> None:
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    @contextlib.contextmanager
+    def time(self) -> Iterator[None]:
+        """Observes the number of seconds the block takes"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start)
+
+    def get_percentile(self, percentile: float) -> float:
+        """
+        Estimates the percentile (0-100) by interpolating within the bucket it falls in
+        """
+        if not self.count:
+            return 0.0
+
+        rank = percentile / 100 * self.count
+        seen = 0
+        for idx, count in enumerate(self.counts):
+            if seen + count >= rank and count:
+                lower = self.buckets[idx - 1] if idx > 0 else 0.0
+                if idx == len(self.buckets):
+                    return lower
+                return lower + (self.buckets[idx] - lower) * (rank - seen) / count
+            seen += count
+
+        return self.buckets[-1]
+
+    def get_cumulative_counts(self) -> list[tuple[str, int]]:
+        """Returns (upper bound, count) pairs the way Prometheus expects them"""
+        bounds = [str(bound) for bound in self.buckets] + ['+Inf']
+        cumulative = []
+        total = 0
+        for bound, count in zip(bounds, self.counts):
+            total += count
+            cumulative.append((bound, total))
+        return cumulative
+
+
+@dataclass
+class Metrics:
+    """
+    Everything we measure during a run; the batches in `altmo.batches` update it as they go
+    """
+    requests: int = 0
+    requests_in_flight: int = 0
+    pairs: int = 0
+    cache_hits: int = 0
+    errors: collections.Counter = field(default_factory=collections.Counter)
+    valhalla_latency: Histogram = field(default_factory=Histogram)
+    flush_latency: Histogram = field(default_factory=Histogram)
+    # Callables returning the current size of each queue, registered by the batches owning them
+    queues: dict[str, Callable[[], int]] = field(default_factory=dict)
+    started: float = field(default_factory=time.monotonic)
+
+    @property
+    def elapsed(self) -> float:
+        return time.monotonic() - self.started
+
+    @property
+    def pairs_per_second(self) -> float:
+        return self.pairs / self.elapsed if self.elapsed else 0.0
+
+    def get_queue_depths(self) -> dict[str, int]:
+        return {name: qsize() for name, qsize in self.queues.items()}
+
+    def to_dict(self) -> dict:
+        return {
+            'elapsed_seconds': round(self.elapsed, 3),
+            'requests': self.requests,
+            'requests_in_flight': self.requests_in_flight,
+            'pairs': self.pairs,
+            'pairs_per_second': round(self.pairs_per_second, 1),
+            'cache_hits': self.cache_hits,
+            'errors': dict(self.errors),
+            'queue_depths': self.get_queue_depths(),
+            'valhalla_latency_seconds': {
+                'count': self.valhalla_latency.count,
+                'p50': self.valhalla_latency.get_percentile(50),
+                'p99': self.valhalla_latency.get_percentile(99),
+            },
+            'flush_latency_seconds': {
+                'count': self.flush_latency.count,
+                'p50': self.flush_latency.get_percentile(50),
+                'p99': self.flush_latency.get_percentile(99),
+            },
+        }
+
+    def to_prometheus(self, labels: dict[str, str] = None) -> str:
+        """
+        Returns the metrics in the Prometheus text exposition format
+        """
+        def fmt(name: str, value, extra: dict[str, str] = None) -> str:
+            all_labels = {**(labels or {}), **(extra or {})}
+            label_str = ','.join(f'{key}="{val}"' for key, val in all_labels.items())
+            if label_str:
+                return f'{METRICS_PREFIX}_{name}{{{label_str}}} {value}'
+            return f'{METRICS_PREFIX}_{name} {value}'
+
+        lines = []
+
+        for name, kind, value in (
+            ('requests_total', 'counter', self.requests),
+            ('pairs_total', 'counter', self.pairs),
+            ('cache_hits_total', 'counter', self.cache_hits),
+            ('requests_in_flight', 'gauge', self.requests_in_flight),
+        ):
+            lines += [f'# TYPE {METRICS_PREFIX}_{name} {kind}', fmt(name, value)]
+
+        lines.append(f'# TYPE {METRICS_PREFIX}_errors_total counter')
+        lines += [fmt('errors_total', count, {'type': error}) for error, count in self.errors.items()]
+
+        lines.append(f'# TYPE {METRICS_PREFIX}_queue_depth gauge')
+        lines += [fmt('queue_depth', depth, {'queue': queue}) for queue, depth in self.get_queue_depths().items()]
+
+        for name, histogram in (
+            ('valhalla_latency_seconds', self.valhalla_latency), ('flush_latency_seconds', self.flush_latency)
+        ):
+            lines.append(f'# TYPE {METRICS_PREFIX}_{name} histogram')
+            lines += [fmt(f'{name}_bucket', count, {'le': bound}) for bound, count in histogram.get_cumulative_counts()]
+            lines += [fmt(f'{name}_sum', histogram.sum), fmt(f'{name}_count', histogram.count)]
+
+        return '\n'.join(lines) + '\n'
+
+    def __str__(self):
+        queues = ' '.join(f'{name}={depth}' for name, depth in self.get_queue_depths().items())
+        return (
+            f'{self.pairs:,} pairs ({self.pairs_per_second:,.0f}/s) | '
+            f'{self.requests_in_flight} in flight | queues {queues or "-"} | '
+            f'valhalla p50 {self.valhalla_latency.get_percentile(50) * 1000:.0f}ms '
+            f'p99 {self.valhalla_latency.get_percentile(99) * 1000:.0f}ms | '
+            f'flush p99 {self.flush_latency.get_percentile(99):.2f}s | '
+            f'{sum(self.errors.values())} errors'
+        )
+
+
+class MetricsReporter:
+    """
+    Rewrites `file_name` and the terminal progress line every `interval` seconds while it is running
+    """
+    def __init__(
+        self,
+        metrics: Metrics,
+        file_name: str = None,
+        progress: bool = False,
+        interval: float = DEFAULT_REPORT_INTERVAL,
+        labels: dict[str, str] = None
+    ):
+        self.metrics = metrics
+        self.file_name = file_name
+        self.progress = progress
+        self.interval = interval
+        self.labels = labels
+        self._task = None
+
+    async def __aenter__(self) -> MetricsReporter:
+        self._task = asyncio.create_task(self._run())
+        return self
+
+    async def __aexit__(self, *_) -> None:
+        self._task.cancel()
+        with contextlib.suppress(asyncio.CancelledError):
+            await self._task
+        self.report()
+        if self.progress:
+            sys.stderr.write('\n')
+
+    async def _run(self) -> None:
+        while True:
+            await asyncio.sleep(self.interval)
+            self.report()
+
+    def report(self) -> None:
+        if self.file_name:
+            self.write()
+        if self.progress:
+            sys.stderr.write(f'\r{self.metrics}')
+            sys.stderr.flush()
+
+    def write(self) -> None:
+        """
+        Writes the file in one go, so readers never see half of it
+        """
+        if self.file_name.endswith('.json'):
+            content = json.dumps(self.metrics.to_dict())
+        else:
+            content = self.metrics.to_prometheus(self.labels)
+
+        tmp_file_name = f'{self.file_name}.tmp'
+        with open(tmp_file_name, 'w') as fp:
+            fp.write(content)
+        os.replace(tmp_file_name, self.file_name)
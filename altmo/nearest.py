@@ -0,0 +1,179 @@
+"""
+Nearest neighbour search done in process with NumPy, used by `altmo straight --engine local`.
+
+NumPy is an optional dependency; install it with `pip install altmo[local]`.
+"""
+from __future__ import annotations
+
+import math
+from collections import defaultdict
+
+import numpy as np
+
+
+class GridIndex:
+    """
+    Buckets points into square cells of `cell_size` so that we only have to compare a residence
+    with the points in the cells around it.
+    """
+    def __init__(self, xy: np.ndarray, cell_size: float):
+        self.xy = xy
+        self.cell_size = cell_size
+        self.origin = xy.min(axis=0)
+
+        point_cells = self.get_cells(xy)
+        self.max_cell = point_cells.max(axis=0)
+
+        cells = defaultdict(list)
+        for idx, cell in enumerate(map(tuple, point_cells.tolist())):
+            cells[cell].append(idx)
+        self.cells = {cell: np.array(indices) for cell, indices in cells.items()}
+        self.cell_keys = np.array(list(self.cells), dtype=np.int64)
+        self.cell_points = list(self.cells.values())
+
+    def __len__(self):
+        return len(self.xy)
+
+    @classmethod
+    def from_points(cls, xy: np.ndarray, k: int, query_xy: np.ndarray = None) -> GridIndex:
+        """
+        Sizes the cells so that each holds about `k` points if they were spread evenly.
+
+        When given, the area also covers `query_xy`: points clustered in a small part of the area would
+        otherwise give tiny cells, and the points we query would be spread over far too many of them.
+        """
+        extent = xy if query_xy is None else np.concatenate([xy, query_xy])
+        width, height = extent.max(axis=0) - extent.min(axis=0)
+        area = max(width, 1.0) * max(height, 1.0)
+        return cls(xy, cell_size=math.sqrt(area * k / len(xy)))
+
+    def get_cells(self, xy: np.ndarray) -> np.ndarray:
+        return np.floor((xy - self.origin) / self.cell_size).astype(np.int64)
+
+    def get_start_rings(self, cells: np.ndarray) -> np.ndarray:
+        """
+        Returns the number of cells between each of `cells` and the bounding box of our points; no ring
+        smaller than this can hold any of them
+        """
+        gaps = np.maximum(np.maximum(-cells, cells - self.max_cell), 0)
+        return gaps.max(axis=1)
+
+    def get_candidates(self, cell: tuple[int, int], ring: int) -> np.ndarray:
+        """
+        Returns the indices of all points at most `ring` cells away from `cell`
+        """
+        col, row = cell
+
+        # Once the ring is large, checking the distance of every occupied cell at once is faster than
+        # looking up every cell around us
+        if (2 * ring + 1) ** 2 >= len(self.cells):
+            near = np.abs(self.cell_keys - (col, row)).max(axis=1) <= ring
+            found = [self.cell_points[idx] for idx in np.flatnonzero(near)]
+        else:
+            found = [
+                self.cells[(col + d_col, row + d_row)]
+                for d_col in range(-ring, ring + 1)
+                for d_row in range(-ring, ring + 1)
+                if (col + d_col, row + d_row) in self.cells
+            ]
+        return np.concatenate(found) if found else np.array([], dtype=np.int64)
+
+    def query(self, xy: np.ndarray, k: int) -> tuple[np.ndarray, np.ndarray]:
+        """
+        Finds the `k` nearest points of each point in `xy`.
+
+        :returns: the indices of the nearest points and their distances, both of shape (len(xy), k) and
+                  ordered by distance; when we have fewer than `k` points all of them are returned
+        """
+        k = min(k, len(self.xy))
+        indices = np.empty((len(xy), k), dtype=np.int64)
+        distances = np.empty((len(xy), k), dtype=np.float64)
+
+        query_cells = self.get_cells(xy)
+        cells, inverse = np.unique(query_cells, axis=0, return_inverse=True)
+        start_rings = self.get_start_rings(cells).tolist()
+
+        # Group the points by cell once instead of scanning all of them for every cell
+        inverse = inverse.ravel()
+        order = np.argsort(inverse, kind='stable')
+        groups = np.split(order, np.cumsum(np.bincount(inverse, minlength=len(cells)))[:-1])
+
+        for cell, members, ring in zip(map(tuple, cells.tolist()), groups, start_rings):
+            # Far away from clustered points, growing the ring one cell at a time takes too many steps
+            candidates = self.get_candidates(cell, ring)
+            while len(candidates) < k:
+                ring = ring * 2 if ring else 1
+                candidates = self.get_candidates(cell, ring)
+
+            nearest, nearest_distances = _get_nearest(xy[members], self.xy, candidates, k)
+
+            # A point just outside the cells we looked at can still be closer than the k-th point we
+            # found, so look again as far out as the largest k-th distance reaches
+            reach = math.ceil(nearest_distances[:, -1].max() / self.cell_size)
+            if reach > ring:
+                nearest, nearest_distances = _get_nearest(
+                    xy[members], self.xy, self.get_candidates(cell, reach), k
+                )
+
+            indices[members] = nearest
+            distances[members] = nearest_distances
+
+        return indices, distances
+
+
+def _get_nearest(
+    xy: np.ndarray, targets: np.ndarray, candidates: np.ndarray, k: int
+) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Compares every point in `xy` with every candidate and returns the `k` nearest ones, ordered by distance
+    """
+    # Squared distances rank the same, so the square root is only taken of the `k` we keep
+    candidate_xy = targets[candidates]
+    d_x = xy[:, 0, np.newaxis] - candidate_xy[np.newaxis, :, 0]
+    d_y = xy[:, 1, np.newaxis] - candidate_xy[np.newaxis, :, 1]
+    candidate_distances = d_x * d_x + d_y * d_y
+
+    if k < len(candidates):
+        partition = np.argpartition(candidate_distances, k - 1, axis=1)[:, :k]
+    else:
+        partition = np.broadcast_to(np.arange(len(candidates)), candidate_distances.shape)
+
+    partition_distances = np.take_along_axis(candidate_distances, partition, axis=1)
+    order = np.argsort(partition_distances, axis=1)
+
+    return (
+        candidates[np.take_along_axis(partition, order, axis=1)],
+        np.sqrt(np.take_along_axis(partition_distances, order, axis=1))
+    )
+
+
+def get_nearest_amenities(
+    residence_ids: np.ndarray,
+    residence_xy: np.ndarray,
+    amenity_ids: np.ndarray,
+    amenity_xy: np.ndarray,
+    k: int = 3,
+    max_distance: float = None
+) -> list[tuple[int, int, float]]:
+    """
+    Returns (residence_id, amenity_id, distance) for the `k` nearest amenities of every residence,
+    leaving out amenities further away than `max_distance`.
+
+    Coordinates should be in the projected SRS of the study area, so that the distances match those
+    calculated by `ST_Distance`.
+    """
+    if not len(residence_ids) or not len(amenity_ids):
+        return []
+
+    index = GridIndex.from_points(amenity_xy, k, query_xy=residence_xy)
+    nearest, distances = index.query(residence_xy, k)
+
+    residences = np.repeat(residence_ids, nearest.shape[1])
+    amenities = amenity_ids[nearest].ravel()
+    distances = distances.ravel()
+
+    if max_distance is not None:
+        within = distances <= max_distance
+        residences, amenities, distances = residences[within], amenities[within], distances[within]
+
+    return list(zip(residences.tolist(), amenities.tolist(), distances.tolist()))
@@ -0,0 +1,180 @@
+"""
+Packs residence amenity pairs into many-to-many matrix requests for the Valhalla API
+"""
+from __future__ import annotations
+
+from dataclasses import dataclass, field
+from itertools import groupby, islice
+from typing import AsyncIterable, AsyncIterator, Iterable, Iterator
+
+from altmo.data.types import Point, StraightDistanceRow, NetworkDistanceRow
+
+# Number of residences we look at when packing them into matrix requests
+DEFAULT_PLANNER_WINDOW: int = 1_000
+
+
+@dataclass
+class MatrixRequest:
+    """
+    A single `sources_to_targets` request.
+
+    `sources` and `targets` define the matrix sent to Valhalla, while `pairs` holds the
+    (source index, target index) cells we actually asked for. Valhalla always computes
+    the full matrix, but we only write the cells listed in `pairs`.
+    """
+    sources: list[Point] = field(default_factory=list)
+    targets: list[Point] = field(default_factory=list)
+    pairs: list[tuple[int, int]] = field(default_factory=list)
+
+    def __len__(self):
+        return len(self.pairs)
+
+    @property
+    def size(self) -> int:
+        """Number of cells in the matrix Valhalla has to compute"""
+        return len(self.sources) * len(self.targets)
+
+    def split(self) -> tuple[MatrixRequest, MatrixRequest]:
+        """
+        Splits the request in two halves of its sources, each one only keeping the targets it asks for
+        """
+        middle = len(self.sources) // 2
+        halves = MatrixRequest(sources=self.sources[:middle]), MatrixRequest(sources=self.sources[middle:])
+        target_indexes: tuple[dict[int, int], dict[int, int]] = {}, {}
+
+        for src_idx, tgt_idx in self.pairs:
+            half_idx = 0 if src_idx < middle else 1
+            half, target_index = halves[half_idx], target_indexes[half_idx]
+            if tgt_idx not in target_index:
+                target_index[tgt_idx] = len(half.targets)
+                half.targets.append(self.targets[tgt_idx])
+            half.pairs.append((src_idx - middle * half_idx, target_index[tgt_idx]))
+
+        return halves
+
+    def get_rows(self, matrix: list[list[dict]], costing: str) -> list[NetworkDistanceRow]:
+        """
+        Fans the response matrix back out into one row per requested residence amenity pair
+
+        :raises: KeyError, IndexError
+        """
+        return [
+            NetworkDistanceRow(
+                matrix[src_idx][tgt_idx]['distance'], matrix[src_idx][tgt_idx]['time'],
+                self.targets[tgt_idx].id, self.sources[src_idx].id, costing
+            )
+            for src_idx, tgt_idx in self.pairs
+        ]
+
+
+def group_by_residence(data: Iterable[StraightDistanceRow]) -> Iterator[tuple[Point, list[Point]]]:
+    """
+    Lazily groups `data` by residence(id, lat, lng).
+
+    `data` is expected to be ordered by residence; unordered data still works but produces
+    more (smaller) groups.
+    """
+    def key(row: StraightDistanceRow):
+        return row.residence_id, row.residence_lat, row.residence_lng
+
+    for (res_id, res_lat, res_lng), rows in groupby(data, key=key):
+        yield Point(res_id, res_lat, res_lng), [
+            Point(row.amenity_id, row.amenity_lat, row.amenity_lng) for row in rows
+        ]
+
+
+async def chunk_groups_async(
+    groups: AsyncIterable[tuple[Point, list[Point]]], size: int
+) -> AsyncIterator[AsyncIterator[tuple[Point, list[Point]]]]:
+    """
+    Lazily splits `groups` into chunks of roughly `size` residence amenity pairs, without splitting
+    a residence over two chunks.
+
+    Like `itertools.groupby`, the chunks share the underlying iterator, so each chunk has to be
+    consumed before moving on to the next one.
+    """
+    groups = groups.__aiter__()
+
+    async def chunk(first: tuple[Point, list[Point]]) -> AsyncIterator[tuple[Point, list[Point]]]:
+        group, count = first, 0
+        while True:
+            yield group
+            count += len(group[1])
+            if count >= size:
+                return
+            try:
+                group = await groups.__anext__()
+            except StopAsyncIteration:
+                return
+
+    while True:
+        try:
+            first = await groups.__anext__()
+        except StopAsyncIteration:
+            return
+        yield chunk(first)
+
+
+def plan_matrix_requests(
+    groups: Iterable[tuple[Point, list[Point]]],
+    matrix_limit: int,
+    window: int = DEFAULT_PLANNER_WINDOW
+) -> Iterator[MatrixRequest]:
+    """
+    Packs residences which share target amenities into N×M matrix requests.
+
+    Residences are read `window` at a time and sorted by the amenities they need so that
+    neighbours sharing the same nearest amenities land in the same request. Requests are
+    filled until `len(sources) * len(targets)` would exceed `matrix_limit`. A residence
+    with more amenities than `matrix_limit` is split over several 1×N requests.
+
+    :param groups: residences with the amenities they need routes to
+    :param matrix_limit: maximum number of cells (sources × targets) the server accepts
+    :param window: number of residences considered at once when packing
+    """
+    groups = iter(groups)
+
+    while True:
+        chunk = list(islice(groups, window))
+        if not chunk:
+            return
+
+        chunk.sort(key=lambda grp: sorted(amenity.id for amenity in grp[1]))
+        yield from _pack_requests(chunk, matrix_limit)
+
+
+def _pack_requests(
+    groups: list[tuple[Point, list[Point]]], matrix_limit: int
+) -> Iterator[MatrixRequest]:
+    """Greedily fills matrix requests with `groups`; see `plan_matrix_requests`"""
+    request = MatrixRequest()
+    target_index: dict[int, int] = {}
+
+    for residence, amenities in groups:
+        new_targets = {amenity.id for amenity in amenities if amenity.id not in target_index}
+
+        if (len(request.sources) + 1) * (len(request.targets) + len(new_targets)) > matrix_limit:
+            if request.pairs:
+                yield request
+            request = MatrixRequest()
+            target_index = {}
+
+        if len(amenities) > matrix_limit:
+            for idx in range(0, len(amenities), matrix_limit):
+                targets = amenities[idx:idx + matrix_limit]
+                yield MatrixRequest(
+                    sources=[residence], targets=targets, pairs=[(0, tgt) for tgt in range(len(targets))]
+                )
+            continue
+
+        src_idx = len(request.sources)
+        request.sources.append(residence)
+
+        for amenity in amenities:
+            if amenity.id not in target_index:
+                target_index[amenity.id] = len(request.targets)
+                request.targets.append(amenity)
+            request.pairs.append((src_idx, target_index[amenity.id]))
+
+    if request.pairs:
+        yield request
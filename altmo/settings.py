@@ -2,6 +2,7 @@ import os
 import sys
 from dataclasses import dataclass
 from functools import wraps
+from typing import List, Union
 
 import yaml
 import yaml.parser
@@ -12,6 +13,9 @@ MODE_PEDESTRIAN = "pedestrian"
 MODE_BICYCLE = "bicycle"
 MODE_AUTO = "auto"
 
+# Values of the `building` tag of the residences we calculate distances for
+RESIDENCE_BUILDINGS_SQL = "('yes', 'house', 'residential', 'apartments', 'terrace', 'detached')"
+
 
 @dataclass
 class Config:
@@ -19,7 +23,9 @@ class Config:
     TBL_PREFIX: str = None
     SRS_ID: int = None
     PG_DSN: str = None
-    VALHALLA_SERVER: str = None
+    VALHALLA_SERVER: Union[str, List[str]] = None
+    VALHALLA_MATRIX_LIMIT: int = 2500
+    VALHALLA_CONNECTION_LIMIT: int = 100
     AMENITIES: dict = None
 
     def __post_init__(self):
@@ -61,6 +67,7 @@ class TableNames:
     RES_AMENITY_DIST_TBL: str = "residence_amenity_distances"
     RES_AMENITY_DIST_STR_TBL: str = "residence_amenity_distances_straight"
     RES_AMENITY_CAT_DIST_TBL: str = "residence_amenity_category_distances"
+    RES_AMENITY_UNREACHABLE_TBL: str = "residence_amenity_unreachable"
 
     def __init__(self):
         self.config = None
@@ -3,7 +3,7 @@ from __future__ import annotations
 import json
 from collections import Sequence
 from itertools import islice
-from typing import Iterable
+from typing import AsyncIterable, AsyncIterator, Iterable, Union
 
 from .errors import AltmoConfigError, CONFIG_ERROR_MSG
 
@@ -70,6 +70,13 @@ def get_amenity_category_weights(
         raise AltmoConfigError(CONFIG_ERROR_MSG)
 
 
+def get_amenity_max_distances(config_data: dict[str, dict]) -> dict[str, float]:
+    """
+    Returns the optional maximum straight line distance to an amenity for each category
+    """
+    return config_data.get("max_distance") or {}
+
+
 def get_amenity_categories(config_data: dict[str, dict]) -> dict[str, dict]:
     """
     safely returns the configured amenities. If they are not there then a AltmoConfigError is thrown
@@ -151,3 +158,30 @@ def grouper(iterable: Iterable, size: int) -> Iterable:
     """
     iterable = iter(iterable)
     return iter(lambda: list(islice(iterable, size)), [])
+
+
+async def as_async_iterator(iterable: Union[Iterable, AsyncIterable]) -> AsyncIterator:
+    """
+    Lets us use `async for` on both regular and async iterables
+    """
+    if hasattr(iterable, '__aiter__'):
+        async for item in iterable:
+            yield item
+    else:
+        for item in iterable:
+            yield item
+
+
+async def grouper_async(iterable: Union[Iterable, AsyncIterable], size: int) -> AsyncIterator[list]:
+    """
+    Same as `grouper`, but also accepts async iterables
+    """
+    group = []
+    async for item in as_async_iterator(iterable):
+        group.append(item)
+        if len(group) == size:
+            yield group
+            group = []
+
+    if group:
+        yield group
@@ -4,7 +4,7 @@ import click
 
 from altmo.data.decorators import psycopg2_cur
 from altmo.data.read import get_study_area
-from altmo.settings import MODE_PEDESTRIAN, MODE_BICYCLE
+from altmo.settings import MODE_PEDESTRIAN, MODE_BICYCLE, MODE_AUTO
 
 
 def validate_mode(_, __, value) -> list[str]:
@@ -19,6 +19,23 @@ def validate_mode(_, __, value) -> list[str]:
         return value or None
 
 
+def validate_modes(_, __, value) -> list[str]:
+    """validates a comma separated list of modes, e.g. "pedestrian,bicycle" """
+    available_choices = (MODE_BICYCLE, MODE_PEDESTRIAN, MODE_AUTO)
+    modes = []
+
+    for mode in value.split(','):
+        mode = mode.strip()
+        if mode not in available_choices:
+            raise click.BadParameter(
+                f'"{mode}" is not valid. Choices are {", ".join(available_choices)}'
+            )
+        if mode not in modes:
+            modes.append(mode)
+
+    return modes
+
+
 @psycopg2_cur()
 def validate_study_area(cursor, _, __, value) -> int:
     """validates study_area parameter and returns the study_area_id"""
@@ -45,3 +62,15 @@ def validate_out(_, __, value) -> list[str]:
             )
 
         return value or None
+
+
+def validate_outs(_, __, value) -> tuple[str]:
+    """validates out parameter, which may be passed several times"""
+    available_choices = (OUT_STDOUT, OUT_CSV, OUT_DB)
+    for out in value:
+        if out not in available_choices:
+            raise click.BadParameter(
+                f'"{out}" is not valid. Choices are {", ".join(available_choices)}'
+            )
+
+    return value
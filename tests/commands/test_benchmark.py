@@ -0,0 +1,47 @@
+from click.testing import CliRunner
+
+from altmo.commands.benchmark import benchmark, get_peak_rss, get_synthetic_rows
+from altmo.validators import OUT_STDOUT, OUT_CSV, OUT_DB
+
+
+def test_synthetic_rows():
+    """Rows are ordered by residence and each residence gets the requested number of amenities"""
+    rows = list(get_synthetic_rows(100, 5))
+
+    assert len(rows) == 100
+    assert [row.residence_id for row in rows] == sorted(row.residence_id for row in rows)
+    assert len({row.residence_id for row in rows}) == 20
+
+
+def test_benchmark_stdout_and_csv():
+    """One line is reported for every writer and every pair is written"""
+    runner = CliRunner()
+    result = runner.invoke(
+        benchmark, ['--out', OUT_STDOUT, '--out', OUT_CSV, '--pairs', '1000', '--latency', '0']
+    )
+
+    assert result.exit_code == 0
+    stdout_line, csv_line = result.output.splitlines()
+    assert stdout_line.startswith('stdout: 1000 pairs')
+    assert csv_line.startswith('csv: 1000 pairs')
+    assert 'p99' in csv_line and 'process peak RSS so far' in csv_line
+
+
+def test_peak_rss_is_in_bytes(mocker):
+    """`ru_maxrss` is in kilobytes on Linux and in bytes on macOS"""
+    mocker.patch('altmo.commands.benchmark.resource.getrusage').return_value.ru_maxrss = 2048
+
+    mocker.patch('altmo.commands.benchmark.sys.platform', 'linux')
+    assert get_peak_rss() == 2048 * 1024
+
+    mocker.patch('altmo.commands.benchmark.sys.platform', 'darwin')
+    assert get_peak_rss() == 2048
+
+
+def test_benchmark_db_requires_study_area():
+    """Writing to the database needs real residences and amenities"""
+    runner = CliRunner()
+    result = runner.invoke(benchmark, ['--out', OUT_DB])
+
+    assert result.exit_code == 2
+    assert '--study-area' in result.output
@@ -17,6 +17,11 @@ def test_happy_path(mock_db):
     assert result.exit_code == 0
     assert result.output == ''
 
+    # Schemas created before we stored WGS84 coordinates and sample keys get the new columns
+    executed_sql = [call.args[0] for call in mock_cur.execute.call_args_list]
+    assert len([sql for sql in executed_sql if 'ADD COLUMN IF NOT EXISTS' in sql]) == 5
+    assert any('SET sample_key' in sql for sql in executed_sql)
+
 
 def test_study_area_not_found(mock_db):
     """Test simple invocation"""
@@ -30,3 +35,103 @@ def test_study_area_not_found(mock_db):
 
     assert result.exit_code == 0
     assert result.output == 'study area not found\n'
+
+
+def test_several_study_areas(mock_db):
+    """
+    Each study area is built on its own connection and its amenities are extracted in a single statement
+    """
+    mock_con = mock_db.return_value
+    mock_cur = mock_con.cursor.return_value
+    mock_cur.connection.encoding = 'UTF8'
+    mock_cur.fetchone.side_effect = [(1, 'new_york', 'New York'), (2, 'boston', 'Boston')]
+
+    runner = CliRunner()
+    result = runner.invoke(build, ['new_york', 'boston', '--parallel', '2'])
+
+    assert result.exit_code == 0
+    assert mock_db.call_count == 3
+
+    amenity_calls = [
+        call for call in mock_cur.execute.call_args_list if 'INSERT INTO altmo_amenities (name, geom' in call.args[0]
+    ]
+    assert sorted(call.args[1]['study_area_id'] for call in amenity_calls) == [1, 2]
+    assert 'planet_osm_point' in amenity_calls[0].args[0]
+    assert 'planet_osm_polygon' in amenity_calls[0].args[0]
+
+
+def test_staged(mock_db):
+    """
+    The study area is built in staging tables which are swapped in with a single commit and vacuumed
+    """
+    mock_con = mock_db.return_value
+    mock_cur = mock_con.cursor.return_value
+    mock_cur.connection.encoding = 'UTF8'
+    mock_cur.fetchone.return_value = (1, 'new_york', 'New York study area')
+
+    runner = CliRunner()
+    result = runner.invoke(build, ['new_york', '--staged'])
+
+    assert result.exit_code == 0
+
+    executed_sql = [call.args[0] for call in mock_cur.execute.call_args_list]
+    assert 'CREATE UNLOGGED TABLE altmo_amenities_staging_1' in '\n'.join(executed_sql)
+    assert 'CREATE UNLOGGED TABLE altmo_residences_staging_1' in '\n'.join(executed_sql)
+    assert any('INSERT INTO altmo_residences_staging_1' in sql for sql in executed_sql)
+    assert any('VACUUM (ANALYZE) altmo_amenities' in sql for sql in executed_sql)
+    assert not any('VACUUM (ANALYZE) altmo_residence_amenity' in sql for sql in executed_sql)
+
+    # Nothing is deleted from the real tables until the staging tables are complete
+    first_delete = next(idx for idx, sql in enumerate(executed_sql) if 'DELETE FROM' in sql)
+    sample_keys = next(idx for idx, sql in enumerate(executed_sql) if 'UPDATE altmo_residences_staging_1' in sql)
+    assert first_delete > sample_keys
+
+
+def test_staged_failure_is_rolled_back(mock_db):
+    """
+    A failed build is rolled back, so its staging tables are not committed by the connection context
+    """
+    mock_con = mock_db.return_value
+    mock_cur = mock_con.cursor.return_value
+    mock_cur.connection.encoding = 'UTF8'
+    mock_cur.fetchone.return_value = (1, 'new_york', 'New York study area')
+
+    def execute(sql, *_):
+        if 'INSERT INTO altmo_residences_staging_1' in sql:
+            raise RuntimeError('Out of disk space')
+
+    mock_cur.execute.side_effect = execute
+
+    runner = CliRunner()
+    result = runner.invoke(build, ['new_york', '--staged'])
+
+    assert result.exit_code == 1
+    assert isinstance(result.exception, RuntimeError)
+    mock_cur.connection.rollback.assert_called_once()
+
+
+def test_residence_join_strategy(mock_db):
+    """
+    Residences are found through an index of the (subdivided) residential areas instead of their union
+    """
+    mock_con = mock_db.return_value
+    mock_cur = mock_con.cursor.return_value
+    mock_cur.connection.encoding = 'UTF8'
+    mock_cur.fetchone.return_value = (1, 'new_york', 'New York study area')
+
+    runner = CliRunner()
+    result = runner.invoke(build, ['new_york', '--residence-strategy', 'join', '--subdivide', '64'])
+
+    assert result.exit_code == 0
+
+    executed = [call.args for call in mock_cur.execute.call_args_list]
+    executed_sql = [args[0] for args in executed]
+    assert not any('ST_Union' in sql for sql in executed_sql)
+
+    sql, params = next(args for args in executed if 'CREATE TEMP TABLE pg_temp.residential_areas' in args[0])
+    assert 'ST_Subdivide(pp.way, %(max_vertices)s)' in sql
+    assert params['max_vertices'] == 64
+    assert any('USING GIST (way)' in sql for sql in executed_sql)
+
+    insert_sql = next(sql for sql in executed_sql if 'INSERT INTO altmo_residences' in sql)
+    assert 'EXISTS' in insert_sql
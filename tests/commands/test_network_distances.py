@@ -1,41 +1,69 @@
-# import os
-from unittest.mock import AsyncMock, patch
+import json
+import os
+from unittest.mock import AsyncMock, MagicMock, patch
 
 import pytest
 from click.testing import CliRunner
 
 from altmo.commands.network_distances import network_distances
-from altmo.validators import OUT_STDOUT, OUT_CSV
+from altmo.validators import OUT_STDOUT, OUT_CSV, OUT_DB
 from tests.fixtures.straight_distance import STRAIGHT_DISTANCE
-from tests.fixtures.valhalla import VALHALLA_MATRIX_RESPONSE
+from tests.fixtures.valhalla import get_matrix_response
 
 
 @pytest.fixture()
-def mock_cur_straight_dist(mock_cur_study_area):
+def mock_cur_straight_dist(mock_cur_study_area, mocker):
     """
     Sets up our mock cursor with a couple of return values we will need for multiple tests.
+
+    Straight distances are read through an aiopg pool, so its cursor returns them as well.
     """
     mock_cur_study_area.fetchall.return_value = STRAIGHT_DISTANCE
 
+    mock_async_cur = MagicMock()
+    mock_async_cur.execute = AsyncMock()
+    mock_async_cur.fetchall = AsyncMock(return_value=STRAIGHT_DISTANCE)
+    mock_conn = MagicMock()
+    mock_conn.cursor.return_value.__aenter__.return_value = mock_async_cur
+    mock_pool = MagicMock()
+    mock_pool.acquire.return_value.__aenter__.return_value = mock_conn
+    mock_create_pool = mocker.patch('altmo.data.decorators.aiopg.create_pool', new_callable=MagicMock)
+    mock_create_pool.return_value.__aenter__.return_value = mock_pool
+    mock_cur_study_area.async_cursor = mock_async_cur
+
     return mock_cur_study_area
 
 
-def test_happy_path_out_csv(mock_cur_straight_dist):
+async def mock_post_matrix(*_, json=None, **__):
     """
-    Happy path setting --out to "stdout"
+    Answers each matrix request with a matrix of the same shape
     """
-    with patch('altmo.api.valhalla.aiohttp.ClientSession.post', AsyncMock()) as mock_post:
-        valhalla_mock_resp = AsyncMock(return_value=VALHALLA_MATRIX_RESPONSE)
-        mock_post.return_value.json = valhalla_mock_resp
+    resp = MagicMock()
+    resp.json = AsyncMock(return_value=get_matrix_response(json))
+    return resp
 
-        runner = CliRunner()
 
-        with runner.isolated_filesystem():
-            filename = 'test-out.csv'
-            result = runner.invoke(network_distances, ['new_york', '--out', OUT_CSV, '--file-name', filename])
+@pytest.fixture()
+def mock_valhalla_post():
+    """
+    Mocks the Valhalla API using `mock_post_matrix`
+    """
+    with patch('altmo.api.valhalla.aiohttp.ClientSession.post', AsyncMock(side_effect=mock_post_matrix)) as mock_post:
+        yield mock_post
 
-            assert result.exit_code == 0
-            assert result.output == ''
+
+def test_happy_path_out_csv(mock_cur_straight_dist, mock_valhalla_post):
+    """
+    Happy path setting --out to "stdout"
+    """
+    runner = CliRunner()
+
+    with runner.isolated_filesystem():
+        filename = 'test-out.csv'
+        result = runner.invoke(network_distances, ['new_york', '--out', OUT_CSV, '--file-name', filename])
+
+        assert result.exit_code == 0
+        assert result.output == ''
 
         # cur_dir = os.listdir('./')
         # for filename in cur_dir:
@@ -43,17 +71,344 @@ def test_happy_path_out_csv(mock_cur_straight_dist):
         #         assert len(list(fp)) == 10
 
 
-def test_happy_path_out_stdout(mock_cur_straight_dist):
+def test_happy_path_out_stdout(mock_cur_straight_dist, mock_valhalla_post):
     """
     Happy path setting --out to "csv"
     """
-    with patch('altmo.api.valhalla.aiohttp.ClientSession.post', AsyncMock()) as mock_post:
-        valhalla_mock_resp = AsyncMock(return_value=VALHALLA_MATRIX_RESPONSE)
-        # Mocks the pool async context manager and the session context manager
-        mock_post.return_value.json = valhalla_mock_resp
+    runner = CliRunner()
+    result = runner.invoke(network_distances, ['new_york', '--out', OUT_STDOUT])
+
+    assert result.exit_code == 0
+    assert len(result.output.splitlines()) == len(STRAIGHT_DISTANCE)
+
+
+def test_matrix_requests_are_packed(mock_cur_straight_dist, mock_valhalla_post):
+    """
+    Residences sharing the same amenities should be routed in a single matrix request
+    """
+    runner = CliRunner()
+    result = runner.invoke(network_distances, ['new_york', '--out', OUT_STDOUT])
+
+    assert result.exit_code == 0
+    assert mock_valhalla_post.call_count == 1
+
+
+def test_several_modes_in_one_pass(mock_cur_straight_dist, mock_valhalla_post):
+    """
+    Pairs are read once and routed for every mode, with each row written with its own mode
+    """
+    runner = CliRunner()
+    result = runner.invoke(network_distances, ['new_york', '--out', OUT_STDOUT, '--mode', 'pedestrian,bicycle'])
+
+    assert result.exit_code == 0
+    assert mock_cur_straight_dist.async_cursor.execute.call_count == 1
+    assert mock_valhalla_post.call_count == 2
+
+    modes = [line.split(',')[-1] for line in result.output.splitlines()]
+    assert modes.count('pedestrian') == modes.count('bicycle') == len(STRAIGHT_DISTANCE)
+
+
+def test_invalid_mode(mock_cur_straight_dist):
+    """
+    Every mode in the list is validated
+    """
+    runner = CliRunner()
+    result = runner.invoke(network_distances, ['new_york', '--mode', 'pedestrian,boat'])
+
+    assert result.exit_code == 2
+    assert '"boat" is not valid' in result.output
+
+
+def test_concurrency_option(mock_cur_straight_dist, mock_valhalla_post):
+    """
+    Running with a custom worker pool size
+    """
+    runner = CliRunner()
+    result = runner.invoke(network_distances, ['new_york', '--out', OUT_STDOUT, '--concurrency', '2'])
 
+    assert result.exit_code == 0
+    assert len(result.output.splitlines()) == len(STRAIGHT_DISTANCE)
+
+
+@pytest.fixture()
+def mock_no_backoff(mocker):
+    """Removes the delay between retries"""
+    mocker.patch('altmo.batches.get_backoff', return_value=0)
+
+
+def test_failed_requests_are_retried(mock_cur_straight_dist, mock_no_backoff):
+    """
+    A request failing with a malformed response is retried and eventually succeeds
+    """
+    responses = iter([{'error': 'Internal server error'}])
+
+    async def post(*_, json=None, **__):
+        resp = MagicMock()
+        resp.json = AsyncMock(return_value=next(responses, None) or get_matrix_response(json))
+        return resp
+
+    with patch('altmo.api.valhalla.aiohttp.ClientSession.post', AsyncMock(side_effect=post)) as mock_post:
         runner = CliRunner()
         result = runner.invoke(network_distances, ['new_york', '--out', OUT_STDOUT])
 
         assert result.exit_code == 0
-        assert result.output != ''
+        assert mock_post.call_count == 2
+        assert len(result.output.splitlines()) == len(STRAIGHT_DISTANCE)
+
+
+def test_failed_requests_are_replayed(mock_cur_straight_dist, mock_no_backoff):
+    """
+    Requests failing every retry are written to the dead letter file and can be replayed from there
+    """
+    async def failing_post(*_, **__):
+        resp = MagicMock()
+        resp.json = AsyncMock(return_value={'error': 'Internal server error'})
+        return resp
+
+    runner = CliRunner()
+
+    with runner.isolated_filesystem():
+        with patch('altmo.api.valhalla.aiohttp.ClientSession.post', AsyncMock(side_effect=failing_post)):
+            result = runner.invoke(network_distances, ['new_york', '--out', OUT_STDOUT, '--retries', '1'])
+
+            assert result.exit_code == 0
+            assert result.output == ''
+            assert os.path.exists('failed.jsonl')
+
+        with patch('altmo.api.valhalla.aiohttp.ClientSession.post', AsyncMock(side_effect=mock_post_matrix)):
+            result = runner.invoke(network_distances, ['new_york', '--out', OUT_STDOUT, '--replay-failed'])
+
+            assert result.exit_code == 0
+            assert len(result.output.splitlines()) == len(STRAIGHT_DISTANCE)
+            assert not os.path.exists('failed.jsonl')
+
+
+def test_rejected_requests_are_split(mock_cur_straight_dist, mock_no_backoff):
+    """
+    A request rejected by Valhalla is split until only the residence it does not accept is dead lettered
+    """
+    rejected = STRAIGHT_DISTANCE[0]
+
+    async def rejecting_post(*_, json=None, **__):
+        if {'lat': rejected.residence_lat, 'lon': rejected.residence_lng} in json['sources']:
+            resp = MagicMock(ok=False, status=400)
+            resp.text = AsyncMock(return_value='No path could be found for input')
+            return resp
+        return await mock_post_matrix(json=json)
+
+    runner = CliRunner()
+
+    with runner.isolated_filesystem():
+        with patch('altmo.api.valhalla.aiohttp.ClientSession.post', AsyncMock(side_effect=rejecting_post)):
+            result = runner.invoke(network_distances, ['new_york', '--out', OUT_STDOUT])
+
+            assert result.exit_code == 0
+            rejected_rows = [row for row in STRAIGHT_DISTANCE if row.residence_id == rejected.residence_id]
+            assert len(result.output.splitlines()) == len(STRAIGHT_DISTANCE) - len(rejected_rows)
+
+        with open('failed.jsonl') as fp:
+            entries = [json.loads(line) for line in fp]
+        assert [res['id'] for entry in entries for res in entry['residences']] == [rejected.residence_id]
+
+
+def test_unfinished_replay_is_replayed_again(mock_cur_straight_dist, mock_no_backoff):
+    """
+    Requests left behind by a replay which did not finish are replayed along with the newly failed ones,
+    and with --out=csv each mode writes its own files
+    """
+    async def failing_post(*_, **__):
+        resp = MagicMock()
+        resp.json = AsyncMock(return_value={'error': 'Internal server error'})
+        return resp
+
+    runner = CliRunner()
+
+    with runner.isolated_filesystem():
+        with patch('altmo.api.valhalla.aiohttp.ClientSession.post', AsyncMock(side_effect=failing_post)):
+            result = runner.invoke(
+                network_distances, ['new_york', '--out', OUT_STDOUT, '--retries', '0', '--mode', 'pedestrian']
+            )
+            assert result.exit_code == 0
+            os.replace('failed.jsonl', 'failed.jsonl.replay')
+
+            result = runner.invoke(
+                network_distances, ['new_york', '--out', OUT_STDOUT, '--retries', '0', '--mode', 'bicycle']
+            )
+            assert result.exit_code == 0
+
+        with patch('altmo.api.valhalla.aiohttp.ClientSession.post', AsyncMock(side_effect=mock_post_matrix)):
+            result = runner.invoke(network_distances, ['new_york', '--out', OUT_CSV, '--replay-failed'])
+
+            assert result.exit_code == 0
+            assert sorted(os.listdir('.')) == ['1-bicycle-out.csv', '1-pedestrian-out.csv']
+
+
+def test_resume_skips_stored_pairs(mock_cur_straight_dist, mock_valhalla_post):
+    """
+    With --resume, pairs which already have a network distance for the mode are excluded by the query
+    """
+    runner = CliRunner()
+    result = runner.invoke(network_distances, ['new_york', '--out', OUT_STDOUT, '--resume', '--mode', 'bicycle'])
+
+    assert result.exit_code == 0
+
+    sql, params = mock_cur_straight_dist.async_cursor.execute.call_args.args
+    assert 'AND (NOT EXISTS (' in sql
+    assert 'd.mode = %(missing_mode_0)s' in sql
+    assert params['missing_mode_0'] == 'bicycle'
+
+
+def test_fetch_size(mock_cur_straight_dist, mock_valhalla_post):
+    """
+    --fetch-size sets the number of pairs read from the database at a time
+    """
+    runner = CliRunner()
+    result = runner.invoke(network_distances, ['new_york', '--out', OUT_STDOUT, '--fetch-size', '1000'])
+
+    assert result.exit_code == 0
+
+    _, params = mock_cur_straight_dist.async_cursor.execute.call_args.args
+    assert params['limit'] == 1000
+
+
+def test_sample_uses_sample_key(mock_cur_straight_dist, mock_valhalla_post):
+    """
+    --sample selects residences by their precomputed sample key instead of their id
+    """
+    mock_cur_straight_dist.fetchone.side_effect = [(1, 'new_york', 'New York study area'), (False,)]
+    runner = CliRunner()
+    result = runner.invoke(network_distances, ['new_york', '--out', OUT_STDOUT, '--sample', '4'])
+
+    assert result.exit_code == 0
+
+    sql, params = mock_cur_straight_dist.async_cursor.execute.call_args.args
+    assert 'r.sample_key < %(sample_fraction)s' in sql
+    assert params['sample_fraction'] == 0.25
+
+
+def test_sample_without_sample_keys(mock_cur_straight_dist, mock_valhalla_post):
+    """
+    Study areas built before sample keys existed would match nothing, so --sample asks for a rebuild instead
+    """
+    mock_cur_straight_dist.fetchone.side_effect = [(1, 'new_york', 'New York study area'), (True,)]
+    runner = CliRunner()
+    result = runner.invoke(network_distances, ['new_york', '--out', OUT_STDOUT, '--sample', '4'])
+
+    assert result.exit_code == 1
+    assert 'altmo build' in result.output
+    mock_valhalla_post.assert_not_called()
+
+
+def test_cached_routes_are_not_requested_again(mock_cur_straight_dist, mock_valhalla_post):
+    """
+    A second run using the same cache file should not send any requests to Valhalla
+    """
+    runner = CliRunner()
+
+    with runner.isolated_filesystem():
+        args = ['new_york', '--out', OUT_STDOUT, '--cache-file', 'cache.sqlite', '--cache-stats']
+        result = runner.invoke(network_distances, args)
+
+        assert result.exit_code == 0
+        assert mock_valhalla_post.call_count == 1
+
+        result = runner.invoke(network_distances, args)
+
+        assert result.exit_code == 0
+        assert mock_valhalla_post.call_count == 1
+        assert f'Route cache: {len(STRAIGHT_DISTANCE)} hits, 0 misses' in result.output
+        rows = [line for line in result.output.splitlines() if not line.startswith('Route cache')]
+        assert len(rows) == len(STRAIGHT_DISTANCE)
+
+
+def test_happy_path_out_db(mock_cur_straight_dist, mock_valhalla_post):
+    """
+    Rows are coalesced and written to the database with a single binary COPY
+    """
+    runner = CliRunner()
+    result = runner.invoke(network_distances, ['new_york', '--out', OUT_DB])
+
+    assert result.exit_code == 0
+    assert mock_cur_straight_dist.copy_expert.call_count == 1
+
+    sql, buffer = mock_cur_straight_dist.copy_expert.call_args.args
+    assert 'FORMAT binary' in sql
+    assert buffer.getvalue().startswith(b'PGCOPY\n\xff\r\n\x00')
+
+
+def test_workers_out_csv(mock_cur_straight_dist, mock_valhalla_post):
+    """
+    With --workers, each worker process writes its own CSV files
+    """
+    mock_cur_straight_dist.fetchone.side_effect = [
+        (1, 'new_york', 'New York study area'),
+        ([{'Plan': {'Plan Rows': len(STRAIGHT_DISTANCE)}}],)
+    ]
+    runner = CliRunner()
+
+    with runner.isolated_filesystem():
+        result = runner.invoke(network_distances, ['new_york', '--out', OUT_CSV, '--workers', '2'])
+
+        assert result.exit_code == 0
+        assert sorted(os.listdir('.')) == ['1-worker1-out.csv', '1-worker2-out.csv']
+
+    # Progress is based on the planner's estimate instead of a count(*)
+    sql, _ = mock_cur_straight_dist.execute.call_args.args
+    assert sql.startswith('EXPLAIN')
+    assert 'count(*)' not in sql
+
+
+def test_workers_dead_letter_files(mock_cur_straight_dist, mock_no_backoff):
+    """
+    With --workers, each worker process saves its failed requests in its own dead letter file
+    """
+    async def failing_post(*_, **__):
+        resp = MagicMock()
+        resp.json = AsyncMock(return_value={'error': 'Internal server error'})
+        return resp
+
+    mock_cur_straight_dist.fetchone.side_effect = [
+        (1, 'new_york', 'New York study area'),
+        ([{'Plan': {'Plan Rows': len(STRAIGHT_DISTANCE)}}],)
+    ]
+    runner = CliRunner()
+
+    with runner.isolated_filesystem():
+        with patch('altmo.api.valhalla.aiohttp.ClientSession.post', AsyncMock(side_effect=failing_post)):
+            result = runner.invoke(
+                network_distances, ['new_york', '--out', OUT_STDOUT, '--workers', '2', '--retries', '0']
+            )
+
+        assert result.exit_code == 0
+        assert sorted(os.listdir('.')) == ['worker1-failed.jsonl', 'worker2-failed.jsonl']
+
+
+def test_replay_failed_with_workers(mock_cur_straight_dist):
+    """
+    Replays run in a single process, so --workers is rejected instead of being ignored
+    """
+    runner = CliRunner()
+    result = runner.invoke(network_distances, ['new_york', '--replay-failed', '--workers', '2'])
+
+    assert result.exit_code == 2
+    assert '--workers cannot be used with --replay-failed' in result.output
+
+
+def test_metrics_file(mock_cur_straight_dist, mock_valhalla_post):
+    """
+    Metrics are written to a JSON status file when the file name ends with ".json"
+    """
+    runner = CliRunner()
+
+    with runner.isolated_filesystem():
+        result = runner.invoke(network_distances, ['new_york', '--out', OUT_DB, '--metrics-file', 'status.json'])
+
+        assert result.exit_code == 0
+        with open('status.json') as fp:
+            status = json.load(fp)
+
+    assert status['pairs'] == len(STRAIGHT_DISTANCE)
+    assert status['requests'] == mock_valhalla_post.call_count
+    assert status['requests_in_flight'] == 0
+    assert status['flush_latency_seconds']['count'] == 1
+    assert status['errors'] == {}
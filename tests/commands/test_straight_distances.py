@@ -0,0 +1,154 @@
+from unittest.mock import AsyncMock, MagicMock
+
+import pytest
+from click.testing import CliRunner
+
+import altmo.settings
+from altmo.commands.straight_distances import straight_distance
+from tests.fixtures.config_data import CONFIG_DATA
+
+
+@pytest.fixture()
+def mock_async_cur(mock_cur_study_area, mocker):
+    """
+    Replaces the aiopg pool the straight distances are written with and returns its cursor
+    """
+    mock_cur_study_area.fetchall.side_effect = [
+        [('supermarket', 'shopping'), ('school', 'education')],
+        [(1, 500), (501, 1000), (1001, 1200), (1201, 1300)],
+    ]
+
+    mock_cur = MagicMock()
+    mock_cur.execute = AsyncMock()
+    mock_conn = MagicMock()
+    mock_conn.cursor.return_value.__aenter__.return_value = mock_cur
+    mock_pool = MagicMock()
+    mock_pool.acquire.return_value.__aenter__.return_value = mock_conn
+    mock_create_pool = mocker.patch('altmo.data.decorators.aiopg.create_pool', new_callable=MagicMock)
+    mock_create_pool.return_value.__aenter__.return_value = mock_pool
+    mock_cur.create_pool = mock_create_pool
+
+    return mock_cur
+
+
+def test_knn_strategy_is_default(mock_async_cur):
+    """
+    Nearest amenities are looked up per residence through the spatial index
+    """
+    runner = CliRunner()
+    result = runner.invoke(straight_distance, ['new_york'])
+
+    assert result.exit_code == 0
+    # Every amenity type is split into residence ranges; without a max_distance the unreachable marks are left alone
+    assert mock_async_cur.execute.call_count == 8
+    assert not any('DELETE' in call.args[0] for call in mock_async_cur.execute.call_args_list)
+
+    sql, params = mock_async_cur.execute.call_args_list[0].args
+    assert 'ORDER BY\n            am.geom <-> re.geom\n        LIMIT 3' in sql
+    assert 'rank()' not in sql
+    assert 'AND re.id BETWEEN %(residence_min_id)s AND %(residence_max_id)s' in sql
+    assert 'ST_DWithin' not in sql
+    assert params == {
+        'study_area_id': 1, 'amenity': 'supermarket', 'category': 'shopping',
+        'residence_min_id': 1, 'residence_max_id': 500
+    }
+
+    # All of them share one pool
+    assert mock_async_cur.create_pool.call_count == 1
+
+
+def test_rank_strategy(mock_async_cur):
+    runner = CliRunner()
+    result = runner.invoke(straight_distance, ['new_york', '--strategy', 'rank'])
+
+    assert result.exit_code == 0
+    sql, _ = mock_async_cur.execute.call_args_list[0].args
+    assert 'rank()' in sql
+
+
+def test_max_distance(mock_async_cur, mocker):
+    """
+    Amenities are only searched within the `max_distance` of their category and residences without any are
+    marked as unreachable
+    """
+    amenities = {**CONFIG_DATA['AMENITIES'], 'max_distance': {'shopping': 2000}}
+    mocker.patch.object(altmo.settings._CONFIG, 'AMENITIES', amenities)
+
+    runner = CliRunner()
+    result = runner.invoke(straight_distance, ['new_york'])
+
+    assert result.exit_code == 0
+
+    # The unreachable marks of each "shopping" range are replaced after its distances are added
+    assert mock_async_cur.execute.call_count == 16
+    queries = [call.args for call in mock_async_cur.execute.call_args_list]
+    shopping_queries = [(sql, params) for sql, params in queries if params['category'] == 'shopping']
+
+    sql, _ = shopping_queries[0]
+    assert 'DELETE FROM altmo_residence_amenity_unreachable' in sql
+
+    sql, params = shopping_queries[1]
+    assert 'ST_DWithin(am.geom, re.geom, %(max_distance)s)' in sql
+    assert params['max_distance'] == 2000
+
+    sql, _ = shopping_queries[2]
+    assert 'residence_amenity_unreachable' in sql
+    assert 'NOT EXISTS' in sql
+
+
+def test_study_area_not_found(mock_db):
+    mock_db.return_value.cursor.return_value.fetchone.return_value = None
+
+    runner = CliRunner()
+    result = runner.invoke(straight_distance, ['new_york'])
+
+    assert result.exit_code == 1
+    assert result.output == 'study area not found\n'
+
+
+def test_local_engine(mock_cur_study_area):
+    """
+    Nearest amenities are calculated in process and written back with COPY, one amenity type at a time
+    """
+    pytest.importorskip('numpy')
+    mock_cur_study_area.fetchall.side_effect = [
+        [(10, 0.0, 0.0), (11, 100.0, 0.0)],
+        [(1, 'supermarket', 'shopping', 1.0, 0.0), (2, 'school', 'education', 90.0, 0.0)],
+    ]
+
+    runner = CliRunner()
+    result = runner.invoke(straight_distance, ['new_york', '--engine', 'local'])
+
+    assert result.exit_code == 0
+    assert mock_cur_study_area.copy_expert.call_count == 2
+    assert not any('DELETE' in call.args[0] for call in mock_cur_study_area.execute.call_args_list)
+
+    sql, buffer = mock_cur_study_area.copy_expert.call_args.args
+    assert 'FORMAT binary' in sql
+    assert buffer.getvalue().startswith(b'PGCOPY\n\xff\r\n\x00')
+
+
+def test_local_engine_max_distance(mock_cur_study_area, mocker):
+    """
+    Unreachable marks of each amenity type are replaced, so that rerunning with another max_distance works
+    """
+    pytest.importorskip('numpy')
+    amenities = {**CONFIG_DATA['AMENITIES'], 'max_distance': {'shopping': 10}}
+    mocker.patch.object(altmo.settings._CONFIG, 'AMENITIES', amenities)
+    mock_cur_study_area.fetchall.side_effect = [
+        [(10, 0.0, 0.0), (11, 100.0, 0.0)],
+        [(1, 'supermarket', 'shopping', 1.0, 0.0)],
+    ]
+
+    runner = CliRunner()
+    result = runner.invoke(straight_distance, ['new_york', '--engine', 'local'])
+
+    assert result.exit_code == 0
+
+    queries = [call.args[0] for call in mock_cur_study_area.execute.call_args_list]
+    delete_idx = next(idx for idx, sql in enumerate(queries) if 'DELETE FROM altmo_residence_amenity' in sql)
+    upsert_idx = next(idx for idx, sql in enumerate(queries) if 'ON CONFLICT' in sql)
+    assert delete_idx < upsert_idx
+
+    sql, _ = mock_cur_study_area.copy_expert.call_args.args
+    assert sql.startswith('COPY residence_amenity_unreachable_copy')
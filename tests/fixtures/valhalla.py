@@ -389,3 +389,24 @@ VALHALLA_MATRIX_RESPONSE = {
   ],
   "units": "kilometers"
 }
+
+
+def get_matrix_response(json: dict) -> dict:
+    """
+    Builds a response shaped like the matrix request in `json` by reusing the
+    cells in `VALHALLA_MATRIX_RESPONSE`
+    """
+    [cells] = VALHALLA_MATRIX_RESPONSE['sources_to_targets']
+
+    return {
+        'sources': [json['sources']],
+        'targets': [json['targets']],
+        'sources_to_targets': [
+            [
+                {**cells[tgt_idx % len(cells)], 'from_index': src_idx, 'to_index': tgt_idx}
+                for tgt_idx in range(len(json['targets']))
+            ]
+            for src_idx in range(len(json['sources']))
+        ],
+        'units': 'kilometers'
+    }
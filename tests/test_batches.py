@@ -0,0 +1,43 @@
+import asyncio
+
+import pytest
+
+from altmo.batches import ReaderBatch, WriterBatch, batch_manager
+
+
+class ListReaderBatch(ReaderBatch):
+    """
+    Puts every item of `items` on the queue
+    """
+    def __init__(self, items):
+        self.items = items
+        self._producers = []
+
+    def register(self, queue: asyncio.Queue) -> None:
+        self._producers = [asyncio.create_task(self.produce(queue))]
+
+    async def produce(self, queue: asyncio.Queue) -> None:
+        for item in self.items:
+            await queue.put(item)
+
+
+class FailingWriterBatch(WriterBatch):
+    """
+    Fails on the first item it receives
+    """
+    async def consume(self, queue: asyncio.Queue) -> None:
+        await queue.get()
+        raise ValueError('Disk full')
+
+
+def test_writer_error_is_raised():
+    """
+    A failing writer stops the run with its error instead of leaving the readers waiting on a full queue
+    """
+    run = batch_manager(ListReaderBatch(range(10)), FailingWriterBatch(), queue_size=1)
+
+    async def main():
+        await asyncio.wait_for(run(), timeout=5)
+
+    with pytest.raises(ValueError, match='Disk full'):
+        asyncio.run(main())
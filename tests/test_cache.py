@@ -0,0 +1,48 @@
+from altmo.api.cache import RouteCache
+from altmo.data.types import Point
+from altmo.planner import MatrixRequest
+
+from tests.fixtures.valhalla import get_matrix_response
+
+
+def get_request(source_ids: list[int], target_ids: list[int]) -> MatrixRequest:
+    sources = [Point(src_id, 1.0 + src_id, 1.0) for src_id in source_ids]
+    targets = [Point(tgt_id, 2.0, 2.0 + tgt_id) for tgt_id in target_ids]
+    return MatrixRequest(
+        sources=sources, targets=targets,
+        pairs=[(src_idx, tgt_idx) for src_idx in range(len(sources)) for tgt_idx in range(len(targets))]
+    )
+
+
+def put(cache: RouteCache, request: MatrixRequest) -> None:
+    json_data = {'sources': [{}] * len(request.sources), 'targets': [{}] * len(request.targets)}
+    cache.put(request, get_matrix_response(json_data)['sources_to_targets'], 'pedestrian')
+
+
+def test_split_returns_cache_misses(tmp_path):
+    """Cached pairs of a window are passed to `on_hit`, the others are returned to be routed"""
+    cache = RouteCache(str(tmp_path / 'cache.sqlite'))
+    put(cache, get_request([1], [10, 11]))
+
+    request = get_request([1, 2], [10, 11])
+    groups = [(source, request.targets) for source in request.sources]
+    hits = []
+    missing = cache.split(groups, 'pedestrian', on_hit=hits.extend)
+
+    assert sorted((row.residence_id, row.amenity_id) for row in hits) == [(1, 10), (1, 11)]
+    assert [(residence.id, [amenity.id for amenity in amenities]) for residence, amenities in missing] == [
+        (2, [10, 11])
+    ]
+    assert (cache.stats.hits, cache.stats.misses) == (2, 2)
+
+
+def test_size_is_shared_between_processes(tmp_path):
+    """Caches sharing a file see each other's routes when deciding what to evict"""
+    file_name = str(tmp_path / 'cache.sqlite')
+    first, second = RouteCache(file_name, max_size=5), RouteCache(file_name, max_size=5)
+
+    put(first, get_request([1], [10, 11, 12]))
+    put(second, get_request([2], [10, 11, 12]))
+
+    assert first.size == second.size == 5
+    assert RouteCache(file_name).size == 5
@@ -0,0 +1,29 @@
+from altmo.data.columns import PairColumns
+from altmo.data.types import StraightDistanceRow
+from altmo.planner import group_by_residence
+
+from tests.fixtures.straight_distance import STRAIGHT_DISTANCE
+
+
+def get_rows(num_residences: int, num_amenities: int) -> list[StraightDistanceRow]:
+    return [
+        StraightDistanceRow(res_id, amt_id, 1.0 + res_id, 2.0, 3.0 + amt_id, 4.0)
+        for res_id in range(1, num_residences + 1)
+        for amt_id in range(1, num_amenities + 1)
+    ]
+
+
+def test_groups_match_group_by_residence():
+    """Columns give us the same groups as grouping the rows themselves"""
+    columns = PairColumns.from_rows(STRAIGHT_DISTANCE)
+
+    assert len(columns) == len(STRAIGHT_DISTANCE)
+    assert list(columns.groups()) == list(group_by_residence(STRAIGHT_DISTANCE))
+
+
+def test_bytes_per_pair():
+    """Pairs take 20 bytes each plus 28 bytes for every residence"""
+    columns = PairColumns.from_rows(get_rows(10, 5))
+
+    assert columns.residence_count == 10
+    assert columns.nbytes == 50 * 20 + 10 * 28
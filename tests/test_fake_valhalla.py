@@ -0,0 +1,46 @@
+import asyncio
+
+import pytest
+
+from altmo.api.fake_valhalla import FakeValhallaOptions, fake_valhalla_server
+from altmo.api.valhalla import ValhallaServer, get_matrix_request
+from altmo.data.types import Point
+from altmo.errors import ValhallaRequestError, ValhallaServerError
+
+SOURCES = [Point(1, 59.32, 18.10), Point(2, 59.33, 18.11)]
+TARGETS = [Point(3, 59.34, 18.07), Point(4, 59.31, 18.09), Point(5, 59.31, 18.06)]
+
+
+def post_matrix(url: str, sources: list[Point], targets: list[Point]) -> dict:
+    async def post():
+        server = ValhallaServer(url)
+        try:
+            return await server.post('/sources_to_targets', json=get_matrix_request(sources, targets))
+        finally:
+            await server.close()
+
+    return asyncio.run(post())
+
+
+def test_fake_server_answers_matrix():
+    """The response has one cell for every source and target"""
+    with fake_valhalla_server(FakeValhallaOptions(latency=0)) as url:
+        resp = post_matrix(url, SOURCES, TARGETS)
+
+    matrix = resp['sources_to_targets']
+    assert [len(row) for row in matrix] == [3, 3]
+    assert all(cell['distance'] > 0 and cell['time'] > 0 for row in matrix for cell in row)
+
+
+def test_fake_server_matrix_limit():
+    """Matrices larger than the limit are rejected"""
+    with fake_valhalla_server(FakeValhallaOptions(latency=0, matrix_limit=4)) as url:
+        with pytest.raises(ValhallaRequestError):
+            post_matrix(url, SOURCES, TARGETS)
+
+
+def test_fake_server_errors():
+    """With an error rate of 1 every request fails"""
+    with fake_valhalla_server(FakeValhallaOptions(latency=0, error_rate=1)) as url:
+        with pytest.raises(ValhallaServerError):
+            post_matrix(url, SOURCES, TARGETS)
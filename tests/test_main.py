@@ -1,4 +1,21 @@
+import os
+import subprocess
+import sys
 
 
 def test_it_should_work():
     assert 1 + 1 == 2
+
+
+def test_cli_imports_without_config_file(tmp_path):
+    """
+    The config file is only read once a command needs it, so `altmo --help` works without one
+    """
+    env = {**os.environ, 'ALTMO_CONFIG_FILE': str(tmp_path / 'missing.yml')}
+    result = subprocess.run(
+        [sys.executable, '-c', 'from altmo.main import cli; cli(["--help"])'],
+        env=env, capture_output=True, text=True
+    )
+
+    assert result.returncode == 0, result.stderr
+    assert 'Usage' in result.stdout
@@ -0,0 +1,57 @@
+import asyncio
+
+from altmo.metrics import Histogram, Metrics, MetricsReporter
+
+
+def test_histogram_percentiles():
+    """
+    Percentiles are interpolated within the bucket they fall in
+    """
+    histogram = Histogram(buckets=(1.0, 2.0, 4.0))
+    for value in (0.5, 1.5, 1.5, 3.0):
+        histogram.observe(value)
+
+    assert histogram.count == 4
+    assert histogram.sum == 6.5
+    assert histogram.get_percentile(50) == 1.5
+    assert histogram.get_percentile(100) == 4.0
+    assert histogram.get_cumulative_counts() == [('1.0', 1), ('2.0', 3), ('4.0', 4), ('+Inf', 4)]
+
+
+def test_empty_histogram():
+    assert Histogram().get_percentile(99) == 0.0
+
+
+def test_prometheus_textfile():
+    """
+    Counters, gauges and histograms are written in the text exposition format with our labels
+    """
+    metrics = Metrics(requests=3, pairs=10, queues={'requests': lambda: 2})
+    metrics.errors['ValhallaServerError'] += 1
+    metrics.valhalla_latency.observe(0.2)
+
+    text = metrics.to_prometheus({'worker': '1'})
+
+    assert '# TYPE altmo_requests_total counter\naltmo_requests_total{worker="1"} 3\n' in text
+    assert 'altmo_errors_total{worker="1",type="ValhallaServerError"} 1\n' in text
+    assert 'altmo_queue_depth{worker="1",queue="requests"} 2\n' in text
+    assert 'altmo_valhalla_latency_seconds_bucket{worker="1",le="+Inf"} 1\n' in text
+    assert 'altmo_valhalla_latency_seconds_count{worker="1"} 1\n' in text
+
+
+def test_reporter_writes_file_when_done(tmp_path):
+    """
+    The file is written once more when the reporter stops, so it always holds the final numbers
+    """
+    metrics = Metrics()
+    file_name = str(tmp_path / 'altmo.prom')
+
+    async def run():
+        async with MetricsReporter(metrics, file_name=file_name, interval=60):
+            metrics.pairs += 5
+
+    asyncio.run(run())
+
+    with open(file_name) as fp:
+        assert 'altmo_pairs_total 5\n' in fp.read()
+    assert not (tmp_path / 'altmo.prom.tmp').exists()
@@ -0,0 +1,72 @@
+import pytest
+
+np = pytest.importorskip('numpy')
+
+from altmo.nearest import GridIndex, get_nearest_amenities  # noqa: E402
+
+
+def get_brute_force_nearest(xy, targets, k):
+    distances = np.sqrt(((xy[:, np.newaxis, :] - targets[np.newaxis, :, :]) ** 2).sum(axis=2))
+    return np.sort(distances, axis=1)[:, :k]
+
+
+@pytest.mark.parametrize('amenity_count', [1, 2, 3, 50, 500])
+def test_grid_index_matches_brute_force(amenity_count):
+    """
+    The grid index finds the same nearest distances as comparing every pair, also for clustered points
+    """
+    rng = np.random.default_rng(1)
+    residences = rng.uniform(0, 10_000, size=(1_000, 2))
+    amenities = np.concatenate([
+        rng.uniform(0, 10_000, size=(amenity_count // 2, 2)),
+        rng.normal(2_000, 50, size=(amenity_count - amenity_count // 2, 2)),
+    ])
+
+    indices, distances = GridIndex.from_points(amenities, k=3).query(residences, k=3)
+
+    expected = get_brute_force_nearest(residences, amenities, 3)
+    assert distances.shape == expected.shape
+    np.testing.assert_allclose(distances, expected)
+    np.testing.assert_allclose(
+        np.sqrt(((residences[:, np.newaxis, :] - amenities[indices]) ** 2).sum(axis=2)), distances
+    )
+
+
+def test_grid_index_single_cluster():
+    """
+    Amenities in one small cluster far from most residences give the same results as brute force, and
+    sizing the cells over the residences too keeps them from being spread over a cell each
+    """
+    rng = np.random.default_rng(1)
+    residences = rng.uniform(0, 50_000, size=(5_000, 2))
+    amenities = rng.normal(25_000, 30, size=(500, 2))
+
+    index = GridIndex.from_points(amenities, k=3, query_xy=residences)
+    indices, distances = index.query(residences, k=3)
+
+    np.testing.assert_allclose(distances, get_brute_force_nearest(residences, amenities, 3))
+    assert len(np.unique(index.get_cells(residences), axis=0)) <= len(amenities)
+
+
+def test_get_nearest_amenities():
+    residence_ids = np.array([10, 11])
+    residence_xy = np.array([[0.0, 0.0], [100.0, 0.0]])
+    amenity_ids = np.array([1, 2, 3, 4])
+    amenity_xy = np.array([[1.0, 0.0], [90.0, 0.0], [50.0, 0.0], [0.0, 3.0]])
+
+    rows = get_nearest_amenities(residence_ids, residence_xy, amenity_ids, amenity_xy, k=2)
+
+    assert rows == [(10, 1, 1.0), (10, 4, 3.0), (11, 2, 10.0), (11, 3, 50.0)]
+
+
+def test_get_nearest_amenities_without_amenities():
+    assert get_nearest_amenities(np.array([1]), np.array([[0.0, 0.0]]), np.array([]), np.empty((0, 2))) == []
+
+
+def test_get_nearest_amenities_max_distance():
+    rows = get_nearest_amenities(
+        np.array([10, 11]), np.array([[0.0, 0.0], [100.0, 0.0]]), np.array([1, 2]), np.array([[1.0, 0.0], [5.0, 0.0]]),
+        k=2, max_distance=10
+    )
+
+    assert rows == [(10, 1, 1.0), (10, 2, 5.0)]
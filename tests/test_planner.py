@@ -0,0 +1,77 @@
+from altmo.data.types import Point
+import asyncio
+
+from altmo.planner import MatrixRequest, plan_matrix_requests, chunk_groups_async
+
+from tests.fixtures.valhalla import get_matrix_response
+
+
+def get_groups(num_residences: int, amenity_ids: list[int]) -> list[tuple]:
+    return [
+        (Point(res_id, 1.0, 1.0), [Point(amt_id, 2.0, 2.0) for amt_id in amenity_ids])
+        for res_id in range(1, num_residences + 1)
+    ]
+
+
+def test_requests_stay_within_matrix_limit():
+    """Packed requests should never exceed the configured matrix limit"""
+    requests = list(plan_matrix_requests(get_groups(20, [1, 2, 3]), matrix_limit=30))
+
+    assert all(request.size <= 30 for request in requests)
+    assert [len(request.sources) for request in requests] == [10, 10]
+    assert sum(len(request) for request in requests) == 60
+
+
+def test_large_residences_are_split():
+    """A residence needing more targets than the limit is split over several requests"""
+    requests = list(plan_matrix_requests(get_groups(1, list(range(1, 8))), matrix_limit=3))
+
+    assert [len(request.targets) for request in requests] == [3, 3, 1]
+
+
+def test_get_rows_only_returns_requested_pairs():
+    """Only the cells listed in `pairs` are fanned back out into rows"""
+    request = MatrixRequest(
+        sources=[Point(1, 1.0, 1.0), Point(2, 1.0, 1.0)],
+        targets=[Point(10, 2.0, 2.0), Point(11, 2.0, 2.0)],
+        pairs=[(0, 0), (1, 1)]
+    )
+    json_data = {'sources': [{}, {}], 'targets': [{}, {}]}
+    rows = request.get_rows(get_matrix_response(json_data)['sources_to_targets'], 'pedestrian')
+
+    assert [(row.residence_id, row.amenity_id, row.mode) for row in rows] == [
+        (1, 10, 'pedestrian'), (2, 11, 'pedestrian')
+    ]
+
+
+def test_split_keeps_the_targets_of_each_half():
+    """Each half asks for the same pairs as before, with only the targets its own sources need"""
+    request = MatrixRequest(
+        sources=[Point(1, 1.0, 1.0), Point(2, 1.0, 1.0), Point(3, 1.0, 1.0)],
+        targets=[Point(10, 2.0, 2.0), Point(11, 2.0, 2.0), Point(12, 2.0, 2.0)],
+        pairs=[(0, 0), (0, 1), (1, 1), (2, 2), (2, 0)]
+    )
+
+    def get_pairs(req: MatrixRequest) -> list[tuple[int, int]]:
+        return [(req.sources[src_idx].id, req.targets[tgt_idx].id) for src_idx, tgt_idx in req.pairs]
+
+    first, second = request.split()
+
+    assert [source.id for source in first.sources] == [1]
+    assert [target.id for target in first.targets] == [10, 11]
+    assert [target.id for target in second.targets] == [11, 12, 10]
+    assert get_pairs(first) + get_pairs(second) == get_pairs(request)
+
+
+def test_chunk_groups_keeps_residences_together():
+    """Chunks hold about `size` pairs and never split a residence"""
+    async def groups():
+        for group in get_groups(5, [1, 2, 3]):
+            yield group
+
+    async def collect() -> list[list[tuple]]:
+        return [[group async for group in chunk] async for chunk in chunk_groups_async(groups(), size=5)]
+
+    chunks = asyncio.run(collect())
+
+    assert [len(chunk) for chunk in chunks] == [2, 2, 1]
@@ -0,0 +1,85 @@
+import asyncio
+from unittest.mock import AsyncMock, MagicMock
+
+import pytest
+
+from altmo.data.columns import PairColumns
+from altmo.data.result_sets import AsyncStraightDistanceResultSet
+from tests.fixtures.straight_distance import STRAIGHT_DISTANCE
+
+
+def get_pairs(result_sets) -> list[tuple]:
+    return [
+        (residence.id, amenity.id)
+        for result_set in result_sets
+        for residence, amenities in result_set
+        for amenity in amenities
+    ]
+
+
+def get_mock_pool(fetchall: AsyncMock) -> MagicMock:
+    cur = MagicMock()
+    cur.execute = AsyncMock()
+    cur.fetchall = fetchall
+    conn = MagicMock()
+    conn.cursor.return_value.__aenter__.return_value = cur
+    pool = MagicMock()
+    pool.acquire.return_value.__aenter__.return_value = conn
+    return pool
+
+
+async def collect(result_sets) -> list[list[tuple]]:
+    return [[group async for group in result_set] async for result_set in result_sets]
+
+
+def test_async_result_set():
+    """
+    Pages are read on the pool and a residence split over two pages is merged back together
+    """
+    pages = [STRAIGHT_DISTANCE[idx:idx + 4] for idx in range(0, len(STRAIGHT_DISTANCE), 4)]
+    if len(pages[-1]) == 4:
+        pages.append([])
+    pool = get_mock_pool(AsyncMock(side_effect=pages))
+
+    result_set = AsyncStraightDistanceResultSet(pool, study_area_id=1, page_size=4, batch_size=1_000)
+    result_sets = asyncio.run(collect(result_set.result_sets))
+
+    assert get_pairs(result_sets) == [(row.residence_id, row.amenity_id) for row in STRAIGHT_DISTANCE]
+    residence_ids = [residence.id for residence, _ in result_sets[0]]
+    assert len(residence_ids) == len(set(residence_ids))
+
+    # Each page starts after the last (residence_id, amenity_id) of the previous one
+    cur = pool.acquire.return_value.__aenter__.return_value.cursor.return_value.__aenter__.return_value
+    page_params = [call.args[1] for call in cur.execute.call_args_list]
+    assert len(page_params) == len(pages)
+    assert 'after_residence_id' not in page_params[0]
+    assert (page_params[1]['after_residence_id'], page_params[1]['after_amenity_id']) == STRAIGHT_DISTANCE[3][:2]
+
+
+def test_async_result_set_error():
+    """
+    Errors while reading are raised by the consumer
+    """
+    pool = get_mock_pool(AsyncMock(side_effect=RuntimeError('connection lost')))
+    result_set = AsyncStraightDistanceResultSet(pool, study_area_id=1, page_size=4, batch_size=1_000)
+
+    with pytest.raises(RuntimeError):
+        asyncio.run(collect(result_set.result_sets))
+
+
+def test_async_result_set_pages_are_columns():
+    """
+    Pages are queued as PairColumns, so only the groups being consumed are turned into Points
+    """
+    pool = get_mock_pool(AsyncMock(side_effect=[STRAIGHT_DISTANCE[:4], []]))
+    result_set = AsyncStraightDistanceResultSet(pool, study_area_id=1, page_size=4, batch_size=1_000)
+
+    async def read_pages() -> list:
+        pages = asyncio.Queue()
+        await result_set._read_pages(pages)
+        return [pages.get_nowait() for _ in range(pages.qsize())]
+
+    page, end = asyncio.run(read_pages())
+    assert isinstance(page, PairColumns)
+    assert len(page) == 4
+    assert end is None
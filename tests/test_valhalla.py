@@ -0,0 +1,68 @@
+import asyncio
+from unittest.mock import AsyncMock, MagicMock
+
+import pytest
+
+from altmo.api.valhalla import CircuitBreaker, ValhallaAsyncClient, ValhallaServer, get_server_urls
+from altmo.errors import ValhallaServerError
+
+
+def get_server(name: str, outstanding: int = 0) -> MagicMock:
+    server = MagicMock()
+    server.name = name
+    server.outstanding = outstanding
+    return server
+
+
+def test_get_server_urls():
+    """A single URL and a list of URLs are both accepted"""
+    assert get_server_urls('http://localhost:8002') == ['http://localhost:8002']
+    assert get_server_urls(['http://a', 'unix:///tmp/v.sock']) == ['http://a', 'unix:///tmp/v.sock']
+
+
+def test_least_outstanding_server_is_used():
+    """Requests go to the server with the fewest outstanding requests"""
+    busy, idle = get_server('busy', outstanding=5), get_server('idle', outstanding=1)
+
+    async def post(*_, **__):
+        return {}
+
+    idle.post = MagicMock(side_effect=post)
+    client = ValhallaAsyncClient([busy, idle])
+
+    asyncio.run(client.source_to_targets(json={}))
+
+    idle.post.assert_called_once_with('/sources_to_targets', json={})
+    busy.post.assert_not_called()
+
+
+def test_server_error_releases_connection(mocker):
+    """The connection goes back to the pool even though we never read the body of a 5xx response"""
+    resp = MagicMock(ok=False, status=503)
+    mocker.patch('altmo.api.valhalla.aiohttp.ClientSession.post', AsyncMock(return_value=resp))
+
+    async def main():
+        server = ValhallaServer('http://localhost:8002')
+        try:
+            with pytest.raises(ValhallaServerError):
+                await server.post('/sources_to_targets', json={})
+        finally:
+            await server.close()
+
+    asyncio.run(main())
+
+    resp.release.assert_called_once()
+
+
+def test_open_circuit_breakers_are_waited_for():
+    """When no server is available, the request waits for the first circuit breaker to close"""
+    server = get_server('only')
+    server.breaker = CircuitBreaker(threshold=1, reset_timeout=0.05)
+    server.breaker.record_failure()
+    server.post = AsyncMock(return_value={})
+    client = ValhallaAsyncClient([server])
+
+    assert not server.breaker.available
+    asyncio.run(client.source_to_targets(json={}))
+
+    server.post.assert_called_once_with('/sources_to_targets', json={})